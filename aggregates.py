@@ -0,0 +1,178 @@
+"""Counts and summaries of the stored posts that are kept up to date as posts come and go.
+
+Pages read these instead of working them out from the posts on every request. Each aggregate is keyed so that it can
+be fetched directly by key name and is updated in its own transaction so that concurrent ingests don't lose counts.
+
+A post is counted under the day, feed and author it had when it was first stored. Edits to a post don't move it: its
+PostDigest records where it was counted so that deleting it uncounts it from the same aggregates. Posts stored before
+they were counted as they came in are counted by countStoredPosts.
+"""
+
+from google.appengine.ext import db
+
+import logging
+import pshb
+
+class DayAggregate(db.Model):
+  """The posts published on a single day. Keyed by the day in YYYY-MM-DD form."""
+  day = db.DateProperty(required=True)
+  # The heading shown above the day's posts
+  label = db.StringProperty(indexed=False)
+  posts = db.IntegerProperty(default=0)
+
+class FeedAggregate(db.Model):
+  """The posts stored for a single feed. Keyed by the feed's url."""
+  feedUrl = db.StringProperty(required=True)
+  posts = db.IntegerProperty(default=0)
+  latestPostTitle = db.StringProperty(multiline=True, indexed=False)
+  latestPostUrl = db.StringProperty(indexed=False)
+  latestPostDate = db.DateTimeProperty(indexed=False)
+
+class AuthorAggregate(db.Model):
+  """The posts written by a single author. Keyed by the author's name."""
+  author = db.StringProperty(required=True)
+  posts = db.IntegerProperty(default=0)
+
+def dayKeyName(day):
+  return day.strftime('%Y-%m-%d')
+
+def dayLabel(day):
+  return day.strftime('%A %B %d, %Y')
+
+def _authorKeyName(author):
+  # Key names can't start with two underscores
+  return 'author:%s' % author
+
+def _countByKey(posts, keyFor):
+  """Return a dictionary mapping each key to the posts it's given for. Posts whose key is None are left out."""
+  postsByKey = {}
+  for post in posts:
+    key = keyFor(post)
+    if key is not None:
+      postsByKey.setdefault(key, []).append(post)
+  return postsByKey
+
+def _postDay(post):
+  return post.datePublished and post.datePublished.date()
+
+def _countedUnder(post):
+  """Return the day and author the post is counted under if it's counted now"""
+  return _postDay(post), post.author or None
+
+def _tally(keys):
+  """Return a dictionary mapping each key to how many times it appears. None isn't counted."""
+  counts = {}
+  for key in keys:
+    if key is not None:
+      counts[key] = counts.get(key, 0) + 1
+  return counts
+
+def _updateDay(day, delta):
+  aggregate = DayAggregate.get_by_key_name(dayKeyName(day))
+  if aggregate is None:
+    aggregate = DayAggregate(key_name=dayKeyName(day), day=day, label=dayLabel(day))
+  aggregate.posts = max(0, aggregate.posts + delta)
+  aggregate.put()
+
+def _updateFeed(feedUrl, delta, latestPost):
+  aggregate = FeedAggregate.get_by_key_name(feedUrl)
+  if aggregate is None:
+    aggregate = FeedAggregate(key_name=feedUrl, feedUrl=feedUrl)
+  aggregate.posts = max(0, aggregate.posts + delta)
+  if latestPost and (aggregate.latestPostDate is None or latestPost.datePublished >= aggregate.latestPostDate):
+    aggregate.latestPostTitle = latestPost.title
+    aggregate.latestPostUrl = latestPost.url
+    aggregate.latestPostDate = latestPost.datePublished
+  aggregate.put()
+
+def _updateAuthor(author, delta):
+  aggregate = AuthorAggregate.get_by_key_name(_authorKeyName(author))
+  if aggregate is None:
+    aggregate = AuthorAggregate(key_name=_authorKeyName(author), author=author)
+  aggregate.posts = max(0, aggregate.posts + delta)
+  aggregate.put()
+
+def _latest(posts):
+  dated = [(post.datePublished, post) for post in posts if post.datePublished]
+  if not dated:
+    return None
+  return max(dated)[1]
+
+def _updateDaysAndAuthors(countedUnder, sign):
+  """Count, or uncount, posts under the (day, author) pairs they're counted under"""
+  for day, count in _tally([day for day, author in countedUnder]).items():
+    db.run_in_transaction(_updateDay, day, sign * count)
+  for author, count in _tally([author for day, author in countedUnder]).items():
+    db.run_in_transaction(_updateAuthor, author, sign * count)
+
+def _markCounted(posts, digests):
+  """Record where each post has been counted in its PostDigest. Posts without a digest are left out."""
+  for post, digest in zip(posts, digests):
+    if digest:
+      digest.counted = True
+      digest.countedDay, digest.countedAuthor = _countedUnder(post)
+  db.put([digest for digest in digests if digest])
+
+def postsStored(changedPosts, newPosts):
+  """Count the posts that have just been stored for the first time.
+
+  newPosts must be a subset of changedPosts and must have been stored along with their digests. Posts that were stored
+  again because they changed only update the latest post of their feed."""
+  _updateDaysAndAuthors([_countedUnder(post) for post in newPosts], 1)
+  newPostIds = dict([(id(post), True) for post in newPosts])
+  for feedUrl, postsInFeed in _countByKey(changedPosts, lambda post: post.feedUrl).items():
+    newPostsInFeed = [post for post in postsInFeed if id(post) in newPostIds]
+    db.run_in_transaction(_updateFeed, feedUrl, len(newPostsInFeed), _latest(postsInFeed))
+  if newPosts:
+    _markCounted(newPosts, pshb.PostDigest.get_by_key_name([post.key().name() for post in newPosts]))
+  logging.info("Updated aggregates for %d new and %d changed posts" % (len(newPosts), len(changedPosts) - len(newPosts)))
+
+def postsDeleted(posts):
+  """Stop counting posts that are about to be deleted.
+
+  Each post is uncounted from the day and author it was counted under, whatever it has now. Posts that were never
+  counted are left alone. Posts are only deleted along with their feed so the feed's aggregate is left to
+  feedDeleted."""
+  digests = pshb.PostDigest.get_by_key_name([post.key().name() for post in posts])
+  countedDigests = [digest for digest in digests if digest and digest.counted]
+  _updateDaysAndAuthors([(digest.countedDay, digest.countedAuthor) for digest in countedDigests], -1)
+
+def countStoredPosts(cursor=None, batchSize=100):
+  """Count the next batch of posts that were stored without being counted.
+
+  Return a cursor for the following batch or None if there are no more posts. Posts that are already counted are
+  skipped so a batch that's run again doesn't count them twice."""
+  query = pshb.Post.all()
+  if cursor:
+    query.with_cursor(cursor)
+  posts = query.fetch(batchSize)
+  digests = pshb.PostDigest.get_by_key_name([post.key().name() for post in posts])
+  # Posts stored before digests existed are given one, which needs their body
+  pshb.Post.fetchBodies([post for post, digest in zip(posts, digests) if digest is None])
+  uncountedPosts = []
+  uncountedDigests = []
+  for post, digest in zip(posts, digests):
+    if digest is None:
+      digest = pshb.PostDigest(key_name=post.key().name(), digest=post.computeDigest())
+    if not digest.counted:
+      uncountedPosts.append(post)
+      uncountedDigests.append(digest)
+  _updateDaysAndAuthors([_countedUnder(post) for post in uncountedPosts], 1)
+  for feedUrl, postsInFeed in _countByKey(uncountedPosts, lambda post: post.feedUrl).items():
+    db.run_in_transaction(_updateFeed, feedUrl, len(postsInFeed), _latest(postsInFeed))
+  _markCounted(uncountedPosts, uncountedDigests)
+  logging.info("Counted %d of %d stored posts" % (len(uncountedPosts), len(posts)))
+  if len(posts) < batchSize:
+    return None
+  return query.cursor()
+
+def feedDeleted(feedUrl):
+  db.delete(db.Key.from_path('FeedAggregate', feedUrl))
+
+def getDays(days):
+  """Return the aggregate for each of the days, or None for days without one, in a single fetch"""
+  return DayAggregate.get_by_key_name([dayKeyName(day) for day in days])
+
+def getFeeds(feedUrls):
+  """Return the aggregate for each of the feeds, or None for feeds without one, in a single fetch"""
+  return FeedAggregate.get_by_key_name(feedUrls)
@@ -0,0 +1,118 @@
+"""An Atom feed of the posts Streamer has stored.
+
+Each post is serialized to an atom:entry once, when it's stored, and keeps the serialized form alongside the rest of
+its data. Building the feed is then just a matter of joining up the entries of the newest posts.
+"""
+
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+import logging
+import time
+
+ATOM_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def _unicode(value):
+  if isinstance(value, str):
+    return value.decode('utf-8', 'replace')
+  return unicode(value)
+
+def _element(out, name, value, attributes=None):
+  if value is None or value == '':
+    return
+  out.append(u'<%s' % name)
+  for attributeName, attributeValue in attributes or []:
+    if attributeValue:
+      out.append(u' %s=%s' % (attributeName, quoteattr(_unicode(attributeValue))))
+  out.append(u'>%s</%s>' % (escape(_unicode(value)), name))
+
+def _link(out, rel, href, type=None):
+  if not href:
+    return
+  out.append(u'<link rel=%s href=%s' % (quoteattr(rel), quoteattr(_unicode(href))))
+  if type:
+    out.append(u' type=%s' % quoteattr(type))
+  out.append(u'/>')
+
+def _formatDate(date):
+  """Format a datetime or a time.struct_time as an Atom date"""
+  if date is None:
+    return None
+  if isinstance(date, time.struct_time):
+    return time.strftime(ATOM_DATE_FORMAT, date)
+  return date.strftime(ATOM_DATE_FORMAT)
+
+def _textType(contentType):
+  if not contentType or 'html' in contentType:
+    return 'html'
+  return 'text'
+
+def serializeEntry(post):
+  """Return the post as an atom:entry.
+
+  As much of the original entry as FeedParser kept is carried over and the feed it came from is named in atom:source."""
+  try:
+    entry = post.getFeedParserEntry()
+  except Exception, e:
+    # The entry is only there to enrich the output so a post whose entry can't be read still gets serialized
+    logging.warn("Couldn't read the entry stored for post: %s. Error was: %s" % (post.key().name(), e))
+    entry = {}
+  out = [u'<entry>']
+  _element(out, 'id', post.key().name())
+  _element(out, 'title', post.title, [('type', 'text')])
+  _link(out, 'alternate', post.url)
+  published = _formatDate(post.datePublished)
+  _element(out, 'updated', _formatDate(entry.get('updated_parsed')) or published)
+  _element(out, 'published', published)
+
+  authorDetail = entry.get('author_detail') or {}
+  out.append(u'<author>')
+  _element(out, 'name', post.author or authorDetail.get('name') or u'Unknown')
+  _element(out, 'email', authorDetail.get('email'))
+  _element(out, 'uri', authorDetail.get('href'))
+  out.append(u'</author>')
+
+  for tag in entry.get('tags') or []:
+    out.append(u'<category term=%s' % quoteattr(_unicode(tag.get('term') or u'')))
+    for attributeName, key in [('scheme', 'scheme'), ('label', 'label')]:
+      if tag.get(key):
+        out.append(u' %s=%s' % (attributeName, quoteattr(_unicode(tag[key]))))
+    out.append(u'/>')
+
+  contents = entry.get('content') or []
+  contentType = contents and contents[0].get('type') or 'text/html'
+  summary = entry.get('summary')
+  content = post.getContent()
+  if summary and summary != content:
+    summaryType = (entry.get('summary_detail') or {}).get('type')
+    _element(out, 'summary', summary, [('type', _textType(summaryType))])
+  _element(out, 'content', content, [('type', _textType(contentType))])
+
+  out.append(u'<source>')
+  _element(out, 'id', post.feedUrl)
+  _link(out, 'self', post.feedUrl)
+  out.append(u'</source>')
+  out.append(u'</entry>')
+  return u''.join(out)
+
+def serializePosts(posts):
+  """Store the serialized form of each of the posts on it, ready to be put"""
+  for post in posts:
+    post.getBody().atomEntry = serializeEntry(post)
+
+def renderFeed(posts, selfUrl, alternateUrl, hub=None, title=u'Streamer'):
+  """Return the posts as a utf-8 encoded Atom document. Their bodies should have been fetched with Post.fetchBodies."""
+  out = [u'<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">']
+  _element(out, 'title', title)
+  _element(out, 'id', selfUrl)
+  _link(out, 'self', selfUrl, 'application/atom+xml')
+  _link(out, 'alternate', alternateUrl, 'text/html')
+  _link(out, 'hub', hub)
+  updated = [post.datePublished for post in posts if post.datePublished]
+  _element(out, 'updated', _formatDate(updated and max(updated) or None) or time.strftime(ATOM_DATE_FORMAT, time.gmtime()))
+  out.append(u'<author><name>%s</name></author>' % escape(title))
+  for post in posts:
+    # Posts stored before entries were serialized on the way in are serialized now
+    out.append(post.getBody().atomEntry or serializeEntry(post))
+  out.append(u'</feed>')
+  return u''.join(out).encode('utf-8')
@@ -0,0 +1,105 @@
+"""A cache for rendered pages that are expensive to build but rarely change.
+
+Pages live in memcache so that every instance shares them. Pages that are too big for memcache, or that are cached
+while it can't be reached, are kept in this process instead. No other instance can invalidate those copies so they
+only live for LOCAL_CACHE_SECONDS.
+
+Every cache key includes a generation number. Invalidating bumps the generation, which means a page that was being
+rendered while the posts it shows changed gets stored under a key that will never be read again.
+"""
+
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+
+NAMESPACE = 'pages'
+GENERATION_KEY = 'generation'
+
+LOCAL_CACHE_SIZE = 20
+LOCAL_CACHE_SECONDS = 60
+
+_localPages = {}
+_localGeneration = [0]
+
+class CachedPage(object):
+  """A rendered page along with what's needed to answer conditional requests for it and to know when it's stale"""
+
+  def __init__(self, body, oldestPost=None):
+    self.body = body
+    self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+    # Publication date of the oldest post on the page. None means any new post belongs on the page.
+    self.oldestPost = oldestPost
+
+  def matches(self, ifNoneMatch):
+    """Return True if the If-None-Match header value names this version of the page"""
+    if not ifNoneMatch:
+      return False
+    etags = [etag.strip() for etag in ifNoneMatch.split(',')]
+    return '*' in etags or self.etag in etags
+
+  def wouldShow(self, posts):
+    """Return True if storing the posts changes this page"""
+    if self.oldestPost is None:
+      return True
+    for post in posts:
+      if post.datePublished is None or post.datePublished >= self.oldestPost:
+        return True
+    return False
+
+def _generation():
+  generation = memcache.get(GENERATION_KEY, namespace=NAMESPACE)
+  if generation is None:
+    # Start from the clock rather than 0 so that pages cached before memcache lost the counter are never served again
+    memcache.add(GENERATION_KEY, int(time.time()), namespace=NAMESPACE)
+    generation = memcache.get(GENERATION_KEY, namespace=NAMESPACE)
+    if generation is None:
+      return 'local%d' % _localGeneration[0]
+  return generation
+
+def pageKey(name):
+  """Return the key the page called name is currently cached under"""
+  return "%s:%s" % (_generation(), name)
+
+def get(key):
+  page = memcache.get(key, namespace=NAMESPACE)
+  if page is not None:
+    return page
+  storedAt, page = _localPages.get(key, (0, None))
+  if time.time() - storedAt < LOCAL_CACHE_SECONDS:
+    return page
+  return None
+
+def set(key, page):
+  try:
+    if memcache.set(key, page, namespace=NAMESPACE):
+      return
+  except ValueError:
+    # memcache refuses values over 1MB, which a page of full entries can easily be
+    logging.info("Page: %s is too big for memcache so it's only cached in this instance" % key)
+  if len(_localPages) >= LOCAL_CACHE_SIZE:
+    oldestKey = min([(storedAt, k) for k, (storedAt, p) in _localPages.items()])[1]
+    del _localPages[oldestKey]
+  _localPages[key] = (time.time(), page)
+
+def invalidate():
+  """Make every cached page stale"""
+  # If the counter doesn't exist then nothing can have been cached under it so there's nothing to do for memcache
+  memcache.incr(GENERATION_KEY, namespace=NAMESPACE)
+  _localGeneration[0] += 1
+  _localPages.clear()
+
+def invalidateIfShown(names, posts):
+  """Invalidate the cached pages if storing the posts changes any of the pages with the given names.
+
+  Pages that aren't cached have nothing to invalidate so only the ones that are decide. Pages such as the admin's
+  front page are rarely cached and would otherwise make every ingest invalidate everything."""
+  if not posts:
+    return
+  generation = _generation()
+  for name in names:
+    page = get("%s:%s" % (generation, name))
+    if page is not None and page.wouldShow(posts):
+      invalidate()
+      return
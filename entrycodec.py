@@ -0,0 +1,263 @@
+"""A compact, versioned binary serialization for FeedParser entries.
+
+Entries used to be stored as repr() strings and brought back with eval(). This format is smaller, much faster to decode
+and lets a caller pull out individual top-level fields without rebuilding the whole entry.
+
+The layout is:
+  version byte, flags byte, then the (optionally zlib compressed) body.
+  The body is a key table (count followed by length-prefixed utf-8 keys) followed by a single encoded value.
+  Every value starts with a one byte tag. Dictionaries store each field as a key table index, the encoded length of
+  the value and then the value itself so that a reader can skip over the fields it doesn't want.
+"""
+
+import struct
+import time
+import zlib
+
+import feedparser
+
+VERSION = 1
+
+FLAG_COMPRESSED = 1
+
+# Entries smaller than this aren't worth the cost of compressing
+COMPRESSION_THRESHOLD = 256
+
+_NONE = 'N'
+_TRUE = 'T'
+_FALSE = 'F'
+_INT = 'i'
+_FLOAT = 'f'
+_STR = 's'
+_UNICODE = 'u'
+_LIST = 'l'
+_TUPLE = 'p'
+_DICT = 'd'
+_TIME = 't'
+
+class CodecError(Exception):
+  pass
+
+def _encodeVarint(value, out):
+  while value > 0x7f:
+    out.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  out.append(chr(value))
+
+def _decodeVarint(data, position):
+  result = 0
+  shift = 0
+  while True:
+    byte = ord(data[position])
+    position += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result, position
+    shift += 7
+
+def _zigzag(value):
+  if value >= 0:
+    return value << 1
+  return ((-value) << 1) - 1
+
+def _unzigzag(value):
+  if value & 1:
+    return -((value + 1) >> 1)
+  return value >> 1
+
+class _Encoder(object):
+  def __init__(self):
+    self.keys = []
+    self.keyIndexes = {}
+
+  def keyIndex(self, key):
+    index = self.keyIndexes.get(key)
+    if index is None:
+      index = len(self.keys)
+      self.keys.append(key)
+      self.keyIndexes[key] = index
+    return index
+
+  def encode(self, value, out):
+    # Order matters: bool is a subclass of int and struct_time is a subclass of tuple
+    if value is None:
+      out.append(_NONE)
+    elif value is True:
+      out.append(_TRUE)
+    elif value is False:
+      out.append(_FALSE)
+    elif isinstance(value, (int, long)):
+      out.append(_INT)
+      _encodeVarint(_zigzag(value), out)
+    elif isinstance(value, float):
+      out.append(_FLOAT)
+      out.append(struct.pack('>d', value))
+    elif isinstance(value, unicode):
+      encoded = value.encode('utf-8')
+      out.append(_UNICODE)
+      _encodeVarint(len(encoded), out)
+      out.append(encoded)
+    elif isinstance(value, str):
+      out.append(_STR)
+      _encodeVarint(len(value), out)
+      out.append(value)
+    elif isinstance(value, time.struct_time):
+      out.append(_TIME)
+      for field in value:
+        _encodeVarint(_zigzag(field), out)
+    elif isinstance(value, (list, tuple)):
+      if isinstance(value, tuple):
+        out.append(_TUPLE)
+      else:
+        out.append(_LIST)
+      _encodeVarint(len(value), out)
+      for item in value:
+        self.encode(item, out)
+    elif isinstance(value, dict):
+      out.append(_DICT)
+      _encodeVarint(len(value), out)
+      for key, item in value.items():
+        encodedItem = []
+        self.encode(item, encodedItem)
+        encodedItem = ''.join(encodedItem)
+        _encodeVarint(self.keyIndex(key), out)
+        _encodeVarint(len(encodedItem), out)
+        out.append(encodedItem)
+    else:
+      raise CodecError("Can't encode value of type: %s" % type(value))
+
+def encode(entry, compress=True):
+  """Return a byte string holding the given entry"""
+  encoder = _Encoder()
+  body = []
+  encoder.encode(entry, body)
+  out = []
+  _encodeVarint(len(encoder.keys), out)
+  for key in encoder.keys:
+    if isinstance(key, unicode):
+      key = key.encode('utf-8')
+    _encodeVarint(len(key), out)
+    out.append(key)
+  out.extend(body)
+  payload = ''.join(out)
+
+  flags = 0
+  if compress and len(payload) > COMPRESSION_THRESHOLD:
+    payload = zlib.compress(payload)
+    flags |= FLAG_COMPRESSED
+  return chr(VERSION) + chr(flags) + payload
+
+def _decodeKey(rawKey):
+  # FeedParser's own keys are plain strings so only fall back to unicode when we must
+  try:
+    return rawKey.decode('ascii').encode('ascii')
+  except UnicodeError:
+    return rawKey.decode('utf-8')
+
+def _readPayload(data):
+  """Return the uncompressed payload along with the key table and the position of the first value"""
+  if len(data) < 2:
+    raise CodecError("Encoded entry is too short")
+  version = ord(data[0])
+  if version != VERSION:
+    raise CodecError("Unsupported entry encoding version: %d" % version)
+  payload = data[2:]
+  if ord(data[1]) & FLAG_COMPRESSED:
+    payload = zlib.decompress(payload)
+
+  keyCount, position = _decodeVarint(payload, 0)
+  keys = []
+  for i in range(keyCount):
+    length, position = _decodeVarint(payload, position)
+    keys.append(_decodeKey(payload[position:position + length]))
+    position += length
+  return payload, keys, position
+
+def _decodeValue(data, position, keys):
+  """Return the value starting at position and the position just after it"""
+  tag = data[position]
+  position += 1
+  if tag == _NONE:
+    return None, position
+  elif tag == _TRUE:
+    return True, position
+  elif tag == _FALSE:
+    return False, position
+  elif tag == _INT:
+    value, position = _decodeVarint(data, position)
+    return _unzigzag(value), position
+  elif tag == _FLOAT:
+    return struct.unpack('>d', data[position:position + 8])[0], position + 8
+  elif tag == _STR or tag == _UNICODE:
+    length, position = _decodeVarint(data, position)
+    value = data[position:position + length]
+    if tag == _UNICODE:
+      value = value.decode('utf-8')
+    return value, position + length
+  elif tag == _TIME:
+    fields = []
+    for i in range(9):
+      field, position = _decodeVarint(data, position)
+      fields.append(_unzigzag(field))
+    return time.struct_time(fields), position
+  elif tag == _LIST or tag == _TUPLE:
+    count, position = _decodeVarint(data, position)
+    items = []
+    for i in range(count):
+      item, position = _decodeValue(data, position, keys)
+      items.append(item)
+    if tag == _TUPLE:
+      return tuple(items), position
+    return items, position
+  elif tag == _DICT:
+    count, position = _decodeVarint(data, position)
+    value = feedparser.FeedParserDict()
+    for i in range(count):
+      keyIndex, position = _decodeVarint(data, position)
+      length, position = _decodeVarint(data, position)
+      # Store the items directly so that FeedParserDict doesn't try to remap the keys it wrote out in the first place
+      item, position = _decodeValue(data, position, keys)
+      dict.__setitem__(value, keys[keyIndex], item)
+    return value, position
+  raise CodecError("Unknown tag: %r at position: %d" % (tag, position - 1))
+
+def decode(data):
+  """Return the FeedParserDict held in the given byte string"""
+  payload, keys, position = _readPayload(data)
+  value, position = _decodeValue(payload, position, keys)
+  return value
+
+class LazyEntry(object):
+  """Read-only access to the top-level fields of an encoded entry that only decodes the fields that are asked for"""
+
+  def __init__(self, data):
+    # Not self.keys, which would hide the keys method
+    self.payload, self._keyTable, position = _readPayload(data)
+    if self.payload[position] != _DICT:
+      raise CodecError("Encoded value is not an entry")
+    count, position = _decodeVarint(self.payload, position + 1)
+    self.offsets = {}
+    for i in range(count):
+      keyIndex, position = _decodeVarint(self.payload, position)
+      length, position = _decodeVarint(self.payload, position)
+      self.offsets[self._keyTable[keyIndex]] = position
+      position += length
+    self.decoded = {}
+
+  def __getitem__(self, key):
+    if key not in self.decoded:
+      self.decoded[key] = _decodeValue(self.payload, self.offsets[key], self._keyTable)[0]
+    return self.decoded[key]
+
+  def __contains__(self, key):
+    return key in self.offsets
+
+  has_key = __contains__
+
+  def get(self, key, default=None):
+    if key in self.offsets:
+      return self[key]
+    return default
+
+  def keys(self):
+    return self.offsets.keys()
@@ -75,6 +75,11 @@ RESOLVE_RELATIVE_URIS = 1
 # HTML content, set this to 1.
 SANITIZE_HTML = 1
 
+# If you want feedparser to look for microformats in HTML content, set this to
+# 1. It only has an effect when BeautifulSoup is installed, and it can be
+# overridden for a single feed with the microformats argument to parse().
+PARSE_MICROFORMATS = 1
+
 # ---------- required modules (should come with any Python distribution) ----------
 import sgmllib, re, sys, copy, urlparse, time, rfc822, types, cgi, urllib, urllib2
 try:
@@ -229,7 +234,17 @@ class FeedParserDict(UserDict):
               'copyright_detail': 'rights_detail',
               'tagline': 'subtitle',
               'tagline_detail': 'subtitle_detail'}
-    def __getitem__(self, key):
+    # Keys whose values are computed from other keys every time they're read
+    _computedkeys = {'category': 1, 'enclosures': 1, 'license': 1, 'categories': 1}
+    # Where each alias is stored when it's written. Worked out once here rather than on every write.
+    _setkeymap = {}
+    for k, v in keymap.items():
+        if type(v) == types.ListType:
+            v = v[0]
+        _setkeymap[k] = v
+    del k, v
+
+    def _computeditem(self, key):
         if key == 'category':
             return UserDict.__getitem__(self, 'tags')[0]['term']
         if key == 'enclosures':
@@ -239,29 +254,31 @@ class FeedParserDict(UserDict):
             for link in UserDict.__getitem__(self, 'links'):
                 if link['rel']=='license' and link.has_key('href'):
                     return link['href']
-        if key == 'categories':
-            return [(tag['scheme'], tag['term']) for tag in UserDict.__getitem__(self, 'tags')]
-        realkey = self.keymap.get(key, key)
+            return UserDict.__getitem__(self, key)
+        return [(tag['scheme'], tag['term']) for tag in UserDict.__getitem__(self, 'tags')]
+
+    def __getitem__(self, key):
+        if key in self._computedkeys:
+            return self._computeditem(key)
+        realkey = self.keymap.get(key)
+        if realkey is None:
+            return UserDict.__getitem__(self, key)
         if type(realkey) == types.ListType:
             for k in realkey:
-                if UserDict.has_key(self, k):
+                if UserDict.__contains__(self, k):
                     return UserDict.__getitem__(self, k)
-        if UserDict.has_key(self, key):
+            return UserDict.__getitem__(self, key)
+        if UserDict.__contains__(self, key):
             return UserDict.__getitem__(self, key)
         return UserDict.__getitem__(self, realkey)
 
     def __setitem__(self, key, value):
-        for k in self.keymap.keys():
-            if key == k:
-                key = self.keymap[k]
-                if type(key) == types.ListType:
-                    key = key[0]
-        return UserDict.__setitem__(self, key, value)
+        return UserDict.__setitem__(self, self._setkeymap.get(key, key), value)
 
     def get(self, key, default=None):
-        if self.has_key(key):
-            return self[key]
-        else:
+        try:
+            return self.__getitem__(key)
+        except Exception:
             return default
 
     def setdefault(self, key, value):
@@ -270,20 +287,27 @@ class FeedParserDict(UserDict):
         return self[key]
         
     def has_key(self, key):
+        if UserDict.__contains__(self, key):
+            return True
+        if key in self._computedkeys or key in self.keymap:
+            try:
+                self.__getitem__(key)
+                return True
+            except Exception:
+                pass
+        # Attributes such as the dictionary's own methods have always counted as keys
         try:
-            return hasattr(self, key) or UserDict.has_key(self, key)
-        except AttributeError:
+            return hasattr(self.__class__, key) or self.__dict__.has_key(key)
+        except TypeError:
             return False
         
     def __getattr__(self, key):
+        # Only called when normal attribute lookup has failed so the instance dictionary has already been checked
+        if key.startswith('_'):
+            raise AttributeError, "object has no attribute '%s'" % key
         try:
-            return self.__dict__[key]
-        except KeyError:
-            pass
-        try:
-            assert not key.startswith('_')
             return self.__getitem__(key)
-        except:
+        except Exception:
             raise AttributeError, "object has no attribute '%s'" % key
 
     def __setattr__(self, key, value):
@@ -439,6 +463,11 @@ class _FeedParserMixin:
     can_be_relative_uri = ['link', 'id', 'wfw_comment', 'wfw_commentrss', 'docs', 'url', 'href', 'comments', 'icon', 'logo']
     can_contain_relative_uris = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
     can_contain_dangerous_markup = ['content', 'title', 'summary', 'info', 'tagline', 'subtitle', 'copyright', 'rights', 'description']
+    can_contain_microformats = ['content', 'description', 'summary']
+    # None means use the module-wide PARSE_MICROFORMATS setting
+    parse_microformats = None
+    # A dictionary to add the seconds spent on embedded markup to under 'sanitize', or None not to time it
+    timings = None
     html_types = ['text/html', 'application/xhtml+xml']
     
     def __init__(self, baseuri=None, baselang=None, encoding='utf-8'):
@@ -770,15 +799,30 @@ class _FeedParserMixin:
             pass
 
         is_htmlish = self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types
+        # text without tags or entities has nothing to resolve, mine for microformats or sanitize
+        has_markup = is_htmlish and (output.find('<') != -1 or output.find('&') != -1)
+        content_type = self.contentparams.get('type', 'text/html')
+        resolve = has_markup and RESOLVE_RELATIVE_URIS and element in self.can_contain_relative_uris
+        sanitize = has_markup and SANITIZE_HTML and element in self.can_contain_dangerous_markup
+        parse_microformats = self.parse_microformats
+        if parse_microformats is None:
+            parse_microformats = PARSE_MICROFORMATS
+        microformats = has_markup and parse_microformats and BeautifulSoup and element in self.can_contain_microformats
+        markup_started = has_markup and self.timings is not None and time.time()
+
+        if resolve and sanitize and not microformats:
+            # resolve relative URIs and sanitize in a single pass over the markup
+            output = _sanitizeHTML(output, self.encoding, content_type, self.baseuri, resolveURIs=1)
+            resolve = sanitize = 0
+
         # resolve relative URIs within embedded markup
-        if is_htmlish and RESOLVE_RELATIVE_URIS:
-            if element in self.can_contain_relative_uris:
-                output = _resolveRelativeURIs(output, self.baseuri, self.encoding, self.contentparams.get('type', 'text/html'))
+        if resolve:
+            output = _resolveRelativeURIs(output, self.baseuri, self.encoding, content_type)
                 
         # parse microformats
         # (must do this before sanitizing because some microformats
         # rely on elements that we sanitize)
-        if is_htmlish and element in ['content', 'description', 'summary']:
+        if microformats:
             mfresults = _parseMicroformats(output, self.baseuri, self.encoding)
             if mfresults:
                 for tag in mfresults.get('tags', []):
@@ -792,9 +836,10 @@ class _FeedParserMixin:
                     self._getContext()['vcard'] = vcard
         
         # sanitize embedded markup
-        if is_htmlish and SANITIZE_HTML:
-            if element in self.can_contain_dangerous_markup:
-                output = _sanitizeHTML(output, self.encoding, self.contentparams.get('type', 'text/html'))
+        if sanitize:
+            output = _sanitizeHTML(output, self.encoding, content_type)
+        if markup_started:
+            _add_timing(self.timings, 'sanitize', markup_started)
 
         if self.encoding and type(output) != type(u''):
             try:
@@ -812,7 +857,7 @@ class _FeedParserMixin:
 
         # map win-1252 extensions to the proper code points
         if type(output) == type(u''):
-            output = u''.join([c in _cp1252.keys() and _cp1252[c] or c for c in output])
+            output = u''.join([_cp1252.get(c, c) for c in output])
 
         # categories/tags/keywords/whatever are handled in _end_category
         if element == 'category':
@@ -1684,6 +1729,17 @@ if _XML_AVAILABLE:
             self.error(exc)
             raise exc
 
+    class _IncrementalFeedParser(_StrictFeedParser):
+        '''A strict parser that hands over each entry as soon as it ends instead of collecting them all'''
+        def __init__(self, baseuri, baselang, encoding):
+            _StrictFeedParser.__init__(self, baseuri, baselang, encoding)
+            self.finished_entries = []
+
+        def _end_item(self):
+            _StrictFeedParser._end_item(self)
+            self.finished_entries.append(self.entries.pop())
+        _end_entry = _end_item
+
 class _BaseHTMLProcessor(sgmllib.SGMLParser):
     special = re.compile('''[<>'"]''')
     bare_ampersand = re.compile("&(?!#\d+;|#x[0-9a-fA-F]+;|\w+;)")
@@ -2574,8 +2630,27 @@ class _HTMLSanitizer(_BaseHTMLProcessor):
         return ' '.join(clean)
 
 
-def _sanitizeHTML(htmlSource, encoding, type):
-    p = _HTMLSanitizer(encoding, type)
+class _RelativeURIResolvingSanitizer(_HTMLSanitizer):
+    '''Resolves relative URIs as it sanitizes so that markup only needs one pass through sgmllib'''
+    relative_uris = _RelativeURIResolver.relative_uris
+
+    def __init__(self, baseuri, encoding, type):
+        _HTMLSanitizer.__init__(self, encoding, type)
+        self.baseuri = baseuri
+
+    def resolveURI(self, uri):
+        return _urljoin(self.baseuri, uri.strip())
+
+    def unknown_starttag(self, tag, attrs):
+        attrs = self.normalize_attrs(attrs)
+        attrs = [(key, ((tag, key) in self.relative_uris) and self.resolveURI(value) or value) for key, value in attrs]
+        _HTMLSanitizer.unknown_starttag(self, tag, attrs)
+
+def _sanitizeHTML(htmlSource, encoding, type, baseURI=None, resolveURIs=0):
+    if resolveURIs:
+        p = _RelativeURIResolvingSanitizer(baseURI, encoding, type)
+    else:
+        p = _HTMLSanitizer(encoding, type)
     p.feed(htmlSource)
     data = p.output()
     if TIDY_MARKUP:
@@ -2771,10 +2846,72 @@ def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, h
     # treat url_file_stream_or_string as string
     return _StringIO(str(url_file_stream_or_string))
 
+class _LRUCache:
+    '''A mapping that holds at most maxsize items, forgetting the least recently used item to make room'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        # Each link is [previous link, next link, key, value] in a circular list ordered from oldest to newest
+        self._links = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def _moveToNewest(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        root = self._root
+        newest = root[0]
+        newest[1] = root[0] = link
+        link[0] = newest
+        link[1] = root
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            return default
+        self._moveToNewest(link)
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            link[3] = value
+            self._moveToNewest(link)
+            return
+        root = self._root
+        if len(self._links) >= self.maxsize:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self._links[oldest[2]]
+        newest = root[0]
+        link = [newest, root, key, value]
+        newest[1] = root[0] = link
+        self._links[key] = link
+
+    def __len__(self):
+        return len(self._links)
+
 _date_handlers = []
 def registerDateHandler(func):
     '''Register a date handler function (takes string, returns 9-tuple date in GMT)'''
     _date_handlers.insert(0, func)
+    # A new handler may parse dates differently so forget everything learnt from the old ones
+    _date_cache.clear()
+    _date_handler_by_signature.clear()
+
+# Entries in the same document often share timestamps so remember the dates that have already been parsed
+_date_cache = _LRUCache(1000)
+
+# The handler that last parsed each shape of date string. It's tried before all the others.
+_date_handler_by_signature = _LRUCache(100)
+_date_signature_digits_re = re.compile(r'\d')
+_date_signature_letters_re = re.compile(r'[^\W\d_]+', re.UNICODE)
+def _date_signature(dateString):
+    '''Reduce a date string to its shape so that all dates in the same format share a signature'''
+    return _date_signature_letters_re.sub('a', _date_signature_digits_re.sub('9', dateString))
     
 # ISO-8601 date parsing routines written by Fazal Majid.
 # The ISO 8601 standard is very convoluted and irregular - a full ISO 8601
@@ -3176,21 +3313,40 @@ def _parse_date_perforce(aDateString):
 		return time.gmtime(rfc822.mktime_tz(tm))
 registerDateHandler(_parse_date_perforce)
 
+def _parse_date_with(handler, dateString):
+    '''Return the 9-tuple the handler makes of the date string or None if it can't parse it'''
+    try:
+        date9tuple = handler(dateString)
+        if not date9tuple: return None
+        if len(date9tuple) != 9:
+            if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
+            raise ValueError
+        map(int, date9tuple)
+        return date9tuple
+    except Exception, e:
+        if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
+    return None
+
+_date_not_cached = object()
 def _parse_date(dateString):
     '''Parses a variety of date formats into a 9-tuple in GMT'''
-    for handler in _date_handlers:
-        try:
-            date9tuple = handler(dateString)
-            if not date9tuple: continue
-            if len(date9tuple) != 9:
-                if _debug: sys.stderr.write('date handler function must return 9-tuple\n')
-                raise ValueError
-            map(int, date9tuple)
-            return date9tuple
-        except Exception, e:
-            if _debug: sys.stderr.write('%s raised %s\n' % (handler.__name__, repr(e)))
-            pass
-    return None
+    date9tuple = _date_cache.get(dateString, _date_not_cached)
+    if date9tuple is not _date_not_cached:
+        return date9tuple
+    signature = _date_signature(dateString)
+    preferred = _date_handler_by_signature.get(signature)
+    date9tuple = None
+    if preferred is not None:
+        date9tuple = _parse_date_with(preferred, dateString)
+    if date9tuple is None:
+        for handler in _date_handlers:
+            if handler is preferred: continue
+            date9tuple = _parse_date_with(handler, dateString)
+            if date9tuple is not None:
+                _date_handler_by_signature[signature] = handler
+                break
+    _date_cache[dateString] = date9tuple
+    return date9tuple
 
 def _getCharacterEncoding(http_headers, xml_data):
     '''Get the character encoding of the XML document
@@ -3417,8 +3573,25 @@ def _stripDoctype(data):
 
     return version, data, dict(replacement and safe_pattern.findall(replacement))
     
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[]):
-    '''Parse a feed from a URL, file, stream, or string'''
+def _add_timing(timings, phase, started):
+    timings[phase] = timings.get(phase, 0) + (time.time() - started)
+
+def _time_markup(timings, phase, started):
+    '''Add the time since started to phase, less the time the parser spent on embedded markup meanwhile'''
+    sanitize_before = timings.get('sanitize', 0)
+    _add_timing(timings, phase, started)
+    timings[phase] -= timings.get('sanitize', 0) - sanitize_before
+
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], microformats=None,
+          timings=None):
+    '''Parse a feed from a URL, file, stream, or string
+
+    microformats overrides PARSE_MICROFORMATS for this feed when it isn't None.
+
+    If timings is a dictionary the seconds spent on each phase of parsing are added to it under 'fetch', 'decompress',
+    'encoding', 'sax' (or 'loose' when the strict parser can't be used) and 'sanitize'. The time spent on embedded
+    markup is only counted under 'sanitize'.'''
+    started = timings is not None and time.time()
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
     result['entries'] = []
@@ -3434,6 +3607,9 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         result['bozo_exception'] = e
         data = None
         f = None
+    if started:
+        _add_timing(timings, 'fetch', started)
+        started = time.time()
 
     # if feed is gzip-compressed, decompress it
     if f and data and hasattr(f, 'headers'):
@@ -3455,6 +3631,8 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
                 result['bozo'] = 1
                 result['bozo_exception'] = e
                 data = ''
+        if started:
+            _add_timing(timings, 'decompress', started)
 
     # save HTTP headers
     if hasattr(f, 'info'):
@@ -3509,6 +3687,7 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
         return result
 
     # determine character encoding
+    started = timings is not None and time.time()
     use_strict_parser = 0
     known_encoding = 0
     tried_encodings = []
@@ -3574,12 +3753,17 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             'documented declared as %s, but parsed as %s' % \
             (result['encoding'], proposed_encoding))
         result['encoding'] = proposed_encoding
+    if started:
+        _add_timing(timings, 'encoding', started)
 
     if not _XML_AVAILABLE:
         use_strict_parser = 0
     if use_strict_parser:
         # initialize the SAX parser
         feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+        feedparser.parse_microformats = microformats
+        feedparser.timings = timings
+        started = timings is not None and time.time()
         saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
         saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
         saxparser.setContentHandler(feedparser)
@@ -3601,15 +3785,120 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             result['bozo'] = 1
             result['bozo_exception'] = feedparser.exc or e
             use_strict_parser = 0
+        if started:
+            _time_markup(timings, 'sax', started)
     if not use_strict_parser:
         feedparser = _LooseFeedParser(baseuri, baselang, known_encoding and 'utf-8' or '', entities)
+        feedparser.parse_microformats = microformats
+        feedparser.timings = timings
+        started = timings is not None and time.time()
         feedparser.feed(data)
+        if started:
+            _time_markup(timings, 'loose', started)
     result['feed'] = feedparser.feeddata
     result['entries'] = feedparser.entries
     result['version'] = result['version'] or feedparser.version
     result['namespaces'] = feedparser.namespacesInUse
     return result
 
+# Encodings expat can read directly, which means a document in one of them can be parsed as it's read
+_INCREMENTAL_ENCODINGS = ['utf-8', 'utf8', 'us-ascii', 'ascii']
+_UTF8_BOM = '\xef\xbb\xbf'
+
+class _EntryIterator:
+    '''Yields the entries of a feed one at a time. See iterparse.'''
+    def __init__(self, url_file_stream_or_string, chunk_size, microformats, timings):
+        self.source = url_file_stream_or_string
+        self.chunk_size = chunk_size
+        self.microformats = microformats
+        self.timings = timings
+        self.feed = FeedParserDict()
+        self.bozo = 0
+        self.bozo_exception = None
+        self.version = ''
+        self.namespaces = {}
+
+    def __iter__(self):
+        if hasattr(self.source, 'read'):
+            stream = self.source
+        else:
+            stream = _StringIO(str(self.source))
+        first_chunk = stream.read(self.chunk_size)
+        if first_chunk.startswith(_UTF8_BOM):
+            first_chunk = first_chunk[len(_UTF8_BOM):]
+        timings = self.timings
+        started = timings is not None and time.time()
+        encoding = _getCharacterEncoding({}, first_chunk)[0]
+        if started:
+            _add_timing(timings, 'encoding', started)
+        if not _XML_AVAILABLE or encoding.lower() not in _INCREMENTAL_ENCODINGS:
+            for entry in self._parse_in_full(first_chunk + stream.read(), 0):
+                yield entry
+            return
+
+        self.version, first_chunk, entities = _stripDoctype(first_chunk)
+        parser = _IncrementalFeedParser(None, None, 'utf-8')
+        parser.parse_microformats = self.microformats
+        parser.timings = timings
+        self.feed = parser.feeddata
+        saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
+        saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
+        saxparser.setContentHandler(parser)
+        saxparser.setErrorHandler(parser)
+        if hasattr(saxparser, '_ns_stack'):
+            # work around bug in built-in SAX parser (doesn't recognize xml: namespace)
+            saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
+        yielded = 0
+        chunk = first_chunk
+        try:
+            while chunk:
+                # Only the parsing is timed, not what's done with each entry as it's yielded
+                started = timings is not None and time.time()
+                saxparser.feed(chunk)
+                if started:
+                    _time_markup(timings, 'sax', started)
+                while parser.finished_entries:
+                    yield parser.finished_entries.pop(0)
+                    yielded += 1
+                chunk = stream.read(self.chunk_size)
+            saxparser.close()
+            while parser.finished_entries:
+                yield parser.finished_entries.pop(0)
+                yielded += 1
+        except xml.sax.SAXException, e:
+            self.bozo = 1
+            self.bozo_exception = parser.exc or e
+            if hasattr(self.source, 'read'):
+                # The start of the stream has gone so the entries that were parsed before the error will have to do
+                self.version = self.version or parser.version
+                self.namespaces = parser.namespacesInUse
+                return
+            # The loose parser copes with documents the strict parser can't but it can only parse the whole thing
+            for entry in self._parse_in_full(self.source, yielded):
+                yield entry
+            return
+        self.version = self.version or parser.version
+        self.namespaces = parser.namespacesInUse
+
+    def _parse_in_full(self, data, skip):
+        result = parse(data, microformats=self.microformats, timings=self.timings)
+        self.feed = result.feed
+        self.bozo = result.bozo
+        self.bozo_exception = result.get('bozo_exception')
+        self.version = result.version
+        self.namespaces = result.get('namespaces', {})
+        return result.entries[skip:]
+
+def iterparse(url_file_stream_or_string, chunk_size=65536, microformats=None, timings=None):
+    '''Parse a feed from a stream or string, yielding each entry as soon as its end tag has been parsed
+
+    Entries are forgotten once they've been yielded so memory use doesn't grow with the number of entries. The returned
+    iterator's feed attribute holds the feed-level data parsed so far, and its bozo, bozo_exception, version and
+    namespaces attributes are complete once iteration has finished. Documents that aren't UTF-8 or that the strict
+    parser rejects are parsed in full by parse() instead and their entries yielded afterwards. timings is as for
+    parse().'''
+    return _EntryIterator(url_file_stream_or_string, chunk_size, microformats, timings)
+
 class Serializer:
     def __init__(self, results):
         self.results = results
@@ -0,0 +1,200 @@
+"""Counters for the things Streamer wants to keep an eye on.
+
+They live in memcache so updating them is cheap enough to do on every request. The price is that they're approximate
+and are reset whenever memcache evicts them.
+
+Timings of the hot paths are kept as histograms, both overall and for each feed. Only a sample of operations, chosen by
+settings.METRICS_SAMPLE_RATE, are timed so that the cost of timing the rest is a single random number.
+"""
+
+from google.appengine.api import memcache
+
+import hashlib
+import random
+import settings
+import time
+
+NAMESPACE = 'metrics'
+
+# The phases that are timed. A phase's time includes the time of the phases nested in it. For example contentParser
+# includes fetch and parse, which includes the parse.* phases.
+TIMED_PHASES = ['contentParser', 'fetch', 'sniff', 'parse', 'parse.fetch', 'parse.decompress', 'parse.encoding',
+                'parse.sax', 'parse.loose', 'parse.sanitize', 'extractPosts', 'put', 'putBatch', 'render']
+# Upper bounds in milliseconds of the histogram buckets. Anything slower is counted in a final, open-ended bucket.
+TIMING_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def increment(name, delta=1):
+  if memcache.incr(name, delta, namespace=NAMESPACE) is None:
+    # The counter doesn't exist yet. If another request creates it first then add fails and we try incrementing again.
+    if not memcache.add(name, delta, namespace=NAMESPACE):
+      memcache.incr(name, delta, namespace=NAMESPACE)
+
+def get(name):
+  return memcache.get(name, namespace=NAMESPACE) or 0
+
+def getAll(names):
+  """Return a dictionary mapping each of the names to the current value of its counter"""
+  values = memcache.get_multi(names, namespace=NAMESPACE)
+  return dict([(name, values.get(name, 0)) for name in names])
+
+def hitRates(caches, counters):
+  """Return the fraction of the lookups in each of the caches that were hits, or None for caches that haven't been used.
+
+  counters must hold the <cache>.hits and <cache>.misses counters of every cache, as returned by getAll."""
+  rates = {}
+  for name in caches:
+    hits = counters[name + '.hits']
+    lookups = hits + counters[name + '.misses']
+    if lookups:
+      rates[name] = round(float(hits) / lookups, 3)
+    else:
+      rates[name] = None
+  return rates
+
+def _timingKey(phase, stat, feedUrl=None):
+  key = 'timing.%s.%s' % (phase, stat)
+  if feedUrl:
+    # Feed urls can be longer than memcache allows keys to be
+    key += ':' + hashlib.md5(feedUrl).hexdigest()
+  return key
+
+def _bucketStats():
+  return ['le%d' % upperMs for upperMs in TIMING_BUCKETS_MS] + ['over']
+
+def _bucketStat(ms):
+  for upperMs in TIMING_BUCKETS_MS:
+    if ms <= upperMs:
+      return 'le%d' % upperMs
+  return 'over'
+
+def recordTiming(phase, seconds, feedUrl=None):
+  """Count a single timing of the phase in the overall histogram and, if feedUrl is given, in the feed's histogram"""
+  ms = int(seconds * 1000)
+  urls = [None]
+  if feedUrl:
+    urls.append(feedUrl)
+  for url in urls:
+    increment(_timingKey(phase, 'count', url))
+    increment(_timingKey(phase, 'totalMs', url), ms)
+    increment(_timingKey(phase, _bucketStat(ms), url))
+
+def recordSample(phase, seconds):
+  """Count a single timing of the phase overall if it's chosen as part of the sample.
+
+  Use this rather than timed for phases that happen many times in an operation and should be counted one by one."""
+  if random.random() < settings.METRICS_SAMPLE_RATE:
+    recordTiming(phase, seconds)
+
+class Histogram(object):
+  """The timings recorded for a phase"""
+
+  def __init__(self, phase, count, totalMs, buckets):
+    self.phase = phase
+    self.count = count
+    self.totalMs = totalMs
+    # A (label, count) pair for each bucket
+    self.buckets = buckets
+
+  def meanMs(self):
+    if not self.count:
+      return 0
+    return self.totalMs // self.count
+
+  def toDict(self):
+    return {'phase': self.phase, 'count': self.count, 'totalMs': self.totalMs, 'meanMs': self.meanMs(),
+            'buckets': dict(self.buckets)}
+
+def getHistograms(feedUrl=None):
+  """Return a Histogram for each of the TIMED_PHASES, overall or for the feed at feedUrl, in a single fetch"""
+  stats = ['count', 'totalMs'] + _bucketStats()
+  values = getAll([_timingKey(phase, stat, feedUrl) for phase in TIMED_PHASES for stat in stats])
+  histograms = []
+  for phase in TIMED_PHASES:
+    buckets = [('<=%dms' % upperMs, values[_timingKey(phase, 'le%d' % upperMs, feedUrl)]) for upperMs in TIMING_BUCKETS_MS]
+    buckets.append(('>%dms' % TIMING_BUCKETS_MS[-1], values[_timingKey(phase, 'over', feedUrl)]))
+    histograms.append(Histogram(phase, values[_timingKey(phase, 'count', feedUrl)],
+                                values[_timingKey(phase, 'totalMs', feedUrl)], buckets))
+  return histograms
+
+class Profile(object):
+  """The time spent on each phase of a single operation, such as ingesting a ping.
+
+  Whether the operation is timed at all is decided once, when the profile is created. The timings are only recorded
+  when save is called, so that they can be counted against the feed the operation turned out to be for."""
+
+  def __init__(self, sampleRate=None):
+    if sampleRate is None:
+      sampleRate = settings.METRICS_SAMPLE_RATE
+    self.sampled = random.random() < sampleRate
+    self.feedUrl = None
+    self.timings = {}
+
+  def add(self, phase, seconds):
+    if self.sampled:
+      self.timings[phase] = self.timings.get(phase, 0) + seconds
+
+  def addPhases(self, prefix, timings):
+    """Add timings, a dictionary like the one returned by phaseTimings, with each phase's name prefixed"""
+    for phase, seconds in (timings or {}).items():
+      self.add(prefix + phase, seconds)
+
+  def call(self, phase, function, *args, **kwargs):
+    if not self.sampled:
+      return function(*args, **kwargs)
+    started = time.time()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      self.add(phase, time.time() - started)
+
+  def save(self):
+    for phase, seconds in self.timings.items():
+      recordTiming(phase, seconds, self.feedUrl)
+    self.timings = {}
+
+# The profile of the operation in progress. Each instance only handles one request at a time.
+_currentProfile = [None]
+
+def profiled(function):
+  """Decorator that times the phases of each call to function as a single profile"""
+  def wrapper(*args, **kwargs):
+    _currentProfile[0] = Profile()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      profile = _currentProfile[0]
+      _currentProfile[0] = None
+      profile.save()
+  wrapper.__name__ = function.__name__
+  wrapper.__doc__ = function.__doc__
+  return wrapper
+
+def setProfileFeed(feedUrl):
+  """Count the timings of the operation in progress against the feed at feedUrl as well as overall"""
+  if _currentProfile[0] is not None:
+    _currentProfile[0].feedUrl = feedUrl
+
+def timed(phase, function, *args, **kwargs):
+  """Call function with the arguments, timing it as a phase of the operation in progress.
+
+  Outside a profiled operation the call is sampled and recorded on its own."""
+  profile = _currentProfile[0]
+  if profile is not None:
+    return profile.call(phase, function, *args, **kwargs)
+  profile = Profile()
+  try:
+    return profile.call(phase, function, *args, **kwargs)
+  finally:
+    profile.save()
+
+def phaseTimings():
+  """Return a dictionary for a library to add the time it spends on each of its phases to, or None if the operation
+  in progress isn't being timed. Pass the dictionary to addPhases afterwards."""
+  profile = _currentProfile[0]
+  if profile is not None and profile.sampled:
+    return {}
+  return None
+
+def addPhases(prefix, timings):
+  if _currentProfile[0] is not None:
+    _currentProfile[0].addPhases(prefix, timings)
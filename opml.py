@@ -0,0 +1,56 @@
+"""Reading and writing the OPML subscription lists that feed readers import and export."""
+
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+import StringIO
+import xml.sax
+
+class OpmlError(Exception):
+  pass
+
+class _OutlineHandler(xml.sax.handler.ContentHandler):
+  def __init__(self):
+    xml.sax.handler.ContentHandler.__init__(self)
+    self.urls = []
+    self.seen = {}
+
+  def startElement(self, name, attributes):
+    if name.lower() != 'outline':
+      return
+    # Readers disagree about the case of the attribute name
+    for attributeName in attributes.getNames():
+      if attributeName.lower() == 'xmlurl':
+        url = attributes.getValue(attributeName).strip()
+        if url and url not in self.seen:
+          self.seen[url] = True
+          self.urls.append(url)
+
+def parseFeedUrls(content):
+  """Return the feed url of every outline in the OPML document, however deeply nested, in order and without repeats"""
+  handler = _OutlineHandler()
+  parser = xml.sax.make_parser()
+  # Uploaded files mustn't be able to make us fetch or read anything else
+  parser.setFeature(xml.sax.handler.feature_external_ges, 0)
+  parser.setContentHandler(handler)
+  try:
+    parser.parse(StringIO.StringIO(content))
+  except xml.sax.SAXException, e:
+    raise OpmlError("Not a valid OPML document: %s" % e)
+  return handler.urls
+
+def writeHeader(out, title):
+  out.write('<?xml version="1.0" encoding="utf-8"?>\n<opml version="1.0">\n')
+  out.write('<head><title>%s</title></head>\n<body>\n' % escape(title))
+
+def writeOutline(out, url, title=None, htmlUrl=None):
+  outline = '<outline type="rss" text=%s xmlUrl=%s' % (quoteattr(title or url), quoteattr(url))
+  if htmlUrl:
+    outline += ' htmlUrl=%s' % quoteattr(htmlUrl)
+  outline += '/>\n'
+  if isinstance(outline, unicode):
+    outline = outline.encode('utf-8')
+  out.write(outline)
+
+def writeFooter(out):
+  out.write('</body>\n</opml>\n')
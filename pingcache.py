@@ -0,0 +1,69 @@
+"""The digests of the pings that have been ingested recently.
+
+Feeds subscribed to through several hubs, and hubs that retry pings they think timed out, send the same body more than
+once. A ping whose digest is here has already been ingested so it can be acknowledged without being parsed again.
+
+Digests live in memcache so that every instance sees them. The most recently used are also kept in this process so
+that a repeat sent to the same instance doesn't even need memcache. Only pings that were ingested, or staged to be,
+are remembered so that a hub retrying a ping that failed still gets it ingested.
+"""
+
+from google.appengine.api import memcache
+
+import collections
+import hashlib
+import metrics
+import settings
+import time
+
+NAMESPACE = 'pingDigests'
+
+# Maps each digest kept in this process to when it was first remembered and when it was last used
+_recent = {}
+# The (digest, use) of every use, oldest first. A digest used again has a later use further along.
+_uses = collections.deque()
+_useCount = [0]
+
+def digest(content):
+  return hashlib.sha1(content).hexdigest()
+
+def _keep(pingDigest, rememberedAt):
+  """Keep the digest in this process as the most recently used, dropping the least recently used if there's no room"""
+  _useCount[0] += 1
+  _recent[pingDigest] = (rememberedAt, _useCount[0])
+  _uses.append((pingDigest, _useCount[0]))
+  while len(_recent) > settings.PING_DIGEST_CACHE_SIZE:
+    oldDigest, use = _uses.popleft()
+    if _recent.get(oldDigest, (None, None))[1] == use:
+      del _recent[oldDigest]
+  if len(_uses) > 2 * settings.PING_DIGEST_CACHE_SIZE:
+    # Digests that keep being used leave a trail of earlier uses behind them
+    latestUses = sorted([(use, d) for d, (rememberedAt, use) in _recent.items()])
+    _uses.clear()
+    _uses.extend([(d, use) for use, d in latestUses])
+
+def seen(pingDigest):
+  """Return True if a ping with the digest was ingested in the last PING_DIGEST_SECONDS"""
+  if not settings.PING_DIGEST_SECONDS:
+    return False
+  rememberedAt = _recent.get(pingDigest, (None, None))[0]
+  if rememberedAt is None or time.time() - rememberedAt >= settings.PING_DIGEST_SECONDS:
+    rememberedAt = memcache.get(pingDigest, namespace=NAMESPACE)
+  if rememberedAt is None:
+    metrics.increment('pingDigests.misses')
+    return False
+  _keep(pingDigest, rememberedAt)
+  metrics.increment('pingDigests.hits')
+  return True
+
+def remember(pingDigest):
+  if not settings.PING_DIGEST_SECONDS:
+    return
+  now = time.time()
+  memcache.set(pingDigest, now, time=settings.PING_DIGEST_SECONDS, namespace=NAMESPACE)
+  _keep(pingDigest, now)
+
+def clear():
+  """Forget the digests kept in this process"""
+  _recent.clear()
+  _uses.clear()
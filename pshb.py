@@ -3,18 +3,189 @@
 This module depends on the existence of:
 settings.py containing various config parameters as constants
 feedparser.py to parse feeds
+entrycodec.py to store feed entries
+metrics.py to count what happens to incoming posts
 """
 
 from google.appengine.ext import db
 from google.appengine.api import urlfetch
+from xml.sax.saxutils import unescape
 
 import datetime
+import entrycodec
 import feedparser
+import hashlib
+import hmac
 import logging
+import metrics
 import pprint
+import re
 import settings
+import time
 import urllib
 
+def deleteInBatches(query, cursor=None, batchSize=None, timeBudget=None, relatedKeys=None, onDelete=None):
+  """Delete the entities returned by a query. Keys-only queries are the cheapest unless onDelete needs the entities.
+
+  Keys are fetched and deleted a batch at a time until the query is exhausted or the time budget has run out.
+  If relatedKeys is given it's called with each batch of keys and the keys it returns are deleted along with them.
+  If onDelete is given it's called with each batch of results just before they're deleted.
+  Returns the number of entities deleted and a cursor to resume from, which is None once everything has been deleted."""
+  if batchSize is None:
+    batchSize = settings.DELETE_BATCH_SIZE
+  if timeBudget is None:
+    timeBudget = settings.DELETE_TIME_BUDGET_SECONDS
+  start = time.time()
+  deleted = 0
+  while True:
+    if cursor:
+      query.with_cursor(cursor)
+    results = query.fetch(batchSize)
+    if onDelete:
+      onDelete(results)
+    keys = [isinstance(result, db.Model) and result.key() or result for result in results]
+    if relatedKeys:
+      db.delete(keys + relatedKeys(keys))
+    else:
+      db.delete(keys)
+    deleted += len(keys)
+    if len(keys) < batchSize:
+      return deleted, None
+    cursor = query.cursor()
+    if time.time() - start >= timeBudget:
+      return deleted, cursor
+
+# Rough size of the key and property names of an entity, on top of the size of its values
+ENTITY_OVERHEAD_BYTES = 200
+
+def estimateSize(entity):
+  """Return roughly how many bytes the entity adds to a put. String and blob values are counted exactly."""
+  size = ENTITY_OVERHEAD_BYTES
+  for prop in entity.properties().values():
+    value = prop.get_value_for_datastore(entity)
+    if isinstance(value, unicode):
+      size += len(value.encode('utf-8'))
+    elif isinstance(value, str):
+      size += len(value)
+    else:
+      size += 16
+  return size
+
+# How many entities putInBatches puts in each batch. It's tuned as batches are put and lasts from one request to the next.
+_putBatchSize = [None]
+
+def _tunePutBatchSize(entities, seconds, maxEntities, targetSeconds):
+  """Move the batch size halfway towards the number of entities that could have been put in targetSeconds"""
+  ideal = targetSeconds / max(seconds, 0.001) * entities
+  _putBatchSize[0] = max(1, min(maxEntities, int((_putBatchSize[0] + ideal) / 2)))
+
+def putInBatches(entities, maxEntities=None, maxBytes=None, targetSeconds=None, maxAttempts=None):
+  """Put the entities a batch at a time so that no put exceeds the datastore's limits on entities or bytes per call.
+
+  Batches have at most maxEntities entities and roughly maxBytes bytes. Within those limits the batch size is tuned so
+  that each put takes about targetSeconds. A batch that times out is halved and tried again after a backoff, giving up
+  after maxAttempts timeouts in a row. Returns an (entities, bytes, seconds) tuple for each batch that was put."""
+  if maxEntities is None:
+    maxEntities = settings.PUT_MAX_ENTITIES
+  if maxBytes is None:
+    maxBytes = settings.PUT_MAX_BYTES
+  if targetSeconds is None:
+    targetSeconds = settings.PUT_TARGET_SECONDS
+  if maxAttempts is None:
+    maxAttempts = settings.PUT_MAX_ATTEMPTS
+  if _putBatchSize[0] is None:
+    _putBatchSize[0] = settings.PUT_INITIAL_BATCH_SIZE
+  sizes = [estimateSize(entity) for entity in entities]
+  batches = []
+  start = 0
+  timeouts = 0
+  while start < len(entities):
+    end = start
+    batchBytes = 0
+    while end < len(entities) and end - start < min(_putBatchSize[0], maxEntities):
+      # A single entity bigger than maxBytes still gets a batch of its own
+      if end > start and batchBytes + sizes[end] > maxBytes:
+        break
+      batchBytes += sizes[end]
+      end += 1
+    started = time.time()
+    try:
+      db.put(entities[start:end])
+    except db.Timeout:
+      timeouts += 1
+      metrics.increment('put.timeouts')
+      if timeouts >= maxAttempts:
+        raise
+      logging.warn("Put of %d entities timed out. Retrying a smaller batch." % (end - start))
+      _putBatchSize[0] = max(1, (end - start) // 2)
+      time.sleep(settings.PUT_BACKOFF_SECONDS * 2 ** (timeouts - 1))
+      continue
+    seconds = time.time() - started
+    timeouts = 0
+    batches.append((end - start, batchBytes, seconds))
+    metrics.recordSample('putBatch', seconds)
+    _tunePutBatchSize(end - start, seconds, maxEntities, targetSeconds)
+    start = end
+  metrics.increment('put.batches', len(batches))
+  logging.debug("Put %d entities in batches of (entities, bytes, seconds): %s" % (len(entities), batches))
+  return batches
+
+def _utf8(value):
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return value or ''
+
+class PostDigest(db.Model):
+  """A hash of the content of a stored Post. It shares the Post's key name so the two can be matched up cheaply."""
+  digest = db.StringProperty(required=True, indexed=False)
+  # A hash of the markup of the entry the Post was last stored from. See skipUnchangedEntries.
+  rawDigest = db.StringProperty(indexed=False)
+  # The day and author the post is counted under in the aggregates. They're the ones it had when it was first counted
+  # so that deleting it uncounts it from the same aggregates even if an edit has moved it since.
+  counted = db.BooleanProperty(default=False, indexed=False)
+  countedDay = db.DateProperty(indexed=False)
+  countedAuthor = db.StringProperty(indexed=False)
+
+def putPosts(posts, prepare=None):
+  """Store the posts that are new or whose content has changed since they were last stored. Return the stored posts
+  and the ones among them that are new.
+
+  Feeds tend to resend their most recent entries with every ping so most posts can be skipped.
+
+  If prepare is given it's called with the posts that are about to be stored."""
+  keyNames = [post.key().name() for post in posts]
+  storedDigests = PostDigest.get_by_key_name(keyNames)
+  changedPosts = []
+  newPosts = []
+  newDigests = []
+  for post, keyName, storedDigest in zip(posts, keyNames, storedDigests):
+    digest = post.computeDigest()
+    if storedDigest and storedDigest.digest == digest:
+      if post.rawDigest and storedDigest.rawDigest != post.rawDigest:
+        # The entry's markup changed without changing the post. Remembering it lets the next copy skip parsing.
+        storedDigest.rawDigest = post.rawDigest
+        newDigests.append(storedDigest)
+      continue
+    changedPosts.append(post)
+    if storedDigest:
+      # The stored digest is updated rather than replaced so that the post stays counted where it was
+      storedDigest.digest = digest
+      storedDigest.rawDigest = post.rawDigest
+    else:
+      newPosts.append(post)
+      storedDigest = PostDigest(key_name=keyName, digest=digest, rawDigest=post.rawDigest)
+    newDigests.append(storedDigest)
+  if prepare:
+    prepare(changedPosts)
+  # Bodies go first so that a post is never stored without one. Digests go last so that a post whose put failed
+  # is stored again next time.
+  bodies = [post.getBody() for post in changedPosts]
+  metrics.timed('put', putInBatches, bodies + changedPosts + newDigests)
+  logging.info("Stored %d new or changed posts and skipped %d unchanged posts" % (len(changedPosts), len(posts) - len(changedPosts)))
+  metrics.increment('posts.written', len(changedPosts))
+  metrics.increment('posts.skipped', len(posts) - len(changedPosts))
+  return changedPosts, newPosts
+
 class PostFactory(object):
   """A factory for Posts.
 
@@ -38,34 +209,220 @@ class PostFactory(object):
     uniqueId = PostFactory.__extractUniqueId(entry)
 
     logging.debug("Unique id is: %s for entry: %s" % (uniqueId, pprint.pformat(entry)))
-    entryString = repr(entry)
-
-    return Post(key_name=uniqueId, url=url, feedUrl=feedUrl, title=title, content=content, datePublished=datePublished,
-                author=author, entryString=entryString)
+    entryBlob = db.Blob(entrycodec.encode(entry))
+
+    post = Post(key_name=uniqueId, url=url, feedUrl=feedUrl, title=title, datePublished=datePublished, author=author,
+                excerpt=makeExcerpt(content))
+    body = PostBody(key_name=uniqueId, content=content, entryBlob=entryBlob)
+    body.dropDerivableContent(entry)
+    post.setBody(body)
+    return post
+
+# How many characters of a post's content lists of posts show
+EXCERPT_LENGTH = 300
+_TAG = re.compile(r'<[^>]*>')
+_PARTIAL_ENTITY = re.compile(r'&[^;\s]*$')
+
+def makeExcerpt(content, length=EXCERPT_LENGTH):
+  """Return the start of the content as plain text, cut at a word boundary if it's too long to show in full"""
+  text = ' '.join(_TAG.sub(' ', content or '').split())
+  if len(text) <= length:
+    return text
+  return _PARTIAL_ENTITY.sub('', text[:length].rsplit(' ', 1)[0]) + '...'
+
+def entryContent(entry):
+  """Return the content of a FeedParser entry that a Post shows"""
+  if hasattr(entry, 'content'):
+    content = entry.content[0].value
+    #Workaround for Flickr's RSS feeds. I should probably ignore it but they use RSS 2.0 as their default format.
+    #TODO(ade) Check to see if this is actually a bug in Feedparser.py since arguably rss2.0:description elements should be mapped to atom:content elements.
+    if not content:
+      content = entry.get('summary', '')
+    return content
+  logging.debug("Entry has no atom:content")
+  return entry.get('description', '')
+
+class PostBody(db.Model):
+  """The parts of a Post that lists of posts don't need. It shares the Post's key name and is fetched on demand."""
+  # Only stored when it isn't what entryContent finds in the entry, since the entry holds a copy of the content already
+  content = db.TextProperty()
+  entryBlob = db.BlobProperty()
+  # The post as an atom:entry, ready to be put into Streamer's own feed
+  atomEntry = db.TextProperty()
+
+  def getContent(self):
+    if self.content is not None or not self.entryBlob:
+      return self.content
+    content = getattr(self, '_entryContent', None)
+    if content is None:
+      content = self._entryContent = entryContent(entrycodec.decode(self.entryBlob))
+    return content
+
+  def dropDerivableContent(self, entry):
+    """Stop storing the content separately if it's what the given entry, the one in entryBlob, holds anyway"""
+    if self.content is not None and self.content == entryContent(entry):
+      self.content = None
 
 class Post(db.Model):
-  """An atom:entry or RSS item."""
+  """An atom:entry or RSS item.
+
+  Only what lists of posts show is stored in the Post itself. Everything else is in its PostBody. Posts stored before
+  the two were split keep their body in the legacy properties below until migrateBodies moves it."""
   url = db.StringProperty(required=True)
   feedUrl = db.StringProperty(required=True)
   title = db.StringProperty(multiline=True)
-  content = db.TextProperty()
   datePublished = db.DateTimeProperty()
   author = db.StringProperty()
+  excerpt = db.TextProperty()
+  # Legacy properties. Use getBody() instead.
+  content = db.TextProperty()
+  # Posts stored before entrycodec existed hold a repr() of their entry. Newer posts hold an encoded entry instead.
   entryString = db.TextProperty()
+  entryBlob = db.BlobProperty()
+  atomEntry = db.TextProperty()
+  # The hash of the markup of the entry the post was parsed from, if it was sniffed. It's stored in the PostDigest.
+  rawDigest = None
+
+  def hasLegacyBody(self):
+    return self.content is not None or bool(self.entryBlob) or bool(self.entryString) or self.atomEntry is not None
+
+  def getBody(self):
+    """Return the post's PostBody, fetching it the first time it's needed"""
+    body = getattr(self, '_postBody', None)
+    if body is None:
+      if self.hasLegacyBody():
+        body = PostBody(key_name=self.key().name(), content=self.content, entryBlob=self.entryBlob,
+                        atomEntry=self.atomEntry)
+      else:
+        body = PostBody.get_by_key_name(self.key().name()) or PostBody(key_name=self.key().name())
+      self._postBody = body
+    return body
+
+  def setBody(self, body):
+    self._postBody = body
+
+  def getContent(self):
+    return self.getBody().getContent()
+
+  @staticmethod
+  def fetchBodies(posts):
+    """Fetch the bodies of the posts that are going to need them in a single call"""
+    posts = [post for post in posts if getattr(post, '_postBody', None) is None and not post.hasLegacyBody()]
+    bodies = PostBody.get_by_key_name([post.key().name() for post in posts])
+    for post, body in zip(posts, bodies):
+      post.setBody(body or PostBody(key_name=post.key().name()))
 
   def getFeedParserEntry(self):
+    entryBlob = self.getBody().entryBlob
+    if entryBlob:
+      return entrycodec.decode(entryBlob)
     entry = eval(self.entryString)
     return entry
 
-  @property
-  def day(self):
-    return self.datePublished.strftime('%A %B %d, %Y')
+  def getEntryField(self, name, default=None):
+    """Return a single top-level field of the entry without decoding the rest of it"""
+    entryBlob = self.getBody().entryBlob
+    if entryBlob:
+      return entrycodec.LazyEntry(entryBlob).get(name, default)
+    return self.getFeedParserEntry().get(name, default)
+
+  def migrateEntryString(self):
+    """Re-encode a repr() entry using entrycodec. Return True if the post needs to be stored again."""
+    if self.entryBlob or not self.entryString:
+      return False
+    self.entryBlob = db.Blob(entrycodec.encode(feedparser.FeedParserDict(self.getFeedParserEntry())))
+    self.entryString = None
+    return True
 
   @staticmethod
-  def deleteAllPostsWithMatchingFeedUrl(url):
-    postsQuery = db.GqlQuery("SELECT __key__ from Post where feedUrl= :1", url)
-    for postKey in postsQuery.fetch(settings.MAX_FETCH):
-      db.delete(postKey)
+  def migrateEntryStrings(cursor=None, batchSize=100):
+    """Migrate the next batch of posts. Return a cursor for the following batch or None if there are no more posts."""
+    query = Post.all()
+    if cursor:
+      query.with_cursor(cursor)
+    posts = query.fetch(batchSize)
+    migrated = [post for post in posts if post.migrateEntryString()]
+    db.put(migrated)
+    logging.info("Migrated %d of %d posts to entrycodec" % (len(migrated), len(posts)))
+    if len(posts) < batchSize:
+      return None
+    return query.cursor()
+
+  def migrateBody(self):
+    """Move the body of a post stored before bodies were split out into a PostBody and return it.
+
+    Returns None if there's nothing to move."""
+    if not self.hasLegacyBody():
+      return None
+    self.migrateEntryString()
+    # Build the body from the legacy properties again now that the entry has been re-encoded
+    self.setBody(None)
+    body = self.getBody()
+    self.excerpt = makeExcerpt(body.getContent())
+    if body.entryBlob:
+      body.dropDerivableContent(entrycodec.decode(body.entryBlob))
+    self.content = self.entryBlob = self.atomEntry = None
+    return body
+
+  @staticmethod
+  def migrateBodies(cursor=None, batchSize=100):
+    """Migrate the next batch of posts. Return a cursor for the following batch or None if there are no more posts."""
+    query = Post.all()
+    if cursor:
+      query.with_cursor(cursor)
+    posts = query.fetch(batchSize)
+    migrated = [post for post in posts if post.hasLegacyBody()]
+    # The bodies go first so that a failure between the two puts can't lose them
+    db.put([post.migrateBody() for post in migrated])
+    db.put(migrated)
+    logging.info("Moved the bodies of %d of %d posts into PostBodies" % (len(migrated), len(posts)))
+    if len(posts) < batchSize:
+      return None
+    return query.cursor()
+
+  @staticmethod
+  def fetchPage(cursor=None, pageSize=60, day=None):
+    """Return a page of posts, newest first, and a cursor for the next page or None if there are no more posts.
+
+    Every page costs the same to fetch however deep it is. When day is given only that day's posts are returned."""
+    query = Post.all().order('-datePublished')
+    if day:
+      start = datetime.datetime(day.year, day.month, day.day)
+      query.filter('datePublished >=', start).filter('datePublished <', start + datetime.timedelta(days=1))
+    if cursor:
+      query.with_cursor(cursor)
+    posts = query.fetch(pageSize)
+    if len(posts) < pageSize:
+      return posts, None
+    return posts, query.cursor()
+
+  @staticmethod
+  def findAdjacentDays(day):
+    """Return the nearest earlier and later days that have posts. Either of them is None if there is no such day."""
+    start = datetime.datetime(day.year, day.month, day.day)
+    earlier = Post.all().filter('datePublished <', start).order('-datePublished').get()
+    later = Post.all().filter('datePublished >=', start + datetime.timedelta(days=1)).order('datePublished').get()
+    return earlier and earlier.datePublished.date(), later and later.datePublished.date()
+
+  def computeDigest(self):
+    body = self.getBody()
+    digest = hashlib.sha1()
+    for value in [self.url, self.feedUrl, self.title, body.getContent(), self.author, body.entryBlob]:
+      digest.update(_utf8(value))
+      digest.update('\0')
+    return digest.hexdigest()
+
+  @staticmethod
+  def deleteAllPostsWithMatchingFeedUrl(url, cursor=None, batchSize=None, timeBudget=None, onDelete=None):
+    """Delete posts from the feed until the time budget runs out. Return the number deleted and a cursor to resume from.
+
+    If onDelete is given it's called with each batch of posts before they're deleted."""
+    if onDelete:
+      postsQuery = db.GqlQuery("SELECT * from Post where feedUrl= :1", url)
+    else:
+      postsQuery = db.GqlQuery("SELECT __key__ from Post where feedUrl= :1", url)
+    relatedKeys = lambda keys: [db.Key.from_path(kind, key.name()) for key in keys for kind in ['PostDigest', 'PostBody']]
+    return deleteInBatches(postsQuery, cursor, batchSize, timeBudget, relatedKeys=relatedKeys, onDelete=onDelete)
 
 class UrlError(Exception):
   def __init__(self, url, status_code, response_string):
@@ -76,21 +433,201 @@ class UrlError(Exception):
   def __str__(self):
     return 'url: %s status code: %d response:<%s>' % (self.url, self.status_code, self.response_string)
 
+# A first pass over a feed that finds its entries and their ids without parsing it. An entry whose markup is exactly
+# what it was when it was last stored can be left out of the document before FeedParser spends time on it.
+_NAME_PREFIX = r'(?:[\w.-]+:)?'
+_ENTRY = re.compile(r'<(%s)(entry|item)(?=[\s>])[^>]*>.*?</\1\2\s*>' % _NAME_PREFIX, re.S)
+_ENTRY_START = re.compile(r'<%s(?:entry|item)(?=[\s>])' % _NAME_PREFIX)
+_SOURCE = re.compile(r'<(%s)source(?=[\s>]).*?</\1source\s*>' % _NAME_PREFIX, re.S)
+# In the order FeedParser and PostFactory prefer them
+_ENTRY_IDS = [re.compile(r'<%s%s(?=[\s>])[^>]*(?<!/)>\s*([^<\s][^<]*?)\s*</' % (_NAME_PREFIX, name))
+              for name in ['id', 'guid', 'link']]
+_ROOT = re.compile(r'<(?![?!])[^>]*>')
+_LINK = re.compile(r'<%slink(?=[\s/>])[^>]*>(?:[^<]*</%slink\s*>)?' % (_NAME_PREFIX, _NAME_PREFIX))
+# Longer ids are left to the parser since the datastore limits the length of key names
+MAX_SNIFFED_ID_LENGTH = 400
+
+def _sniffEntryId(entry):
+  entry = _SOURCE.sub('', entry)
+  for pattern in _ENTRY_IDS:
+    match = pattern.search(entry)
+    if match:
+      try:
+        keyName = unescape(match.group(1)).decode('utf-8')
+      except UnicodeDecodeError:
+        return None
+      # Anything else that FeedParser would decode, or a key name the datastore won't take, means the entry is parsed
+      if '&' in keyName or keyName.startswith('__') or len(keyName) > MAX_SNIFFED_ID_LENGTH:
+        return None
+      return keyName
+  return None
+
+def sniffEntries(content, salt=''):
+  """Find the entries of a feed without parsing it.
+
+  Return the start, end, key name and raw digest of each entry that has an id. The raw digest is a hash of the entry's
+  markup together with the salt and the parts of the document before the first entry that affect how entries are
+  parsed, such as xml:base and the feed's own links. Return an empty list if the entries can't be found reliably."""
+  matches = list(_ENTRY.finditer(content))
+  if not matches:
+    return []
+  prelude = content[:matches[0].start()]
+  context = hashlib.sha1(salt)
+  root = _ROOT.search(prelude)
+  if root:
+    context.update(root.group(0))
+  for link in _LINK.findall(prelude):
+    context.update(link)
+  entries = []
+  for match in matches:
+    entry = match.group(0)
+    # Only the outermost entries are found. Another entry start inside one means the markup isn't what it seems.
+    if len(_ENTRY_START.findall(entry)) != 1:
+      return []
+    keyName = _sniffEntryId(entry)
+    if keyName is None:
+      continue
+    digest = context.copy()
+    digest.update(entry)
+    entries.append((match.start(), match.end(), keyName, digest.hexdigest()))
+  return entries
+
+def skipUnchangedEntries(content, salt=''):
+  """Leave out the entries of the feed that haven't changed since they were last stored.
+
+  Return the rest of the document, the raw digest of each entry that's left in by key name and the number of entries
+  left out."""
+  entries = isinstance(content, str) and sniffEntries(content, salt)
+  if not entries:
+    return content, {}, 0
+  storedDigests = PostDigest.get_by_key_name([keyName for start, end, keyName, rawDigest in entries])
+  pieces = []
+  rawDigests = {}
+  position = 0
+  skipped = 0
+  for (start, end, keyName, rawDigest), storedDigest in zip(entries, storedDigests):
+    if storedDigest and storedDigest.rawDigest == rawDigest:
+      pieces.append(content[position:start])
+      position = end
+      skipped += 1
+    else:
+      rawDigests[keyName] = rawDigest
+  pieces.append(content[position:])
+  metrics.increment('entries.sniffed', len(entries))
+  metrics.increment('entries.skippedUnparsed', skipped)
+  return ''.join(pieces), rawDigests, skipped
+
+# The rels of the link that names the feed itself. Whichever of them comes first is used.
+FEED_URL_RELS = ['http://schemas.google.com/g/2005#feed', 'self']
+
+def linksByRel(links):
+  """Return a dictionary mapping each rel to the href of the first of the links with that rel"""
+  hrefs = {}
+  for link in links:
+    hrefs.setdefault(link.get('rel'), link.get('href'))
+  return hrefs
+
+class FeedMetadata(object):
+  """The feed-level data of a parsed document. It's worked out once per document instead of once per post."""
+
+  def __init__(self, feed, entries, defaultHub, alwaysUseDefaultHub):
+    links = feed.get('links') or []
+    self.linksByRel = linksByRel(links)
+    self.feedUrl = None
+    for link in links:
+      if link.get('rel') in FEED_URL_RELS:
+        self.feedUrl = link.get('href')
+        break
+    else:
+      if feed.get('link'):
+        self.feedUrl = feed['link'] + "rss"
+    self.selfLink = self.linksByRel.get('self')
+    hub = self.linksByRel.get('hub')
+    if alwaysUseDefaultHub or hub is None:
+      self.hub = defaultHub
+    else:
+      self.hub = str(hub)
+    alternate = self.linksByRel.get('alternate')
+    if alternate:
+      self.sourceUrl = str(alternate)
+    else:
+      self.sourceUrl = feed.get('id', '')
+    self.author = _extractAuthor(feed)
+    if not self.author:
+      # Get the authors of all the entries and if they're the same assume that author made all the entries.
+      # TODO(ade) This doesn't correctly handle situations where a feed or an entry has multiple authors.
+      # We currently get away with this because I haven't added multiple author support to feedparser.py
+      authors = set([_extractAuthor(entry) for entry in entries])
+      if len(authors) == 1:
+        self.author = authors.pop()
+      else:
+        self.author = ""
+    # What the metadata was worked out from. A streamed feed's links can grow as parsing goes on.
+    self.feed = feed
+    self.numberOfLinks = len(links)
+    self.link = feed.get('link')
+
+  def isFor(self, feed):
+    """Return True if the metadata is still up to date for the feed"""
+    return feed is self.feed and len(feed.get('links') or []) == self.numberOfLinks and feed.get('link') == self.link
+
+def _extractAuthor(entryOrFeed):
+  # Get the precise name of the author if we can
+  if hasattr(entryOrFeed, 'author_detail'):
+    return entryOrFeed['author_detail']['name']
+  return entryOrFeed.get('author', '')
+
 class ContentParser(object):
   """A parser that extracts data from PSHB feeds
 
   It uses the FeedParser library to parse the feeds, extracts information about the PSHB hub being used and creates valid Streamer Posts."""
 
-  def __init__(self, content, defaultHub='https://pubsubhubbub.appspot.com/', alwaysUseDefaultHub=False, urlToFetch=""):
+  def __init__(self, content, defaultHub='https://pubsubhubbub.appspot.com/', alwaysUseDefaultHub=False, urlToFetch="",
+               etag=None, lastModified=None, streaming=False, microformats=None, skipUnchanged=False):
+    self.defaultHub = defaultHub
+    # None leaves the choice of whether to look for microformats in the content to FeedParser
+    self.microformats = microformats
+    self.alwaysUseDefaultHub = alwaysUseDefaultHub
+    # Set when a conditional fetch finds that the feed hasn't changed. There's nothing to parse when that happens.
+    self.notModified = False
+    self.etag = None
+    self.lastModified = None
+    self.contentLength = 0
+    # Entries left out because they haven't changed since they were stored, and the raw digests of the rest by key name
+    self.skippedEntries = 0
+    self.rawDigests = {}
+    self.__feedMetadata = None
     if urlToFetch:
-      response = urlfetch.fetch(urlToFetch)
+      headers = {}
+      if etag:
+        headers['If-None-Match'] = etag
+      if lastModified:
+        headers['If-Modified-Since'] = lastModified
+      response = metrics.timed('fetch', urlfetch.fetch, urlToFetch, headers=headers)
       logging.info("Status was: [%s]" % response.status_code)
       if response.status_code == 404 or response.status_code == 400:
         raise UrlError(urlToFetch, response.status_code, str(response))
+      self.etag = response.headers.get('ETag', etag)
+      self.lastModified = response.headers.get('Last-Modified', lastModified)
+      if response.status_code == 304:
+        self.notModified = True
+        self.data = None
+        return
       content = response.content
-    self.data = feedparser.parse(content)
-    self.defaultHub = defaultHub
-    self.alwaysUseDefaultHub = alwaysUseDefaultHub
+    if content:
+      self.contentLength = len(content)
+    if streaming:
+      # Nothing is parsed until iterPosts is called
+      self.content = content
+      self.data = feedparser.FeedParserDict(feed=feedparser.FeedParserDict(), entries=[], bozo=0)
+      return
+    if skipUnchanged:
+      # How the entries are parsed depends on whether microformats are looked for so that's part of their digests
+      content, self.rawDigests, self.skippedEntries = metrics.timed('sniff', skipUnchangedEntries, content,
+                                                                    repr(microformats))
+    timings = metrics.phaseTimings()
+    self.data = metrics.timed('parse', feedparser.parse, content, microformats=microformats, timings=timings)
+    metrics.addPhases('parse.', timings)
 
   def dataValid(self):
     if self.data.bozo:
@@ -123,48 +660,33 @@ class ContentParser(object):
         return link
     return entryOrFeed.get('id', '')
 
-  def __extractAuthor(self, entryOrFeed):
-  # Get the precise name of the author if we can
-    if hasattr(entryOrFeed, 'author_detail'):
-      author = entryOrFeed['author_detail']['name']
-    else:
-      author = entryOrFeed.get('author', '')
-    return author
-
   def __extractPost(self, entry):
+    content = entryContent(entry)
     if hasattr(entry, 'content'):
       link = self.__extractAtomPermaLink(entry)
       title = entry.get('title', '')
-      content = entry.content[0].value
-      #Workaround for Flickr's RSS feeds. I should probably ignore it but they use RSS 2.0 as their default format.
-      #TODO(ade) Check to see if this is actually a bug in Feedparser.py since arguably rss2.0:description elements should be mapped to atom:content elements.
-      if not content:
-        content = entry.get('summary', '')
       datePublished = self.__createDateTime(entry)
 
-      author = self.__extractAuthor(entry)
+      author = _extractAuthor(entry)
     else:
-      logging.debug("Entry has no atom:content")
       link = entry.get('link', '')
       title = entry.get('title', '')
-      content = entry.get('description', '')
       datePublished = self.__createDateTime(entry)
       author = ""
-    feedUrl = self.extractFeedUrl()
-    return PostFactory.createPost(url=link, feedUrl=feedUrl, title=title, content=content, datePublished=datePublished,
+    feedUrl = self.feedMetadata().feedUrl
+    post = PostFactory.createPost(url=link, feedUrl=feedUrl, title=title, content=content, datePublished=datePublished,
                                   author=author, entry=entry)
+    post.rawDigest = self.rawDigests.get(post.key().name())
+    return post
+
+  def feedMetadata(self):
+    """Return the FeedMetadata of the document, working it out the first time it's needed"""
+    if self.__feedMetadata is None or not self.__feedMetadata.isFor(self.data.feed):
+      self.__feedMetadata = FeedMetadata(self.data.feed, self.data.entries, self.defaultHub, self.alwaysUseDefaultHub)
+    return self.__feedMetadata
 
   def extractFeedAuthor(self):
-    author = self.__extractAuthor(self.data.feed)
-    if not author:
-    # Get the authors of all the entries and if they're the same assume that author made all the entries.
-    # TODO(ade) This and the extractAuthor method don't correctly handle situations where a feed or an entry has multiple authors.
-    # We currently get away with this because I haven't added multiple author support to feedparser.py
-      authors = [self.__extractAuthor(entry) for entry in self.data.entries]
-      if len(set(authors)) > 1:
-        return ""
-      return authors[0]
-    return author
+    return self.feedMetadata().author
 
   def extractPosts(self):
     postsList = []
@@ -173,27 +695,67 @@ class ContentParser(object):
       postsList.append(p)
     return postsList
 
-  def extractHub(self):
-    if self.alwaysUseDefaultHub:
-      return self.defaultHub
+  def iterPosts(self):
+    """Yield the posts one at a time as they're parsed so that memory use doesn't grow with the size of the feed.
+
+    Only parsers created with streaming=True support this. The feed-level data is filled in as parsing goes on and
+    dataValid is only meaningful once every post has been yielded."""
+    timings = metrics.phaseTimings()
+    entries = feedparser.iterparse(self.content, microformats=self.microformats, timings=timings)
+    for entry in entries:
+      self.data['feed'] = entries.feed
+      yield self.__extractPost(entry)
+    metrics.addPhases('parse.', timings)
+    self.data['feed'] = entries.feed
+    # Anything else the feed had after its first entry is only seen now
+    self.__feedMetadata = None
+    self.data['bozo'] = entries.bozo
+    if entries.bozo:
+      self.data['bozo_exception'] = entries.bozo_exception
 
-    hub = self.__extractLink(self.data.feed, 'hub')
-    if hub is None:
-      return self.defaultHub
-    else:
-      return hub
+  def extractHub(self):
+    return self.feedMetadata().hub
 
   def extractFeedUrl(self):
-    for link in self.data.feed.links:
-      if link['rel'] == 'http://schemas.google.com/g/2005#feed' or link['rel'] == 'self':
-        return link['href']
-    else:
-      return self.data.feed.link + "rss"
+    return self.feedMetadata().feedUrl
 
   def extractSourceUrl(self):
-    sourceUrl = self.__extractAtomPermaLink(self.data.feed)
-    return sourceUrl
-
+    return self.feedMetadata().sourceUrl
+
+
+def _equalInConstantTime(a, b):
+  """Compare two strings in time that depends only on their lengths so that a forger can't learn how much matched"""
+  if hasattr(hmac, 'compare_digest'):
+    return hmac.compare_digest(a, b)
+  if len(a) != len(b):
+    return False
+  difference = 0
+  for x, y in zip(a, b):
+    difference |= ord(x) ^ ord(y)
+  return difference == 0
+
+def signatureValid(content, signature, secret):
+  """Return True if the X-Hub-Signature header value matches the HMAC-SHA1 of the content under the given secret"""
+  if not signature or not signature.startswith('sha1='):
+    return False
+  expected = hmac.new(secret, content, hashlib.sha1).hexdigest()
+  return _equalInConstantTime(str(signature[len('sha1='):]), expected)
+
+class HubPublisher(object):
+  """Tells a hub that topics have new content so that it can send fat pings to their subscribers"""
+
+  def publish(self, hub, urls):
+    """Return True if the hub accepted the notification"""
+    parameters = [("hub.mode", "publish")] + [("hub.url", url) for url in urls]
+    response = urlfetch.fetch(hub,
+                              payload=urllib.urlencode(parameters),
+                              method=urlfetch.POST,
+                              headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    logging.info("Status of publish for: %s at hub: %s is: %d" % (urls, hub, response.status_code))
+    if response.status_code != 204:
+      logging.info(response.content)
+      return False
+    return True
 
 class HubSubscriber(object):
   def subscribe(self, url, hub, callback_url):
@@ -202,14 +764,23 @@ class HubSubscriber(object):
   def unsubscribe(self, url, hub, callback_url):
     self._talk_to_hub('unsubscribe', url, hub, callback_url)
 
-  def _talk_to_hub(self, mode, url, hub, callback_url):
+  def flush(self):
+    """Send any requests that are waiting to be sent. Requests are sent straight away so there never are any."""
+    pass
+
+  def _payload(self, mode, url, callback_url):
     parameters = {"hub.callback": callback_url,
                   "hub.mode": mode,
                   "hub.topic": url,
                   "hub.verify": "async", # We don't want un/subscriptions to block until verification happens
                   "hub.verify_token": settings.SECRET_TOKEN, #TODO Must generate a token based on some secret value
     }
-    payload = urllib.urlencode(parameters)
+    if settings.HUB_SECRET:
+      parameters["hub.secret"] = settings.HUB_SECRET
+    return urllib.urlencode(parameters)
+
+  def _talk_to_hub(self, mode, url, hub, callback_url):
+    payload = self._payload(mode, url, callback_url)
     response = urlfetch.fetch(hub,
                               payload=payload,
                               method=urlfetch.POST,
@@ -217,3 +788,122 @@ class HubSubscriber(object):
     logging.info("Status of %s for feed: %s at hub: %s is: %d" % (mode, url, hub, response.status_code))
     if response.status_code != 202:
       logging.info(response.content)
+
+class HubStats(object):
+  """How the requests sent to a single hub fared"""
+
+  def __init__(self, hub):
+    self.hub = hub
+    self.requests = 0
+    self.retries = 0
+    self.errors = 0
+    self.totalLatency = 0.0
+    self.maxLatency = 0.0
+
+  def record(self, latency):
+    self.requests += 1
+    self.totalLatency += latency
+    self.maxLatency = max(self.maxLatency, latency)
+
+  def averageLatency(self):
+    return self.requests and self.totalLatency / self.requests or 0.0
+
+  def errorRate(self):
+    return self.requests and float(self.errors) / self.requests or 0.0
+
+  def __str__(self):
+    return "%s: %d requests, %d retries, %d errors, %.0fms average latency, %.0fms max latency" % (
+        self.hub, self.requests, self.retries, self.errors, self.averageLatency() * 1000, self.maxLatency * 1000)
+
+class _HubRequest(object):
+  def __init__(self, mode, url, hub, payload):
+    self.mode = mode
+    self.url = url
+    self.hub = hub
+    self.payload = payload
+    self.attempts = 0
+    self.notBefore = 0
+
+class BatchHubSubscriber(HubSubscriber):
+  """A HubSubscriber that queues up requests and sends them all when flush is called.
+
+  Requests for different hubs are sent at the same time using asynchronous urlfetch calls. No more than concurrency
+  requests are outstanding at any one hub. Requests that fail in a way that may not happen again, such as a timeout
+  or a 5xx status, are retried up to maxAttempts times with exponential backoff."""
+
+  def __init__(self, concurrency=None, maxAttempts=None, backoffSeconds=None):
+    self.concurrency = concurrency or settings.HUB_CONCURRENCY
+    self.maxAttempts = maxAttempts or settings.HUB_MAX_ATTEMPTS
+    if backoffSeconds is None:
+      backoffSeconds = settings.HUB_BACKOFF_SECONDS
+    self.backoffSeconds = backoffSeconds
+    self.pending = []
+    # Maps each hub to its HubStats
+    self.stats = {}
+
+  def _talk_to_hub(self, mode, url, hub, callback_url):
+    self.pending.append(_HubRequest(mode, url, hub, self._payload(mode, url, callback_url)))
+
+  def _start(self, request):
+    request.attempts += 1
+    rpc = urlfetch.create_rpc(deadline=settings.HUB_DEADLINE_SECONDS)
+    urlfetch.make_fetch_call(rpc, request.hub, payload=request.payload, method=urlfetch.POST,
+                             headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    return rpc, time.time()
+
+  def _finish(self, request, rpc, started):
+    """Return True if the request needs to be tried again"""
+    stats = self.stats.setdefault(request.hub, HubStats(request.hub))
+    try:
+      response = rpc.get_result()
+      status = response.status_code
+    except urlfetch.Error, e:
+      response = None
+      status = None
+      logging.warn("Failed to %s feed: %s at hub: %s. Error was: %s" % (request.mode, request.url, request.hub, e))
+    stats.record(time.time() - started)
+    if status is not None and 200 <= status < 300:
+      return False
+    transient = status is None or status >= 500 or status == 429
+    if transient and request.attempts < self.maxAttempts:
+      stats.retries += 1
+      request.notBefore = time.time() + self.backoffSeconds * (2 ** (request.attempts - 1))
+      return True
+    stats.errors += 1
+    if response is not None:
+      logging.warn("Status of %s for feed: %s at hub: %s is: %d. Response was: %s" % (request.mode, request.url,
+                                                                                         request.hub, status,
+                                                                                         response.content))
+    return False
+
+  def flush(self):
+    """Send every queued request and return the stats for each hub that was talked to"""
+    waiting = self.pending
+    self.pending = []
+    self.stats = {}
+    while waiting:
+      now = time.time()
+      ready = [request for request in waiting if request.notBefore <= now]
+      if not ready:
+        time.sleep(min([request.notBefore for request in waiting]) - now)
+        continue
+      # Start as many requests as each hub's concurrency allows and wait for them all before starting any more
+      inFlight = []
+      startedPerHub = {}
+      for request in ready:
+        if startedPerHub.get(request.hub, 0) < self.concurrency:
+          startedPerHub[request.hub] = startedPerHub.get(request.hub, 0) + 1
+          inFlight.append(request)
+      inFlightIds = dict([(id(request), True) for request in inFlight])
+      waiting = [request for request in waiting if id(request) not in inFlightIds]
+      rpcs = [self._start(request) for request in inFlight]
+      for request, (rpc, started) in zip(inFlight, rpcs):
+        if self._finish(request, rpc, started):
+          waiting.append(request)
+
+    for stats in self.stats.values():
+      logging.info("Hub %s" % stats)
+      metrics.increment('hub.requests.%s' % stats.hub, stats.requests)
+      metrics.increment('hub.errors.%s' % stats.hub, stats.errors)
+      metrics.increment('hub.latencyMs.%s' % stats.hub, int(stats.totalLatency * 1000))
+    return self.stats
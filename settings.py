@@ -21,6 +21,86 @@ MAX_TASK_RETRIES = 10
 # Maximum number of items to be fetched for any part of the system that wants everything of a given data model type
 MAX_FETCH = 500
 
+# How many entities should be deleted in each datastore call when deleting all the posts of a feed
+DELETE_BATCH_SIZE = 200
+
+# How many seconds a request may spend deleting before it hands the rest of the work on to a background task
+DELETE_TIME_BUDGET_SECONDS = 20
+
+# How many subscriptions each background task refreshes when an admin refreshes all the subscriptions
+REFRESH_BATCH_SIZE = 10
+
+# How many refresh tasks for subscriptions at the same hub may start in each REFRESH_HUB_INTERVAL_SECONDS
+REFRESH_HUB_CONCURRENCY = 5
+REFRESH_HUB_INTERVAL_SECONDS = 10
+
+# Feeds imported from OPML are subscribed to in batches of this size. No more than IMPORT_HOST_CONCURRENCY batches of
+# feeds from the same host may start in each IMPORT_HOST_INTERVAL_SECONDS.
+IMPORT_BATCH_SIZE = 5
+IMPORT_HOST_CONCURRENCY = 2
+IMPORT_HOST_INTERVAL_SECONDS = 10
+
+# Batched requests to hubs: how many may be outstanding at each hub, how long each may take and how often to try them
+HUB_CONCURRENCY = 10
+HUB_DEADLINE_SECONDS = 10
+HUB_MAX_ATTEMPTS = 3
+# The delay before the first retry. It doubles with each retry after that.
+HUB_BACKOFF_SECONDS = 1
+
+# Big puts, such as the posts of an archive feed, are split into batches of at most PUT_MAX_ENTITIES entities and
+# roughly PUT_MAX_BYTES bytes to stay within the datastore's limits. Within those limits the batch size starts at
+# PUT_INITIAL_BATCH_SIZE and is tuned so that each batch takes about PUT_TARGET_SECONDS.
+PUT_MAX_ENTITIES = 500
+PUT_MAX_BYTES = 900 * 1024
+PUT_INITIAL_BATCH_SIZE = 100
+PUT_TARGET_SECONDS = 1.0
+# How many times in a row a batch may time out before the put fails, and the delay before the first retry. It doubles
+# with each retry after that.
+PUT_MAX_ATTEMPTS = 4
+PUT_BACKOFF_SECONDS = 0.2
+
+# Leases are renewed once they're within LEASE_RENEWAL_WINDOW_SECONDS of expiring. The renewal scheduler runs every
+# LEASE_RENEWAL_INTERVAL_SECONDS (see cron.yaml) and spreads the renewals it starts across that interval.
+LEASE_RENEWAL_WINDOW_SECONDS = 24 * 60 * 60
+LEASE_RENEWAL_INTERVAL_SECONDS = 10 * 60
+LEASE_RENEWAL_BATCH_SIZE = 10
+# A lease isn't renewed again until this long after a renewal was last requested, giving the hub time to verify it
+LEASE_RENEWAL_RETRY_SECONDS = 60 * 60
+# The lease assumed when a hub verifies a subscription without saying how long it lasts
+DEFAULT_LEASE_SECONDS = 7 * 24 * 60 * 60
+
 # Should Streamer check that posts it receives from a putative hub are for feeds it's actually subscribed to
 SHOULD_VERIFY_INCOMING_POSTS = False
+
+# Should incoming pings be acknowledged as soon as they're staged, leaving the parsing and storing to a background task
+ASYNC_INGEST = False
+
+# A ping that's byte for byte the same as one ingested within this many seconds is acknowledged without being ingested
+# again. 0 ingests every ping. The digests of the last PING_DIGEST_CACHE_SIZE pings are also kept in each instance.
+PING_DIGEST_SECONDS = 10 * 60
+PING_DIGEST_CACHE_SIZE = 1000
+
+# Pings bigger than this many bytes are parsed and stored a chunk of INGEST_CHUNK_SIZE posts at a time
+STREAMING_INGEST_BYTES = 1024 * 1024
+INGEST_CHUNK_SIZE = 100
+
+# Should FeedParser look for microformats in the content of posts. Streamer doesn't use them so it's cheaper not to.
+# Individual subscriptions can override this.
+PARSE_MICROFORMATS = False
+
+# Should pings and refreshes leave entries whose markup hasn't changed since they were stored out of the document before
+# it's parsed. Feeds resend their recent entries every time so this saves parsing most of them.
+SKIP_UNCHANGED_ENTRIES = True
+
+# The hub that's told whenever Streamer's own Atom feed changes. None stops Streamer from publishing its feed.
+PUBLISH_HUB = "http://pubsubhubbub.appspot.com/"
+# Changes within this many seconds of each other are published together
+PUBLISH_INTERVAL_SECONDS = 10
+
+# The fraction of pings, refreshes and page renders whose hot paths are timed for the admin metrics page. 0 turns
+# timing off and 1 times everything.
+METRICS_SAMPLE_RATE = 0.01
+
+# The shared secret sent to hubs as hub.secret. When set, incoming pings must carry a matching X-Hub-Signature
+HUB_SECRET = None
 # Installation specific config ends.
\ No newline at end of file
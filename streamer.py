@@ -1,3 +1,4 @@
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext import deferred
@@ -5,11 +6,24 @@ from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import login_required
 from google.appengine.ext.webapp.util import run_wsgi_app
+from django.utils import simplejson
 
+import aggregates
+import atomfeed
+import cache
+import datetime
+import hashlib
 import logging
+import metrics
+import opml
 import os
+import pingcache
 import pshb
 import settings
+import time
+import urllib
+import urlparse
+import zlib
 
 from google.appengine.api.labs import taskqueue
 
@@ -25,8 +39,43 @@ class BackGroundTaskHandler(webapp.RequestHandler):
     logging.info("Background task being executed. Function is: <%s>" % (functionName))
     if functionName == 'handleNewSubscription':
       handleNewSubscription(self.request.get('url'), self.request.get('nickname'))
+    elif functionName == 'handleNewSubscriptions':
+      handleNewSubscriptions(self.request.get('urls').split(), self.request.get('nickname'))
+    elif functionName == 'handleIncomingPing':
+      handleIncomingPing(self.request.get('key'), int(retryCount or 0))
+    elif functionName == 'handleScheduleRefresh':
+      handleScheduleRefresh()
+    elif functionName == 'handleRefreshSubscriptions':
+      handleRefreshSubscriptions(self.request.get('urls').split())
+    elif functionName == 'handleDeletePosts':
+      handleDeletePosts(self.request.get('url'), self.request.get('cursor'))
+    elif functionName == 'handleMigrateEntryStrings':
+      handleMigrateEntryStrings(self.request.get('cursor'))
+    elif functionName == 'handleMigratePostBodies':
+      handleMigratePostBodies(self.request.get('cursor'))
+    elif functionName == 'handleCountStoredPosts':
+      handleCountStoredPosts(self.request.get('cursor'))
+    elif functionName == 'handlePublish':
+      handlePublish()
+    elif functionName == 'handleScheduleLeaseRenewals':
+      handleScheduleLeaseRenewals()
+    elif functionName == 'handleRenewLeases':
+      handleRenewLeases(self.request.get('urls').split())
+    elif functionName == 'handleBackfillLeases':
+      handleBackfillLeases(self.request.get('cursor'))
 
 
+EXISTENCE_NAMESPACE = 'subscriptions'
+# Subscriptions written with db.put rather than Subscription.put aren't seen until the cached answer expires
+EXISTENCE_SECONDS = 3600
+EXISTENCE_LOCK_SECONDS = 5
+
+def _existenceKey(url):
+  # Memcache keys can't be longer than 250 bytes but urls can
+  if isinstance(url, unicode):
+    url = url.encode('utf-8')
+  return hashlib.sha1(url).hexdigest()
+
 class Subscription(db.Model):
   """A record of a PSHB lease."""
   url = db.StringProperty(required=True)
@@ -38,6 +87,33 @@ class Subscription(db.Model):
   # Automatically work out when a feed was added
   dateAdded = db.DateTimeProperty(auto_now_add=True)
   author = db.StringProperty()
+  # Validators from the last time the feed was fetched so that refreshes can skip feeds that haven't changed
+  etag = db.StringProperty()
+  lastModified = db.StringProperty()
+  # Size of the feed when it was last downloaded in full. Every fetch that gets a 304 instead saves this many bytes.
+  contentLength = db.IntegerProperty()
+  # When the hub's lease on this subscription runs out and when we last asked the hub to renew it
+  leaseExpires = db.DateTimeProperty()
+  leaseRenewalRequested = db.DateTimeProperty(indexed=False)
+  # Whether to look for microformats in this feed's posts. None means use settings.PARSE_MICROFORMATS
+  parseMicroformats = db.BooleanProperty()
+
+  def shouldParseMicroformats(self):
+    if self.parseMicroformats is None:
+      return settings.PARSE_MICROFORMATS
+    return self.parseMicroformats
+
+  def rememberFetch(self, parser):
+    """Keep the validators from a fetch of the feed so that the next fetch can be conditional"""
+    self.etag = parser.etag
+    self.lastModified = parser.lastModified
+    if parser.notModified:
+      metrics.increment('fetch.notModified')
+      metrics.increment('fetch.bytesSaved', self.contentLength or 0)
+    else:
+      self.contentLength = parser.contentLength
+      metrics.increment('fetch.modified')
+      metrics.increment('fetch.bytesFetched', parser.contentLength)
 
   @staticmethod
   def find(url):
@@ -49,26 +125,267 @@ class Subscription(db.Model):
 
   @staticmethod
   def exists(url):
-    """Return True or False to indicate if a subscription with the given url exists"""
-    query = Subscription.find(url)
-    return len(query.fetch(1)) > 0
+    """Return True or False to indicate if a subscription with the given url exists
+
+    Hub challenges and verified pings ask this all the time so the answer is kept in memcache. Subscriptions are keyed
+    by their url so working it out again is usually a single get by key."""
+    key = _existenceKey(url)
+    exists = memcache.get(key, namespace=EXISTENCE_NAMESPACE)
+    if exists is None:
+      exists = Subscription.get_by_key_name(url) is not None or len(Subscription.find(url).fetch(1)) > 0
+      # add rather than set so that we can't overwrite what a concurrent put or delete has just recorded
+      memcache.add(key, exists, time=EXISTENCE_SECONDS, namespace=EXISTENCE_NAMESPACE)
+    return exists
+
+  @staticmethod
+  def forgetExistence(url):
+    # Stop anyone adding an answer they worked out before the change for a few seconds
+    memcache.delete(_existenceKey(url), seconds=EXISTENCE_LOCK_SECONDS, namespace=EXISTENCE_NAMESPACE)
+
+  @staticmethod
+  def recordLease(url, leaseSeconds):
+    """Remember when the lease the hub has just verified for the feed at url runs out"""
+    try:
+      leaseSeconds = int(leaseSeconds)
+    except ValueError:
+      leaseSeconds = settings.DEFAULT_LEASE_SECONDS
+    def update():
+      subscription = Subscription.get_by_key_name(url)
+      if subscription is None:
+        return
+      subscription.leaseExpires = datetime.datetime.utcnow() + datetime.timedelta(seconds=leaseSeconds)
+      subscription.leaseRenewalRequested = None
+      subscription.put()
+    db.run_in_transaction(update)
+
+  @staticmethod
+  def backfillLeases(cursor=None, batchSize=100):
+    """Give the next batch of subscriptions that have no lease one that runs out at the end of the renewal window.
+
+    Nothing is known about their leases so they're renewed soon, but over the whole window rather than all at once.
+    Return a cursor for the following batch or None if there are no more subscriptions."""
+    query = Subscription.all()
+    if cursor:
+      query.with_cursor(cursor)
+    subscriptions = query.fetch(batchSize)
+    leaseExpires = datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.LEASE_RENEWAL_WINDOW_SECONDS)
+    backfilled = [subscription for subscription in subscriptions if subscription.leaseExpires is None]
+    for subscription in backfilled:
+      subscription.leaseExpires = leaseExpires
+    db.put(backfilled)
+    logging.info("Gave leases to %d of %d subscriptions" % (len(backfilled), len(subscriptions)))
+    if len(subscriptions) < batchSize:
+      return None
+    return query.cursor()
+
+  def renewalRequestedSince(self, time):
+    return self.leaseRenewalRequested is not None and self.leaseRenewalRequested > time
+
+  def put(self):
+    key = db.Model.put(self)
+    memcache.set(_existenceKey(self.url), True, time=EXISTENCE_SECONDS, namespace=EXISTENCE_NAMESPACE)
+    return key
+
+  def delete(self):
+    db.Model.delete(self)
+    Subscription.forgetExistence(self.url)
 
   @staticmethod
   def deleteSubscriptionWithMatchingUrl(url):
     query = db.GqlQuery("SELECT __key__ from Subscription where url= :1", url)
-    # We deliberately use a large fetch value to ensure we delete all feeds matching that URL
-    for key in query.fetch(settings.MAX_FETCH):
-      db.delete(key)
+    # There's rarely more than one subscription per url so keep going until they're all gone
+    deleted, cursor = pshb.deleteInBatches(query)
+    while cursor:
+      deleted, cursor = pshb.deleteInBatches(query, cursor)
+    Subscription.forgetExistence(url)
+
+class DeletionJob(db.Model):
+  """The progress made deleting the posts of a feed that is no longer subscribed to. Keyed by the feed's url.
+
+  A job only exists while there are posts left to delete."""
+  url = db.StringProperty(required=True)
+  # The hub to unsubscribe from, kept here in case the subscription is gone by the time a retry gets to the hub
+  hub = db.StringProperty(indexed=False)
+  postsDeleted = db.IntegerProperty(default=0)
+  dateStarted = db.DateTimeProperty(auto_now_add=True)
+  dateUpdated = db.DateTimeProperty(auto_now=True)
+
+
+# Staged pings have to fit inside a single datastore entity so we leave some headroom below the 1MB limit
+MAX_STAGED_PING_BYTES = 1000 * 1000
 
+class IncomingPing(db.Model):
+  """The raw body of a ping from a hub. It's kept here until a background task has parsed and stored its posts."""
+  body = db.BlobProperty(required=True)
+  dateReceived = db.DateTimeProperty(auto_now_add=True)
+
+  def getContent(self):
+    return zlib.decompress(self.body)
 
 def render(out, htmlPage, templateValues={}):
+  out.write(renderToString(htmlPage, templateValues))
+
+def renderToString(htmlPage, templateValues={}):
   templateValues['admin'] = userIsAdmin()
   path = os.path.join(os.path.dirname(__file__), htmlPage)
-  out.write(template.render(path, templateValues))
+  return metrics.timed('render', template.render, path, templateValues)
+
+# The counters shown on the metrics page. Counters with per-hub names, like the hub.* ones, aren't listed.
+COUNTERS = ['fetch.notModified', 'fetch.modified', 'fetch.bytesSaved', 'fetch.bytesFetched', 'entries.sniffed',
+            'entries.skippedUnparsed', 'posts.written', 'posts.skipped', 'put.batches', 'put.timeouts',
+            'frontPage.hits', 'frontPage.misses', 'atomFeed.hits', 'atomFeed.misses', 'pingDigests.hits',
+            'pingDigests.misses']
+# The caches whose hit rates are worked out from their <cache>.hits and <cache>.misses counters
+CACHES = ['frontPage', 'atomFeed', 'pingDigests']
+
+# The front page looks different to admins so each kind of visitor gets their own copy in the cache
+FRONT_PAGE_NAMES = {False: 'front', True: 'front:admin'}
+POSTS_PAGE_SIZE = 60
+
+def archiveUrl(day):
+  return '/archive/%04d/%02d/%02d' % (day.year, day.month, day.day)
+
+class DayOfPosts(object):
+  """The posts shown under a single day's heading"""
+
+  def __init__(self, day, aggregate):
+    self.day = day
+    self.posts = []
+    self.label = ''
+    self.url = None
+    # The number of posts stored for the whole day, which can be more than the page shows
+    self.count = aggregate and aggregate.posts
+    if aggregate:
+      self.label = aggregate.label
+    elif day:
+      self.label = aggregates.dayLabel(day)
+    if day:
+      self.url = archiveUrl(day)
+
+def groupPostsByDay(posts):
+  """Return the posts grouped by the day they were published. Posts must already be in date order."""
+  days = []
+  for post in posts:
+    day = post.datePublished and post.datePublished.date()
+    if not days or days[-1] != day:
+      days.append(day)
+  dayAggregates = aggregates.getDays([day for day in days if day])
+  aggregatesByDay = dict([(aggregate.day, aggregate) for aggregate in dayAggregates if aggregate])
+  groups = []
+  for post in posts:
+    day = post.datePublished and post.datePublished.date()
+    if not groups or groups[-1].day != day:
+      groups.append(DayOfPosts(day, aggregatesByDay.get(day)))
+    groups[-1].posts.append(post)
+  return groups
+
+def getPostsPage(cursor=None, day=None):
+  """Return a page of posts along with the values needed to render it.
+
+  Pages follow each other by cursor so that the thousandth page is as cheap to fetch as the first."""
+  posts, nextCursor = pshb.Post.fetchPage(cursor, POSTS_PAGE_SIZE, day)
+  templateValues = {'posts': posts, 'days': groupPostsByDay(posts)}
+  if nextCursor:
+    templateValues['olderPostsUrl'] = '%s?cursor=%s' % (day and archiveUrl(day) or '/posts', urllib.quote(nextCursor))
+  if day:
+    earlierDay, laterDay = pshb.Post.findAdjacentDays(day)
+    templateValues['day'] = day
+    templateValues['earlierDayUrl'] = earlierDay and archiveUrl(earlierDay)
+    templateValues['laterDayUrl'] = laterDay and archiveUrl(laterDay)
+  return posts, templateValues
+
+def getCachedPage(name, metricName, renderPage):
+  """Return the page called name from the cache or render it with renderPage and cache it.
+
+  renderPage must return the page's body and the publication date of the oldest post it shows if the page is full."""
+  key = cache.pageKey(name)
+  page = cache.get(key)
+  if page is not None:
+    metrics.increment('%s.hits' % metricName)
+    return page
+  metrics.increment('%s.misses' % metricName)
+  body, oldestPost = renderPage()
+  page = cache.CachedPage(body, oldestPost)
+  cache.set(key, page)
+  return page
+
+def oldestPostOnFullPage(posts):
+  # Until the page is full any post belongs on it. After that only posts at least as new as the last one shown do.
+  if len(posts) == POSTS_PAGE_SIZE:
+    return posts[-1].datePublished
+  return None
+
+def getFrontPage():
+  """Return the rendered front page, from the cache if possible"""
+  def renderFrontPage():
+    posts, templateValues = getPostsPage()
+    return renderToString('posts.html', templateValues), oldestPostOnFullPage(posts)
+  return getCachedPage(FRONT_PAGE_NAMES[userIsAdmin()], 'frontPage', renderFrontPage)
+
+ATOM_PAGE_NAME = 'atom'
+
+def atomFeedUrl():
+  return "http://%s.appspot.com/atom" % settings.APP_NAME
+
+def getAtomFeed():
+  """Return Streamer's own Atom feed of the newest posts, from the cache if possible"""
+  def renderAtomFeed():
+    posts, nextCursor = pshb.Post.fetchPage(pageSize=POSTS_PAGE_SIZE)
+    pshb.Post.fetchBodies(posts)
+    body = atomfeed.renderFeed(posts, atomFeedUrl(), "http://%s.appspot.com/" % settings.APP_NAME, settings.PUBLISH_HUB)
+    return body, oldestPostOnFullPage(posts)
+  return getCachedPage(ATOM_PAGE_NAME, 'atomFeed', renderAtomFeed)
+
+def writeCachedPage(handler, page):
+  """Write the page unless the request shows the client already has it"""
+  handler.response.headers['ETag'] = page.etag
+  if page.matches(handler.request.headers.get('If-None-Match')):
+    handler.response.set_status(304)
+    return
+  handler.response.out.write(page.body)
+
+def writePostsPage(handler, day=None):
+  """Render a page of posts that follows on from the cursor in the request"""
+  try:
+    posts, templateValues = getPostsPage(handler.request.get('cursor'), day)
+  except (db.BadValueError, db.BadRequestError):
+    handler.response.set_status(400)
+    handler.response.out.write("Invalid cursor: %s" % handler.request.get('cursor'))
+    return
+  render(handler.response.out, 'posts.html', templateValues)
+
+def schedulePublish():
+  """Arrange for the hub to be told that the Atom feed has changed. Changes close together share a single task."""
+  if not settings.PUBLISH_HUB:
+    return
+  interval = int(time.time() / settings.PUBLISH_INTERVAL_SECONDS)
+  try:
+    taskqueue.add(url='/bgtasks', name='publish-%d' % interval, countdown=settings.PUBLISH_INTERVAL_SECONDS,
+                  params={'function': 'handlePublish'})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    # Another change in this interval has already scheduled the publish
+    pass
+
+def handlePublish(hubPublisher=pshb.HubPublisher()):
+  if settings.PUBLISH_HUB:
+    hubPublisher.publish(settings.PUBLISH_HUB, [atomFeedUrl()])
+
+def storePosts(posts):
+  """Store the posts that are new or have changed, count them and make sure the front page shows them"""
+  # Each post is serialized for the Atom feed once, when it's stored, rather than every time the feed is rendered
+  changedPosts, newPosts = pshb.putPosts(posts, prepare=atomfeed.serializePosts)
+  aggregates.postsStored(changedPosts, newPosts)
+  cache.invalidateIfShown(FRONT_PAGE_NAMES.values() + [ATOM_PAGE_NAME], changedPosts)
+  if changedPosts:
+    schedulePublish()
+  return changedPosts
 
 def getAllSubscriptionsAsTemplateValues():
 # Get all the feeds
-  subscriptions = db.GqlQuery('SELECT * from Subscription ORDER by url')
+  subscriptions = list(db.GqlQuery('SELECT * from Subscription ORDER by url'))
+  # Along with how many posts each one has and its latest post
+  for subscription, feed in zip(subscriptions, aggregates.getFeeds([s.url for s in subscriptions])):
+    subscription.feed = feed
 
   # Render them in the template
   templateValues = {'subscriptions': subscriptions}
@@ -93,10 +410,128 @@ class AdminRefreshSubscriptionsHandler(BaseAdminHandler):
   def get(self):
   # Only admin users can see this page
     if userIsAdmin():
-      query = Subscription.all()
-      for subscription in query.fetch(settings.MAX_FETCH):
-        logging.info("Refreshing subscription: %s " % subscription.url)
-        self.addNewSubscription(subscription.url)
+      # There can be thousands of subscriptions so even scheduling the refresh is done in the background
+      taskqueue.add(url='/bgtasks', params={'function': 'handleScheduleRefresh'})
+      self.redirect('/subscriptions')
+    else:
+      self.error(403)
+      self.response.out.write("You are not the Admin")
+
+class AdminImportOpmlHandler(BaseAdminHandler):
+  def post(self):
+    """Subscribe to every feed in an uploaded OPML file"""
+    if not userIsAdmin():
+      self.error(403)
+      self.response.out.write("You are not the Admin")
+      return
+    # The file can come from the upload form or be the body of the request
+    content = self.request.get('opml') or self.request.body
+    try:
+      urls = opml.parseFeedUrls(content)
+    except opml.OpmlError, e:
+      self.response.set_status(400)
+      self.response.out.write(str(e))
+      return
+    importSubscriptions(urls, users.get_current_user().nickname())
+    self.redirect('/subscriptions')
+
+class OpmlHandler(webapp.RequestHandler):
+  def get(self):
+    """Export every subscription as OPML"""
+    self.response.headers['Content-Type'] = 'text/x-opml; charset=utf-8'
+    out = self.response.out
+    opml.writeHeader(out, 'Streamer subscriptions')
+    # Subscriptions are written out a page at a time so that they don't all have to be held in memory at once
+    query = Subscription.all()
+    while True:
+      subscriptions = query.fetch(settings.MAX_FETCH)
+      for subscription in subscriptions:
+        opml.writeOutline(out, subscription.url, subscription.author, subscription.sourceUrl)
+      if len(subscriptions) < settings.MAX_FETCH:
+        break
+      query.with_cursor(query.cursor())
+    opml.writeFooter(out)
+
+class CronRenewLeasesHandler(webapp.RequestHandler):
+  def get(self):
+    """Called by cron to renew the leases that are about to expire. app.yaml only lets cron and admins in."""
+    taskqueue.add(url='/bgtasks', params={'function': 'handleScheduleLeaseRenewals'})
+
+class AdminMigrateEntriesHandler(webapp.RequestHandler):
+  @login_required
+  def get(self):
+  # Only admin users can see this page
+    if userIsAdmin():
+      taskqueue.add(url='/bgtasks', params={'function': 'handleMigrateEntryStrings'})
+      self.redirect('/subscriptions')
+    else:
+      self.error(403)
+      self.response.out.write("You are not the Admin")
+
+class AdminMetricsHandler(webapp.RequestHandler):
+  @login_required
+  def get(self):
+    """Show the timing histograms, overall or for the feed given by the feed parameter, and the counters"""
+    if not userIsAdmin():
+      self.error(403)
+      self.response.out.write("You are not the Admin")
+      return
+    feedUrl = self.request.get('feed') or None
+    counters = metrics.getAll(COUNTERS)
+    templateValues = {'feedUrl': feedUrl,
+                      'histograms': metrics.getHistograms(feedUrl),
+                      'counters': sorted(counters.items()),
+                      'hitRates': [(name, rate is None and '-' or rate)
+                                   for name, rate in sorted(metrics.hitRates(CACHES, counters).items())],
+                      'sampleRate': settings.METRICS_SAMPLE_RATE,
+                      'feedUrls': [s.url for s in Subscription.all().order('url').fetch(settings.MAX_FETCH)]}
+    render(self.response.out, 'metrics.html', templateValues)
+
+class AdminMetricsJsonHandler(webapp.RequestHandler):
+  def get(self):
+    """The same data as AdminMetricsHandler as JSON, for monitoring scripts"""
+    if not userIsAdmin():
+      self.error(403)
+      self.response.out.write("You are not the Admin")
+      return
+    feedUrl = self.request.get('feed') or None
+    counters = metrics.getAll(COUNTERS)
+    data = {'feedUrl': feedUrl,
+            'sampleRate': settings.METRICS_SAMPLE_RATE,
+            'timings': [histogram.toDict() for histogram in metrics.getHistograms(feedUrl)],
+            'counters': counters,
+            'hitRates': metrics.hitRates(CACHES, counters)}
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(simplejson.dumps(data))
+
+class AdminMigratePostBodiesHandler(webapp.RequestHandler):
+  @login_required
+  def get(self):
+  # Only admin users can see this page
+    if userIsAdmin():
+      taskqueue.add(url='/bgtasks', params={'function': 'handleMigratePostBodies'})
+      self.redirect('/subscriptions')
+    else:
+      self.error(403)
+      self.response.out.write("You are not the Admin")
+
+class AdminBackfillLeasesHandler(webapp.RequestHandler):
+  @login_required
+  def get(self):
+  # Only admin users can see this page
+    if userIsAdmin():
+      taskqueue.add(url='/bgtasks', params={'function': 'handleBackfillLeases'})
+      self.redirect('/subscriptions')
+    else:
+      self.error(403)
+      self.response.out.write("You are not the Admin")
+
+class AdminCountPostsHandler(webapp.RequestHandler):
+  @login_required
+  def get(self):
+  # Only admin users can see this page
+    if userIsAdmin():
+      taskqueue.add(url='/bgtasks', params={'function': 'handleCountStoredPosts'})
       self.redirect('/subscriptions')
     else:
       self.error(403)
@@ -119,6 +554,7 @@ class AdminDeleteSubscriptionHandler(webapp.RequestHandler):
   # Only admin users can see this page
     if userIsAdmin():
       templateValues = getAllSubscriptionsAsTemplateValues()
+      templateValues['deletions'] = DeletionJob.all().fetch(settings.MAX_FETCH)
       render(self.response.out, 'delete_subscriptions.html', templateValues)
     else:
       self.error(403)
@@ -136,6 +572,23 @@ class AdminDeleteSubscriptionHandler(webapp.RequestHandler):
       self.error(403)
       self.response.out.write("You are not the Admin")
 
+class ArchiveHandler(webapp.RequestHandler):
+  def get(self, year, month, day):
+    """Show the posts published on a single day"""
+    try:
+      day = datetime.date(int(year), int(month), int(day))
+    except ValueError:
+      self.response.set_status(404)
+      self.response.out.write("No such day: %s/%s/%s" % (year, month, day))
+      return
+    writePostsPage(self, day)
+
+class AtomHandler(webapp.RequestHandler):
+  def get(self):
+    """Show the newest posts as an Atom feed"""
+    self.response.headers['Content-Type'] = 'application/atom+xml; charset=utf-8'
+    writeCachedPage(self, getAtomFeed())
+
 class AboutHandler(webapp.RequestHandler):
   def get(self):
     render(self.response.out, 'about.html')
@@ -145,38 +598,403 @@ class AboutHandler(webapp.RequestHandler):
 def handleDeleteSubscription(url, hubSubscriber=pshb.HubSubscriber()):
   logging.info("Deleting subscription: %s" % url)
 
-  pshb.Post.deleteAllPostsWithMatchingFeedUrl(url)
   subscription = Subscription.get_by_key_name(url)
   logging.info('Found: %s' % str(subscription))
 
+  # A feed can have tens of thousands of posts so they're deleted in the background. The job is started first so that
+  # the posts are deleted even if a later step fails, and so that a retry still knows the hub.
+  job = DeletionJob.get_by_key_name(url)
+  if job is None:
+    job = DeletionJob(key_name=url, url=url, hub=subscription and subscription.hub)
+    job.put()
+  taskqueue.add(url='/bgtasks', params={'function': 'handleDeletePosts', 'url': url})
+
   Subscription.deleteSubscriptionWithMatchingUrl(url)
-  hubSubscriber.unsubscribe(url, subscription.hub, "http://%s.appspot.com/posts" % settings.APP_NAME)
+  aggregates.feedDeleted(url)
+  if job.hub is None:
+    logging.info("Subscription: %s was already deleted so there's no hub to unsubscribe from" % url)
+    return
+  hubSubscriber.unsubscribe(url, job.hub, "http://%s.appspot.com/posts" % settings.APP_NAME)
 
-def handleNewSubscription(url, nickname):
+def handleDeletePosts(url, cursor=None):
+  """Delete as many of the feed's posts as the time budget allows then hand the rest of the job on to another task"""
+  deleted, nextCursor = pshb.Post.deleteAllPostsWithMatchingFeedUrl(url, cursor, onDelete=aggregates.postsDeleted)
+  job = DeletionJob.get_by_key_name(url) or DeletionJob(key_name=url, url=url)
+  job.postsDeleted += deleted
+  if nextCursor is None:
+    job.delete()
+  else:
+    job.put()
+  if deleted:
+    cache.invalidate()
+  logging.info("Deleted %d posts so far for feed: %s" % (job.postsDeleted, url))
+  if nextCursor:
+    taskqueue.add(url='/bgtasks', params={'function': 'handleDeletePosts', 'url': url, 'cursor': nextCursor})
+
+def handleNewSubscription(url, nickname, hubSubscriber=None):
   logging.info("Subscription added: <%s> by <%s>" % (url, nickname))
+  hubSubscriber = hubSubscriber or pshb.HubSubscriber()
   # TODO test this function directly just like we do for handleDeleteSubscription
 
+  # Re-adding a feed we already have only needs to parse it again if it has changed
+  existingSubscription = Subscription.get_by_key_name(url)
+  etag = None
+  lastModified = None
+  microformats = settings.PARSE_MICROFORMATS
+  if existingSubscription:
+    etag = existingSubscription.etag
+    lastModified = existingSubscription.lastModified
+    microformats = existingSubscription.shouldParseMicroformats()
   try:
-    parser = pshb.ContentParser(None, settings.DEFAULT_HUB, settings.ALWAYS_USE_DEFAULT_HUB, urlToFetch=url)
+    parser = pshb.ContentParser(None, settings.DEFAULT_HUB, settings.ALWAYS_USE_DEFAULT_HUB, urlToFetch=url,
+                                etag=etag, lastModified=lastModified, microformats=microformats)
   except pshb.UrlError, e:
     logging.warn("Url added by: %s had problem.\n Error was: %s" % (nickname, e))
     return
+  if parser.notModified:
+    logging.info("Feed: %s hasn't changed since it was last fetched" % url)
+    existingSubscription.rememberFetch(parser)
+    hubSubscriber.subscribe(url, existingSubscription.hub, "http://%s.appspot.com/posts" % settings.APP_NAME)
+    return
   hub = parser.extractHub()
   sourceUrl = parser.extractSourceUrl()
   author = parser.extractFeedAuthor()
 
-  # Store the url as a Feed
-  subscription = Subscription(url=url, subscriber=nickname, hub=hub, sourceUrl=sourceUrl, author=author, key_name=url)
+  # Store the url as a Feed. A feed we already have keeps its lease and its own settings.
+  subscription = existingSubscription
+  if subscription:
+    subscription.subscriber = nickname
+    subscription.hub = hub
+    subscription.sourceUrl = sourceUrl
+    subscription.author = author
+  else:
+    # Until the hub's challenge says how long the lease is, assume the default so that it's renewed even if the
+    # challenge never comes
+    leaseExpires = datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.DEFAULT_LEASE_SECONDS)
+    subscription = Subscription(url=url, subscriber=nickname, hub=hub, sourceUrl=sourceUrl, author=author, key_name=url,
+                                leaseExpires=leaseExpires)
+  subscription.rememberFetch(parser)
   subscription.put()
 
   # Tell the hub about the url
-  hubSubscriber = pshb.HubSubscriber()
   hubSubscriber.subscribe(url, hub, "http://%s.appspot.com/posts" % settings.APP_NAME)
 
   # Store the current content of the feed
   posts = parser.extractPosts()
   logging.info("About to store %d new posts for subscription: %s" % (len(posts), url))
-  db.put(posts)
+  storePosts(posts)
+
+def stageIncomingPing(content):
+  """Store the raw ping and enqueue a task to ingest it. Return False if the ping is too big to be staged."""
+  # Feeds compress well and the fastest compression level keeps the handler's latency down
+  body = zlib.compress(content, 1)
+  if len(body) > MAX_STAGED_PING_BYTES:
+    logging.warn("Ping of %d bytes is too big to stage so it will be ingested immediately" % len(content))
+    return False
+  ping = IncomingPing(body=db.Blob(body))
+  ping.put()
+  taskqueue.add(url='/bgtasks', queue_name='ingest', params={'function': 'handleIncomingPing', 'key': str(ping.key())})
+  return True
+
+def handleIncomingPing(key, retryCount=0):
+  ping = IncomingPing.get(key)
+  if ping is None:
+    # This task is being retried but an earlier attempt got as far as ingesting the ping
+    logging.info("Staged ping: %s has already been ingested" % key)
+    return
+  try:
+    statusCode, message = ingestContent(ping.getContent())
+  except Exception:
+    if retryCount < settings.MAX_TASK_RETRIES:
+      raise
+    # The task won't be run again so nothing else would ever delete the ping
+    logging.exception("Giving up on staged ping: %s after %d retries" % (key, retryCount))
+    ping.delete()
+    return
+  logging.info("Ingested staged ping: %s with result: %d %s" % (key, statusCode, message))
+  ping.delete()
+
+@metrics.profiled
+def microformatsFor(url):
+  """Return whether to look for microformats in the posts of the feed at url.
+
+  Pings, subscribing and refreshes must all parse a feed the same way or each of them would store its posts again."""
+  subscription = Subscription.get_by_key_name(url)
+  if subscription is None:
+    return settings.PARSE_MICROFORMATS
+  return subscription.shouldParseMicroformats()
+
+def ingestContent(content):
+  """Parse and store the posts in a ping. Return a (status code, message) pair describing what happened."""
+  if len(content) > settings.STREAMING_INGEST_BYTES:
+    return ingestContentInChunks(content)
+  parse = lambda microformats: metrics.timed('contentParser', pshb.ContentParser, content, settings.DEFAULT_HUB,
+                                             settings.ALWAYS_USE_DEFAULT_HUB, microformats=microformats,
+                                             skipUnchanged=settings.SKIP_UNCHANGED_ENTRIES)
+  parser = parse(settings.PARSE_MICROFORMATS)
+  url = parser.extractFeedUrl()
+  metrics.setProfileFeed(url)
+
+  # This is a hack since the correct thing to do is to fetch the feed at subscription
+  # time and store the self element inside the feed then use that for comparisons.
+  if settings.SHOULD_VERIFY_INCOMING_POSTS:
+    if not Subscription.exists(url):
+      #404 chosen because the subscription doesn't exist
+      logging.warn("We don't have a subscription for that feed: %s" % url)
+      return 404, "We don't have a subscription for that feed: %s" % url
+
+  # The feed's url is only known once it's been parsed. Feeds with their own microformats setting are parsed again.
+  microformats = microformatsFor(url)
+  if microformats != settings.PARSE_MICROFORMATS:
+    parser = parse(microformats)
+
+  if not parser.dataValid():
+    parser.logErrors()
+    return 200, "Bad entries: %s" % parser.data
+  posts = metrics.timed('extractPosts', parser.extractPosts)
+  storePosts(posts)
+  logging.info("Successfully added posts")
+  return 200, "Good entries"
+
+# The task queue API won't accept more tasks than this in a single call
+MAX_TASKS_PER_ADD = 100
+
+def staggerBatches(urlsByGroup, batchesPerGroup, batchSize, concurrency, interval):
+  """Split each group's urls into batches and return a (countdown, urls) pair for each batch.
+
+  The batches for each group are staggered so that no more than concurrency of them start in any interval seconds.
+  batchesPerGroup counts the batches already planned for each group and is updated."""
+  batches = []
+  for group, urls in urlsByGroup.items():
+    for i in range(0, len(urls), batchSize):
+      planned = batchesPerGroup.get(group, 0)
+      batchesPerGroup[group] = planned + 1
+      countdown = (planned // concurrency) * interval
+      batches.append((countdown, urls[i:i + batchSize]))
+  return batches
+
+def planRefreshBatches(subscriptions, batchesPerHub):
+  """Group the subscriptions into batches and return a (countdown, urls) pair for each batch.
+
+  The batches for each hub are staggered so that no more than REFRESH_HUB_CONCURRENCY of them start in any
+  REFRESH_HUB_INTERVAL_SECONDS. batchesPerHub counts the batches already planned for each hub and is updated."""
+  urlsByHub = {}
+  for subscription in subscriptions:
+    urlsByHub.setdefault(subscription.hub, []).append(subscription.url)
+  return staggerBatches(urlsByHub, batchesPerHub, settings.REFRESH_BATCH_SIZE, settings.REFRESH_HUB_CONCURRENCY,
+                        settings.REFRESH_HUB_INTERVAL_SECONDS)
+
+def planImportBatches(urls):
+  """Group feed urls into batches and return a (countdown, urls) pair for each batch.
+
+  The batches for each host are staggered so that no more than IMPORT_HOST_CONCURRENCY of them start in any
+  IMPORT_HOST_INTERVAL_SECONDS. That way importing a list full of feeds from one site doesn't hammer it."""
+  urlsByHost = {}
+  for url in urls:
+    urlsByHost.setdefault(urlparse.urlparse(url)[1].lower(), []).append(url)
+  return staggerBatches(urlsByHost, {}, settings.IMPORT_BATCH_SIZE, settings.IMPORT_HOST_CONCURRENCY,
+                        settings.IMPORT_HOST_INTERVAL_SECONDS)
+
+def importSubscriptions(urls, nickname):
+  """Enqueue tasks to subscribe to every feed that isn't already subscribed to. Return the number of new feeds.
+
+  The tasks go on the subscribe queue, whose rate bounds how many subscriptions are worked on at once."""
+  urls = [url for url in urls if url.startswith('http://') or url.startswith('https://')]
+  newUrls = []
+  for i in range(0, len(urls), settings.MAX_FETCH):
+    chunk = urls[i:i + settings.MAX_FETCH]
+    # Only the keys are needed to find the feeds we already have so they're looked up in one batch
+    keys = [db.Key.from_path('Subscription', url) for url in chunk]
+    existing = dict([(subscription.key(), True) for subscription in db.get(keys) if subscription])
+    newUrls.extend([url for url, key in zip(chunk, keys) if key not in existing])
+
+  queue = taskqueue.Queue('subscribe')
+  tasks = [taskqueue.Task(url='/bgtasks', countdown=countdown,
+                          params={'function': 'handleNewSubscriptions', 'urls': '\n'.join(batch), 'nickname': nickname})
+           for countdown, batch in planImportBatches(newUrls)]
+  for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + MAX_TASKS_PER_ADD])
+  logging.info("Importing %d new feeds out of %d in %d tasks" % (len(newUrls), len(urls), len(tasks)))
+  return len(newUrls)
+
+def handleNewSubscriptions(urls, nickname, hubSubscriber=None):
+  hubSubscriber = hubSubscriber or pshb.BatchHubSubscriber()
+  try:
+    for url in urls:
+      # A feed that can't be added mustn't stop the rest of the batch, or the ones already stored, being subscribed
+      try:
+        handleNewSubscription(url, nickname, hubSubscriber)
+      except Exception:
+        logging.exception("Failed to add subscription: %s" % url)
+  finally:
+    hubSubscriber.flush()
+
+def handleScheduleRefresh():
+  """Page through every subscription and enqueue the tasks that will refresh them"""
+  queue = taskqueue.Queue('refresh')
+  batchesPerHub = {}
+  query = Subscription.all()
+  scheduled = 0
+  while True:
+    subscriptions = query.fetch(settings.MAX_FETCH)
+    tasks = [taskqueue.Task(url='/bgtasks', countdown=countdown,
+                            params={'function': 'handleRefreshSubscriptions', 'urls': '\n'.join(urls)})
+             for countdown, urls in planRefreshBatches(subscriptions, batchesPerHub)]
+    for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+      queue.add(tasks[i:i + MAX_TASKS_PER_ADD])
+    scheduled += len(subscriptions)
+    if len(subscriptions) < settings.MAX_FETCH:
+      break
+    query.with_cursor(query.cursor())
+  logging.info("Scheduled refreshes for %d subscriptions across %d hubs" % (scheduled, len(batchesPerHub)))
+
+def handleRefreshSubscriptions(urls, hubSubscriber=None):
+  # The whole batch is renewed at the hubs together once every feed has been fetched
+  hubSubscriber = hubSubscriber or pshb.BatchHubSubscriber()
+  try:
+    for url in urls:
+      # A feed that can't be refreshed mustn't stop the rest of the batch being renewed
+      try:
+        refreshSubscription(url, hubSubscriber)
+      except Exception:
+        logging.exception("Failed to refresh subscription: %s" % url)
+  finally:
+    hubSubscriber.flush()
+
+@metrics.profiled
+def refreshSubscription(url, hubSubscriber):
+  """Renew the subscription at its hub and store any posts that have changed since the last refresh"""
+  subscription = Subscription.get_by_key_name(url)
+  if subscription is None:
+    logging.info("Subscription: %s was deleted before it could be refreshed" % url)
+    return
+  metrics.setProfileFeed(url)
+  try:
+    parser = metrics.timed('contentParser', pshb.ContentParser, None, settings.DEFAULT_HUB,
+                           settings.ALWAYS_USE_DEFAULT_HUB, urlToFetch=url, etag=subscription.etag,
+                           lastModified=subscription.lastModified, microformats=subscription.shouldParseMicroformats(),
+                           skipUnchanged=settings.SKIP_UNCHANGED_ENTRIES)
+  except pshb.UrlError, e:
+    logging.warn("Refreshing subscription: %s had problem.\n Error was: %s" % (url, e))
+    return
+  hubSubscriber.subscribe(url, subscription.hub, "http://%s.appspot.com/posts" % settings.APP_NAME)
+  subscription.rememberFetch(parser)
+  if parser.notModified:
+    # The validators haven't changed either so there's no need to store the subscription again
+    logging.info("Feed: %s hasn't changed since it was last refreshed" % url)
+    return
+
+  subscription.put()
+  posts = metrics.timed('extractPosts', parser.extractPosts)
+  logging.info("About to store %d posts for refreshed subscription: %s" % (len(posts), url))
+  storePosts(posts)
+
+def planLeaseRenewals(subscriptions, now):
+  """Choose which of the subscriptions, ordered by when their leases expire, to renew now.
+
+  Each run takes an even share of the leases in the renewal window so that leases which all expire together are
+  renewed over the whole window rather than all at once. Leases that would expire before the next run are always
+  renewed."""
+  retryAfter = now - datetime.timedelta(seconds=settings.LEASE_RENEWAL_RETRY_SECONDS)
+  due = [subscription for subscription in subscriptions if not subscription.renewalRequestedSince(retryAfter)]
+  runsInWindow = max(1, settings.LEASE_RENEWAL_WINDOW_SECONDS // settings.LEASE_RENEWAL_INTERVAL_SECONDS)
+  share = (len(due) + runsInWindow - 1) // runsInWindow
+  nextRun = now + datetime.timedelta(seconds=2 * settings.LEASE_RENEWAL_INTERVAL_SECONDS)
+  urgent = len([subscription for subscription in due if subscription.leaseExpires < nextRun])
+  return due[:max(share, urgent)]
+
+def handleScheduleLeaseRenewals():
+  """Enqueue tasks that renew the leases closest to expiring, spread evenly across the time until the next run"""
+  now = datetime.datetime.utcnow()
+  window = datetime.timedelta(seconds=settings.LEASE_RENEWAL_WINDOW_SECONDS)
+  query = Subscription.all().filter('leaseExpires <', now + window).order('leaseExpires')
+  renewals = planLeaseRenewals(query.fetch(settings.MAX_FETCH), now)
+  for subscription in renewals:
+    subscription.leaseRenewalRequested = now
+  db.put(renewals)
+
+  batches = [renewals[i:i + settings.LEASE_RENEWAL_BATCH_SIZE]
+             for i in range(0, len(renewals), settings.LEASE_RENEWAL_BATCH_SIZE)]
+  tasks = []
+  for i, batch in enumerate(batches):
+    countdown = i * settings.LEASE_RENEWAL_INTERVAL_SECONDS // len(batches)
+    tasks.append(taskqueue.Task(url='/bgtasks', countdown=countdown,
+                                params={'function': 'handleRenewLeases', 'urls': '\n'.join([s.url for s in batch])}))
+  queue = taskqueue.Queue('refresh')
+  for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + MAX_TASKS_PER_ADD])
+  logging.info("Scheduled renewal of %d leases in %d tasks" % (len(renewals), len(tasks)))
+
+def handleRenewLeases(urls, hubSubscriber=None):
+  """Ask the hubs to renew the leases on the subscriptions. Unlike a refresh the feeds aren't fetched again."""
+  hubSubscriber = hubSubscriber or pshb.BatchHubSubscriber()
+  for subscription in Subscription.get_by_key_name(urls):
+    if subscription:
+      hubSubscriber.subscribe(subscription.url, subscription.hub, "http://%s.appspot.com/posts" % settings.APP_NAME)
+  hubSubscriber.flush()
+
+def handleBackfillLeases(cursor):
+  """Give a batch of subscriptions stored before leases were tracked a lease then hand the rest on to another task"""
+  nextCursor = Subscription.backfillLeases(cursor)
+  if nextCursor:
+    taskqueue.add(url='/bgtasks', params={'function': 'handleBackfillLeases', 'cursor': nextCursor})
+
+def handleMigrateEntryStrings(cursor):
+  """Migrate a batch of posts to the compact entry encoding then hand the rest of the job on to another task"""
+  nextCursor = pshb.Post.migrateEntryStrings(cursor)
+  if nextCursor:
+    taskqueue.add(url='/bgtasks', params={'function': 'handleMigrateEntryStrings', 'cursor': nextCursor})
+
+def handleMigratePostBodies(cursor):
+  """Move the bodies of a batch of posts into PostBodies then hand the rest of the job on to another task"""
+  nextCursor = pshb.Post.migrateBodies(cursor)
+  if nextCursor:
+    taskqueue.add(url='/bgtasks', params={'function': 'handleMigratePostBodies', 'cursor': nextCursor})
+  else:
+    # Pages rendered from unmigrated posts show their full content rather than an excerpt
+    cache.invalidate()
+
+def handleCountStoredPosts(cursor):
+  """Count a batch of the posts stored before they were counted then hand the rest of the job on to another task"""
+  nextCursor = aggregates.countStoredPosts(cursor)
+  if nextCursor:
+    taskqueue.add(url='/bgtasks', params={'function': 'handleCountStoredPosts', 'cursor': nextCursor})
+  else:
+    # The day headings show the counts
+    cache.invalidate()
+
+def ingestContentInChunks(content, microformats=None):
+  """Parse and store the posts in a very large ping a chunk at a time so that memory use stays flat"""
+  if microformats is None:
+    microformats = settings.PARSE_MICROFORMATS
+  parser = pshb.ContentParser(content, settings.DEFAULT_HUB, settings.ALWAYS_USE_DEFAULT_HUB, streaming=True,
+                              microformats=microformats)
+  chunk = []
+  stored = 0
+  for post in parser.iterPosts():
+    metrics.setProfileFeed(post.feedUrl)
+    if not stored and not chunk:
+      if settings.SHOULD_VERIFY_INCOMING_POSTS and not Subscription.exists(post.feedUrl):
+        logging.warn("We don't have a subscription for that feed: %s" % post.feedUrl)
+        return 404, "We don't have a subscription for that feed: %s" % post.feedUrl
+      feedMicroformats = microformatsFor(post.feedUrl)
+      if feedMicroformats != microformats:
+        # Nothing has been stored yet so the feed can start again with its own setting
+        return ingestContentInChunks(content, feedMicroformats)
+    chunk.append(post)
+    if len(chunk) == settings.INGEST_CHUNK_SIZE:
+      storePosts(chunk)
+      stored += len(chunk)
+      chunk = []
+  storePosts(chunk)
+  stored += len(chunk)
+  logging.info("Successfully added %d posts in chunks" % stored)
+
+  # Unlike ingestContent the good posts before any bad data have already been stored by the time we find out
+  if not parser.dataValid():
+    parser.logErrors()
+    return 200, "Bad entries after storing %d posts: %s" % (stored, parser.data.bozo_exception)
+  return 200, "Good entries"
 
 class SubscriptionsHandler(BaseAdminHandler):
   def get(self):
@@ -213,6 +1031,7 @@ class PostsHandler(webapp.RequestHandler):
       topic = self.request.get('hub.topic')
       if mode == "subscribe" and Subscription.exists(topic):
         # If this is a subscription and the URL is one we have in our database
+        Subscription.recordLease(topic, self.request.get('hub.lease_seconds'))
         self.response.out.write(self.request.get('hub.challenge'))
         logging.info("Successfully accepted challenge for subscription to feed: %s" % topic)
       elif mode == "unsubscribe" and not Subscription.exists(topic):
@@ -227,49 +1046,63 @@ class PostsHandler(webapp.RequestHandler):
       # Once a challenge has been issued there's no point in returning anything other than challenge passed or failed
       return
 
-    # Get the last N posts ordered by date
-    limit = 60
-    posts = db.GqlQuery('SELECT * from Post ORDER by datePublished desc LIMIT %d' % limit)
+    # Only the first page is cached. Older pages are fetched by cursor and rarely viewed.
+    if self.request.get('cursor'):
+      writePostsPage(self)
+      return
 
-    # Render them in the template
-    templateValues = {'posts': posts}
-    render(self.response.out, 'posts.html', templateValues)
+    writeCachedPage(self, getFrontPage())
 
   def post(self):
     """Create a new resource in this collection"""
-    logging.info("New content: %s" % self.request.body)
-    #TODO Extract out as much of this and move it into a deferred function
-    parser = pshb.ContentParser(self.request.body, settings.DEFAULT_HUB, settings.ALWAYS_USE_DEFAULT_HUB)
-    url = parser.extractFeedUrl()
-
-    # This is a hack since the correct thing to do is to fetch the feed at subscription
-    # time and store the self element inside the feed then use that for comparisons.
-    if settings.SHOULD_VERIFY_INCOMING_POSTS:
-      if not Subscription.exists(url):
-      #404 chosen because the subscription doesn't exist
-        self.response.set_status(404)
-        self.response.out.write("We don't have a subscription for that feed: %s" % url)
-        logging.warn("We don't have a subscription for that feed: %s" % url)
+    content = self.request.body
+    logging.info("New content of %d bytes" % len(content))
+    if settings.HUB_SECRET:
+      signature = self.request.headers.get('X-Hub-Signature')
+      if not pshb.signatureValid(content, signature, settings.HUB_SECRET):
+        # The PSHB spec says we must acknowledge pings with a bad signature but otherwise ignore them
+        logging.warn("Ignoring ping with invalid signature: %s" % signature)
+        self.response.set_status(200)
+        self.response.out.write("Bad signature")
         return
 
-    if not parser.dataValid():
-      parser.logErrors()
-      self.response.out.write("Bad entries: %s" % parser.data)
-      return
-    else:
-      posts = parser.extractPosts()
-      db.put(posts)
-      logging.info("Successfully added posts")
+    pingDigest = pingcache.digest(content)
+    if pingcache.seen(pingDigest):
+      logging.info("Ignoring ping that's the same as one ingested in the last %ds" % settings.PING_DIGEST_SECONDS)
       self.response.set_status(200)
-      self.response.out.write("Good entries")
+      self.response.out.write("Duplicate")
+      return
+
+    if settings.ASYNC_INGEST and stageIncomingPing(content):
+      pingcache.remember(pingDigest)
+      self.response.set_status(202)
+      self.response.out.write("Accepted")
+      return
+
+    statusCode, message = ingestContent(content)
+    if statusCode == 200:
+      pingcache.remember(pingDigest)
+    self.response.set_status(statusCode)
+    self.response.out.write(message)
 
 
 application = webapp.WSGIApplication([
                                          ('/', PostsHandler),
                                          ('/about', AboutHandler),
                                          ('/admin/addSubscription', AdminAddSubscriptionHandler),
+                                         ('/admin/backfillLeases', AdminBackfillLeasesHandler),
+                                         ('/admin/countPosts', AdminCountPostsHandler),
                                          ('/admin/deleteSubscription', AdminDeleteSubscriptionHandler),
+                                         ('/admin/importOpml', AdminImportOpmlHandler),
+                                         ('/admin/metrics', AdminMetricsHandler),
+                                         ('/admin/metrics.json', AdminMetricsJsonHandler),
+                                         ('/admin/migrateEntries', AdminMigrateEntriesHandler),
+                                         ('/admin/migratePostBodies', AdminMigratePostBodiesHandler),
                                          ('/admin/refreshSubscriptions', AdminRefreshSubscriptionsHandler),
+                                         ('/atom', AtomHandler),
+                                         ('/cron/renewLeases', CronRenewLeasesHandler),
+                                         (r'/archive/(\d{4})/(\d{2})/(\d{2})', ArchiveHandler),
+                                         ('/opml', OpmlHandler),
                                          ('/posts', PostsHandler),
                                          ('/subscriptions', SubscriptionsHandler),
                                          ('/bgtasks', BackGroundTaskHandler), ],
@@ -0,0 +1,662 @@
+"""Benchmarks for Streamer's hot paths.
+
+These run outside the dev_appserver against the SDK's in-memory service stubs, so the Google App Engine SDK must be on
+the PYTHONPATH. Run them with:
+	python streamer_benchmarks.py [--json FILE] [--compare FILE] [benchmark ...]
+
+Naming benchmarks, such as corpus or dateParsing, runs just those. --json writes the results to FILE so that a later run
+can --compare its results with them, for example to check a change against the commit before it. The feeds in
+benchmark_corpus/ are checked in so that every run parses exactly the same documents.
+"""
+
+import StringIO
+import gc
+import mimetools
+import optparse
+import os
+import random
+import sys
+import time
+import urllib
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.api import urlfetch_service_pb
+from google.appengine.api import urlfetch_stub
+from google.appengine.api import user_service_stub
+from google.appengine.api.labs.taskqueue import taskqueue_stub
+
+APP_ID = 'streamer-benchmarks'
+
+class StubUrlFetch(apiproxy_stub.APIProxyStub):
+  """Serves the same feed for every GET and acts as a hub that accepts every POST.
+
+  The feed is reported as unchanged to any request that sends back its ETag."""
+
+  def __init__(self, feed, etag='"1"'):
+    apiproxy_stub.APIProxyStub.__init__(self, 'urlfetch')
+    self.feed = feed
+    self.etag = etag
+    self.feedRequests = 0
+    self.hubRequests = 0
+
+  def _Dynamic_Fetch(self, request, response):
+    if request.method() == urlfetch_service_pb.URLFetchRequest.POST:
+      self.hubRequests += 1
+      response.set_statuscode(202)
+      return
+    self.feedRequests += 1
+    for header in request.header_list():
+      if header.key() == 'If-None-Match' and header.value() == self.etag:
+        response.set_statuscode(304)
+        return
+    response.set_statuscode(200)
+    response.set_content(self.feed)
+    header = response.add_header()
+    header.set_key('ETag')
+    header.set_value(self.etag)
+
+def setUpAppEngineStubs(urlfetchStub=None):
+  """Replace the App Engine services with fresh in-memory stubs"""
+  import pingcache
+  # Ping digests kept in this process would outlive the memcache they came from
+  pingcache.clear()
+  os.environ['APPLICATION_ID'] = APP_ID
+  os.environ['AUTH_DOMAIN'] = 'example.org'
+  os.environ['SERVER_NAME'] = 'localhost'
+  os.environ['SERVER_PORT'] = '8080'
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', datastore_file_stub.DatastoreFileStub(APP_ID, None, None))
+  apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', urlfetchStub or urlfetch_stub.URLFetchServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', taskqueue_stub.TaskQueueServiceStub(root_path=os.path.dirname(__file__)))
+
+def makeAtomFeed(numberOfEntries, contentLength, feedUrl='http://example.org/feed', firstEntry=0):
+  """Return an Atom document with the given number of entries each of which has roughly contentLength bytes of content"""
+  entries = []
+  for i in range(firstEntry, firstEntry + numberOfEntries):
+    entries.append("""
+  <entry>
+    <title>Entry %(i)d</title>
+    <link rel="alternate" href="http://example.org/entries/%(i)d"/>
+    <id>tag:example.org,2010:entry-%(i)d</id>
+    <updated>2010-02-%(day)02dT12:%(minute)02d:00Z</updated>
+    <author><name>Example Author</name></author>
+    <content type="html">%(content)s</content>
+  </entry>""" % {'i': i, 'day': i % 28 + 1, 'minute': i % 60, 'content': 'x' * contentLength})
+  return """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Example Feed</title>
+  <link rel="self" href="%s"/>
+  <link rel="alternate" href="http://example.org/"/>
+  <link rel="hub" href="http://hub.example.org/"/>
+  <id>tag:example.org,2010:feed</id>
+  <updated>2010-02-28T12:00:00Z</updated>%s
+</feed>""" % (feedUrl, ''.join(entries))
+
+def percentile(timings, p):
+  ordered = sorted(timings)
+  index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+  return ordered[index]
+
+def timeCalls(function, iterations):
+  """Call function repeatedly and return the latency of each call in milliseconds"""
+  timings = []
+  for i in range(iterations):
+    start = time.time()
+    function()
+    timings.append((time.time() - start) * 1000)
+  return timings
+
+# Every result of the run, in the order they were recorded
+RESULTS = []
+
+def record(name, text, **values):
+  """Print a result and keep its values for the JSON output"""
+  print "%-50s %s" % (name, text)
+  result = {'name': name}
+  result.update(values)
+  RESULTS.append(result)
+
+def report(name, timings):
+  p50 = percentile(timings, 50)
+  p99 = percentile(timings, 99)
+  record(name, "p50: %8.2fms p99: %8.2fms (%d runs)" % (p50, p99, len(timings)), p50Ms=p50, p99Ms=p99, runs=len(timings))
+
+def benchmarkPingLatency():
+  """Handler latency for pings of various sizes with synchronous and staged ingestion"""
+  import settings
+  import streamer
+  from webtest import TestApp
+
+  app = TestApp(streamer.application)
+  # 1 KB, 100 KB and 5 MB pings
+  sizes = [('1KB', 1, 300, 50), ('100KB', 20, 4800, 20), ('5MB', 100, 50000, 5)]
+  pingDigestSeconds = settings.PING_DIGEST_SECONDS
+  for label, numberOfEntries, contentLength, iterations in sizes:
+    feed = makeAtomFeed(numberOfEntries, contentLength)
+    post = lambda: app.post('/posts', feed, headers={'Content-Type': 'application/atom+xml'})
+    # The same feed is sent every time so repeats have to be ingested for anything but the first ping to be timed
+    settings.PING_DIGEST_SECONDS = 0
+    for asyncIngest in [False, True]:
+      settings.ASYNC_INGEST = asyncIngest
+      setUpAppEngineStubs()
+      report("PostsHandler.post %s ping (async ingest: %s)" % (label, asyncIngest), timeCalls(post, iterations))
+    settings.ASYNC_INGEST = False
+    settings.PING_DIGEST_SECONDS = pingDigestSeconds
+    setUpAppEngineStubs()
+    post()
+    report("PostsHandler.post %s duplicate ping" % label, timeCalls(post, iterations))
+
+def requestsPerSecond(function, seconds):
+  """Call function as often as possible for the given number of seconds and return the calls per second"""
+  calls = 0
+  start = time.time()
+  while time.time() - start < seconds:
+    function()
+    calls += 1
+  return calls / (time.time() - start)
+
+def benchmarkFrontPage():
+  """Requests per second for the front page with and without the render cache"""
+  import cache
+  import streamer
+  from webtest import TestApp
+
+  setUpAppEngineStubs()
+  app = TestApp(streamer.application)
+  app.post('/posts', makeAtomFeed(60, 1000), headers={'Content-Type': 'application/atom+xml'})
+
+  def uncached():
+    cache.invalidate()
+    app.get('/posts')
+  etag = app.get('/posts').headers['ETag']
+  results = [("uncached", uncached), ("cached", lambda: app.get('/posts')),
+             ("cached conditional", lambda: app.get('/posts', headers={'If-None-Match': etag}, status=304))]
+  for label, function in results:
+    perSecond = requestsPerSecond(function, 5)
+    record("GET /posts with 60 posts, %s" % label, "%8.1f requests/s" % perSecond, requestsPerSecond=perSecond)
+
+def benchmarkPagination(numberOfPosts=100000):
+  """Time taken to fetch pages of posts by cursor all the way through a large store compared with offset fetches"""
+  from google.appengine.ext import db
+  import datetime
+  import pshb
+
+  setUpAppEngineStubs()
+  start = datetime.datetime(2010, 1, 1)
+  posts = []
+  for i in range(numberOfPosts):
+    posts.append(pshb.Post(key_name="tag:example.org,2010:entry-%d" % i, url="http://example.org/entries/%d" % i,
+                           feedUrl="http://example.org/feed", title="Entry %d" % i, content="x" * 200,
+                           datePublished=start + datetime.timedelta(minutes=i)))
+    if len(posts) == 500:
+      db.put(posts)
+      posts = []
+  db.put(posts)
+
+  pageTimings = []
+  cursor = None
+  while True:
+    started = time.time()
+    page, cursor = pshb.Post.fetchPage(cursor)
+    pageTimings.append((time.time() - started) * 1000)
+    if cursor is None:
+      break
+  report("fetchPage through %d posts, every page" % numberOfPosts, pageTimings)
+  report("fetchPage through %d posts, first page" % numberOfPosts, pageTimings[:1])
+  report("fetchPage through %d posts, last page" % numberOfPosts, pageTimings[-1:])
+  # The datastore won't skip more than 1000 results so offsets can't reach anywhere near the last page
+  for offset in [0, 940]:
+    query = pshb.Post.all().order('-datePublished')
+    report("offset fetch of 60 posts at offset %d" % offset, timeCalls(lambda: query.fetch(60, offset), 10))
+
+def benchmarkSubscriptionExists(numberOfSubscriptions=1000):
+  """Time taken by Subscription.exists from memcache and by a key lookup compared with the query it used to run"""
+  from google.appengine.api import memcache
+  from google.appengine.ext import db
+  import streamer
+
+  setUpAppEngineStubs()
+  subscriptions = []
+  for i in range(numberOfSubscriptions):
+    url = "http://example.org/feeds/%d" % i
+    subscriptions.append(streamer.Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/",
+                                               key_name=url))
+  for i in range(0, len(subscriptions), 500):
+    db.put(subscriptions[i:i + 500])
+  # Half the checks are for feeds that exist and half for feeds that don't
+  urls = ["http://example.org/feeds/%d" % (i * 2) for i in range(numberOfSubscriptions)]
+
+  def existsUncached():
+    memcache.flush_all()
+    for url in urls:
+      streamer.Subscription.exists(url)
+  def existsCached():
+    for url in urls:
+      streamer.Subscription.exists(url)
+  def query():
+    for url in urls:
+      len(streamer.Subscription.find(url).fetch(1)) > 0
+  report("%d existence checks by query" % len(urls), timeCalls(query, 5))
+  report("%d existence checks by key, nothing in memcache" % len(urls), timeCalls(existsUncached, 5))
+  report("%d existence checks from memcache" % len(urls), timeCalls(existsCached, 5))
+
+def benchmarkPostBodies(numberOfPosts=60):
+  """Bytes deserialized and time taken to fetch a front page of posts before and after their bodies were split out"""
+  from google.appengine.ext import db
+  import atomfeed
+  import pshb
+
+  setUpAppEngineStubs()
+  posts = pshb.ContentParser(makeAtomFeed(numberOfPosts, 2000)).extractPosts()
+  atomfeed.serializePosts(posts)
+  # Store the posts the way they were stored before PostBody existed
+  legacyPosts = []
+  for post in posts:
+    body = post.getBody()
+    legacyPosts.append(pshb.Post(key_name=post.key().name(), url=post.url, feedUrl=post.feedUrl, title=post.title,
+                                 datePublished=post.datePublished, author=post.author, content=body.getContent(),
+                                 entryBlob=body.entryBlob, atomEntry=body.atomEntry))
+  db.put(legacyPosts)
+
+  def frontPageBytes():
+    posts, cursor = pshb.Post.fetchPage(pageSize=numberOfPosts)
+    return sum([len(db.model_to_protobuf(post).Encode()) for post in posts])
+  fetchFrontPage = lambda: pshb.Post.fetchPage(pageSize=numberOfPosts)
+  for label in ["before", "after"]:
+    if label == "after":
+      pshb.Post.migrateBodies(batchSize=numberOfPosts + 1)
+    size = frontPageBytes()
+    record("Front page of %d posts, %s split" % (numberOfPosts, label), "%d bytes deserialized" % size,
+           bytesDeserialized=size)
+    report("fetchPage %d posts, %s split" % (numberOfPosts, label), timeCalls(fetchFrontPage, 20))
+
+def benchmarkEntrySerialization():
+  """Stored size and speed of entrycodec compared to the repr()/eval() serialization it replaced"""
+  import entrycodec
+  import feedparser
+
+  entries = feedparser.parse(makeAtomFeed(50, 2000)).entries
+  reprs = [repr(entry) for entry in entries]
+  encoded = [entrycodec.encode(entry) for entry in entries]
+  reprBytes = sum(map(len, reprs))
+  encodedBytes = sum(map(len, encoded))
+  record("Stored size of 50 entries", "repr: %d bytes entrycodec: %d bytes" % (reprBytes, encodedBytes),
+         reprBytes=reprBytes, entrycodecBytes=encodedBytes)
+
+  # repr() of a struct_time needs the time module to be evaluated again
+  namespace = {'time': time}
+  report("repr() 50 entries", timeCalls(lambda: [repr(entry) for entry in entries], 20))
+  report("entrycodec.encode 50 entries", timeCalls(lambda: [entrycodec.encode(entry) for entry in entries], 20))
+  report("eval() 50 entries", timeCalls(lambda: [eval(r, namespace) for r in reprs], 20))
+  report("entrycodec.decode 50 entries", timeCalls(lambda: [entrycodec.decode(e) for e in encoded], 20))
+  report("entrycodec.LazyEntry title of 50 entries", timeCalls(lambda: [entrycodec.LazyEntry(e)['title'] for e in encoded], 20))
+
+def makeMixedDates(count):
+  """Return date strings in the formats feeds commonly use with plenty of repeated timestamps"""
+  formats = ['%a, %d %b %Y %H:%M:%S GMT', '%a, %d %b %Y %H:%M:%S +0000', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S+01:00',
+             '%Y-%m-%d %H:%M:%S.0', '%Y%m%d']
+  dates = []
+  for i in range(count):
+    timestamp = time.gmtime(1265000000 + (i % (count / 4 + 1)) * 3600)
+    dates.append(time.strftime(formats[i % len(formats)], timestamp))
+  return dates
+
+def benchmarkDateParsing():
+  """feedparser._parse_date over a mixed corpus with and without its caches"""
+  import feedparser
+
+  dates = makeMixedDates(1200)
+  def parseColdCache():
+    for date in dates:
+      feedparser._date_cache.clear()
+      feedparser._date_handler_by_signature.clear()
+      feedparser._parse_date(date)
+  def parseKnownFormats():
+    feedparser._date_cache.clear()
+    for date in dates:
+      feedparser._parse_date(date)
+  report("_parse_date 1200 dates, every handler tried in order", timeCalls(parseColdCache, 10))
+  report("_parse_date 1200 dates, remembered handlers", timeCalls(parseKnownFormats, 10))
+  report("_parse_date 1200 dates, all cached", timeCalls(lambda: map(feedparser._parse_date, dates), 10))
+
+def benchmarkFeedParserDict():
+  """Allocation and access costs of the FeedParserDict that every parsed feed and entry is made of"""
+  import feedparser
+
+  entry = feedparser.parse(makeAtomFeed(1, 200)).entries[0]
+  items = entry.items()
+  iterations = range(10000)
+  def allocate():
+    for i in iterations:
+      feedparser.FeedParserDict(items)
+  def getAttributes():
+    for i in iterations:
+      entry.title
+      entry.link
+  def getAliases():
+    for i in iterations:
+      entry['guid']
+      entry.get('modified_parsed')
+  def checkKeys():
+    for i in iterations:
+      entry.has_key('content')
+      'no such key' in entry
+  def setItems():
+    for i in iterations:
+      entry['title'] = 'Title'
+      entry['date'] = 'Date'
+  report("FeedParserDict allocate 10k", timeCalls(allocate, 10))
+  report("FeedParserDict 20k attribute reads", timeCalls(getAttributes, 10))
+  report("FeedParserDict 20k alias reads", timeCalls(getAliases, 10))
+  report("FeedParserDict 20k key checks", timeCalls(checkKeys, 10))
+  report("FeedParserDict 20k writes", timeCalls(setItems, 10))
+
+def benchmarkStreamingParse():
+  """Time and peak memory for parsing a 20MB archive feed with feedparser.iterparse and then feedparser.parse"""
+  import resource
+  import feedparser
+
+  feed = makeAtomFeed(5000, 4000)
+  def peakMemory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  # The peak only ever goes up so the streaming parse has to be measured first
+  before = peakMemory()
+  report("iterparse %dMB feed" % (len(feed) / 1024 / 1024), timeCalls(lambda: [e for e in feedparser.iterparse(feed)], 1))
+  record("iterparse peak memory growth", "%dMB" % (peakMemory() - before), peakGrowthMB=peakMemory() - before)
+  before = peakMemory()
+  report("parse %dMB feed" % (len(feed) / 1024 / 1024), timeCalls(lambda: feedparser.parse(feed), 1))
+  record("parse peak memory growth", "%dMB" % (peakMemory() - before), peakGrowthMB=peakMemory() - before)
+
+def benchmarkFeedMetadata(numberOfEntries=1000):
+  """Time extracting the posts of a 1,000 entry feed whose feed-level data is worked out once rather than per post"""
+  import feedparser
+  import pshb
+
+  feed = makeAtomFeed(numberOfEntries, 200)
+  data = feedparser.parse(feed)
+  # Lots of links is what made rescanning them for every post show up in profiles
+  for i in range(50):
+    data.feed.links.append(feedparser.FeedParserDict(rel='related', href='http://example.org/related/%d' % i))
+  def extractPosts():
+    # A streaming parser doesn't parse anything up front so only the extraction is timed
+    parser = pshb.ContentParser('', streaming=True)
+    parser.data = data
+    return parser.extractPosts()
+  def rescanLinks():
+    # What every post used to cost: a scan of the feed's links for its url
+    for entry in data.entries:
+      for link in data.feed.links:
+        if link['rel'] in pshb.FEED_URL_RELS:
+          break
+  report("ContentParser.extractPosts %d entries" % numberOfEntries, timeCalls(extractPosts, 10))
+  report("feed link rescans for %d entries" % numberOfEntries, timeCalls(rescanLinks, 10))
+  report("FeedMetadata for %d entries" % numberOfEntries,
+         timeCalls(lambda: pshb.FeedMetadata(data.feed, data.entries, 'http://hub.example.org/', False), 10))
+
+def makeHtmlContent(paragraphs):
+  """Return escaped HTML with the relative links, images and inline styles that blog posts are full of"""
+  paragraph = ('<p class="entry" style="color: red">Some <b>bold</b> text with a <a href="/posts/%d">relative link</a>, '
+               'an <img src="images/%d.png" alt="picture"/> and a <script>track(%d)</script></p>')
+  html = ''.join([paragraph % (i, i, i) for i in range(paragraphs)])
+  return html.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def benchmarkContentProcessing():
+  """Passes over the markup and time taken to resolve, sanitize and mine the content of HTML-heavy entries"""
+  import feedparser
+  import settings
+
+  feed = makeAtomFeed(20, 0).replace('<content type="html"></content>', '<content type="html">%s</content>' % makeHtmlContent(200))
+  feed = feed.replace('<feed ', '<feed xml:base="http://example.org/" ')
+  counts = {'passes': 0, 'bytes': 0}
+  originalFeed = feedparser._BaseHTMLProcessor.feed
+  def countingFeed(processor, data):
+    counts['passes'] += 1
+    counts['bytes'] += len(data)
+    return originalFeed(processor, data)
+  feedparser._BaseHTMLProcessor.feed = countingFeed
+  try:
+    for microformats in [True, settings.PARSE_MICROFORMATS]:
+      counts['passes'] = counts['bytes'] = 0
+      feedparser.parse(feed, microformats=microformats)
+      label = "parse 20 HTML-heavy entries (microformats: %s)" % bool(microformats)
+      record(label, "%d markup passes over %dKB" % (counts['passes'], counts['bytes'] / 1024),
+             markupPasses=counts['passes'], markupKB=counts['bytes'] / 1024)
+      report(label, timeCalls(lambda: feedparser.parse(feed, microformats=microformats), 5))
+  finally:
+    feedparser._BaseHTMLProcessor.feed = originalFeed
+
+def makePingReplay(numberOfPings, entriesPerPing, newEntriesPerPing):
+  """Return the pings a hub sends for a busy feed: each one resends the feed's recent entries with a few new ones"""
+  html = makeHtmlContent(10)
+  pings = []
+  for ping in range(numberOfPings):
+    feed = makeAtomFeed(entriesPerPing, 0, firstEntry=ping * newEntriesPerPing)
+    pings.append(feed.replace('<content type="html"></content>', '<content type="html">%s</content>' % html))
+  return pings
+
+def benchmarkPingReplay(numberOfPings=30, entriesPerPing=25, newEntriesPerPing=2):
+  """Ingestion time for a replay of pings that mostly resend entries that are already stored, with and without
+  leaving the unchanged entries out before parsing"""
+  import metrics
+  import settings
+  import streamer
+
+  pings = makePingReplay(numberOfPings, entriesPerPing, newEntriesPerPing)
+  originalSkipUnchanged = settings.SKIP_UNCHANGED_ENTRIES
+  try:
+    for skipUnchanged in [False, True]:
+      settings.SKIP_UNCHANGED_ENTRIES = skipUnchanged
+      setUpAppEngineStubs()
+      timings = []
+      for ping in pings:
+        start = time.time()
+        streamer.ingestContent(ping)
+        timings.append((time.time() - start) * 1000)
+      label = "ingest %d replayed pings (skip unchanged: %s)" % (numberOfPings, skipUnchanged)
+      # The first ping stores every entry whichever way it's ingested
+      report(label, timings[1:])
+      skipped = metrics.get('entries.skippedUnparsed')
+      record(label + " total", "%.0fms, %d entries left unparsed" % (sum(timings), skipped), totalMs=sum(timings),
+             skippedEntries=skipped)
+  finally:
+    settings.SKIP_UNCHANGED_ENTRIES = originalSkipUnchanged
+
+def benchmarkRefresh(numberOfSubscriptions=10000, numberOfHubs=5):
+  """Time taken to schedule and run a refresh of every subscription against a stub hub and stub feeds"""
+  from google.appengine.ext import db
+  import streamer
+
+  stub = StubUrlFetch(makeAtomFeed(10, 500))
+  setUpAppEngineStubs(stub)
+  subscriptions = []
+  for i in range(numberOfSubscriptions):
+    url = "http://example.org/feeds/%d" % i
+    subscriptions.append(streamer.Subscription(url=url, hub="http://hub%d.example.org/" % (i % numberOfHubs),
+                                               sourceUrl="http://example.org/", key_name=url))
+  for i in range(0, len(subscriptions), 500):
+    db.put(subscriptions[i:i + 500])
+
+  report("Scheduling refresh of %d subscriptions" % numberOfSubscriptions, timeCalls(streamer.handleScheduleRefresh, 1))
+  batches = streamer.planRefreshBatches(subscriptions, {})
+  lastCountdown = max([c for c, urls in batches])
+  record("Refresh plan", "%d batches, last one starts after %ds" % (len(batches), lastCountdown),
+         batches=len(batches), lastCountdownSeconds=lastCountdown)
+
+  def refreshEverything():
+    for countdown, urls in batches:
+      streamer.handleRefreshSubscriptions(urls)
+  # The first refresh finds every feed has changed. The second gets a 304 for every feed.
+  report("Refreshing %d changed feeds" % numberOfSubscriptions, timeCalls(refreshEverything, 1))
+  report("Refreshing %d unchanged feeds" % numberOfSubscriptions, timeCalls(refreshEverything, 1))
+  record("Stub traffic", "%d feed fetches, %d hub requests" % (stub.feedRequests, stub.hubRequests),
+         feedRequests=stub.feedRequests, hubRequests=stub.hubRequests)
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_corpus')
+# The name, file and Content-Encoding of each feed in the corpus
+CORPUS = [('atom', 'atom.xml', None),
+          ('rss2', 'rss2.xml', None),
+          ('rdf', 'rdf.xml', None),
+          ('gzip', 'atom.xml.gz', 'gzip'),
+          # Declares itself as utf-8 but is really windows-1252 so every encoding FeedParser knows about is tried
+          ('misencoded', 'misencoded.xml', None),
+          ('html', 'html_heavy.xml', None)]
+
+def loadCorpus():
+  """Return the name, body and Content-Encoding of each feed in the corpus along with its content once decoded"""
+  import gzip
+
+  feeds = []
+  for name, fileName, contentEncoding in CORPUS:
+    body = open(os.path.join(CORPUS_DIRECTORY, fileName), 'rb').read()
+    content = body
+    if contentEncoding == 'gzip':
+      content = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+    feeds.append((name, body, contentEncoding, content))
+  return feeds
+
+def httpResponse(body, contentEncoding):
+  """Return the body as urllib2 would so that FeedParser sees its Content-Encoding"""
+  headers = 'Content-Type: application/atom+xml\r\n'
+  if contentEncoding:
+    headers += 'Content-Encoding: %s\r\n' % contentEncoding
+  headers = mimetools.Message(StringIO.StringIO(headers + '\r\n'))
+  return urllib.addinfourl(StringIO.StringIO(body), headers, 'http://example.org/feed')
+
+def measureMemory(function):
+  """Return how far calling function raised the peak memory use, in KB, and how many objects its result keeps alive.
+
+  The peak only ever goes up so it only shows growth the first time a benchmark needs more than anything before it."""
+  import resource
+
+  gc.collect()
+  objectsBefore = len(gc.get_objects())
+  peakBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  result = function()
+  peakGrowth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peakBefore
+  gc.collect()
+  objectsKept = len(gc.get_objects()) - objectsBefore
+  del result
+  return peakGrowth, objectsKept
+
+def reportThroughput(name, timings, numberOfBytes, numberOfItems, memory):
+  p50 = percentile(timings, 50)
+  seconds = max(p50, 0.001) / 1000
+  megabytesPerSecond = numberOfBytes / 1024.0 / 1024.0 / seconds
+  itemsPerSecond = numberOfItems / seconds
+  peakGrowth, objectsKept = memory
+  record(name, "p50: %8.2fms %7.2fMB/s %8.0f entries/s %6dKB peak growth %7d objects kept" %
+         (p50, megabytesPerSecond, itemsPerSecond, peakGrowth, objectsKept),
+         p50Ms=p50, p99Ms=percentile(timings, 99), runs=len(timings), bytes=numberOfBytes, entries=numberOfItems,
+         megabytesPerSecond=megabytesPerSecond, entriesPerSecond=itemsPerSecond, peakGrowthKB=peakGrowth,
+         objectsKept=objectsKept)
+
+def benchmarkCorpus(iterations=20):
+  """Throughput and memory use of each stage of ingestion for each feed in the checked-in corpus"""
+  import datetime
+  import feedparser
+  import pshb
+  import streamer
+  from webtest import TestApp
+
+  app = TestApp(streamer.application)
+  for name, body, contentEncoding, content in loadCorpus():
+    parse = lambda: feedparser.parse(httpResponse(body, contentEncoding))
+    data = parse()
+    entries = data.entries
+    reportThroughput("feedparser.parse %s" % name, timeCalls(parse, iterations), len(content), len(entries),
+                     measureMemory(parse))
+    if contentEncoding:
+      # The later stages only ever see the decoded content, which is the same as another feed's
+      continue
+
+    parser = pshb.ContentParser(content)
+    reportThroughput("ContentParser.extractPosts %s" % name, timeCalls(parser.extractPosts, iterations), len(content),
+                     len(entries), measureMemory(parser.extractPosts))
+
+    feedUrl = parser.extractFeedUrl()
+    now = datetime.datetime.utcnow()
+    def createPosts():
+      return [pshb.PostFactory.createPost(url=entry.get('link', ''), feedUrl=feedUrl, title=entry.get('title', ''),
+                                          content=entry.get('description', ''), datePublished=now,
+                                          author=entry.get('author', ''), entry=entry) for entry in entries]
+    reportThroughput("PostFactory.createPost %s" % name, timeCalls(createPosts, iterations), len(content),
+                     len(entries), measureMemory(createPosts))
+
+    # Every ping is stored in an empty datastore so that each one writes all of its posts
+    timings = []
+    for i in range(iterations):
+      setUpAppEngineStubs()
+      started = time.time()
+      app.post('/posts', content, headers={'Content-Type': 'application/atom+xml'})
+      timings.append((time.time() - started) * 1000)
+    setUpAppEngineStubs()
+    memory = measureMemory(lambda: app.post('/posts', content, headers={'Content-Type': 'application/atom+xml'}))
+    reportThroughput("PostsHandler.post %s" % name, timings, len(content), len(entries), memory)
+
+BENCHMARKS = [benchmarkPingLatency, benchmarkFrontPage, benchmarkPagination, benchmarkPostBodies,
+              benchmarkSubscriptionExists, benchmarkEntrySerialization, benchmarkDateParsing, benchmarkFeedParserDict,
+              benchmarkStreamingParse, benchmarkFeedMetadata, benchmarkContentProcessing, benchmarkPingReplay,
+              benchmarkRefresh, benchmarkCorpus]
+
+def benchmarkName(benchmark):
+  name = benchmark.__name__[len('benchmark'):]
+  return name[0].lower() + name[1:]
+
+def loadJson():
+  try:
+    import json
+  except ImportError:
+    from django.utils import simplejson as json
+  return json
+
+def writeResults(fileName):
+  results = {'commit': os.popen('git rev-parse HEAD 2>/dev/null').read().strip() or None,
+             'python': sys.version.split()[0],
+             'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+             'results': RESULTS}
+  out = open(fileName, 'w')
+  try:
+    loadJson().dump(results, out, indent=2, sort_keys=True)
+  finally:
+    out.close()
+
+def compareResults(fileName):
+  """Print how the p50 of each result that's also in the earlier results has changed"""
+  earlier = loadJson().load(open(fileName))
+  earlierResults = dict([(result['name'], result) for result in earlier['results']])
+  print "\nCompared with %s (commit %s)" % (fileName, earlier.get('commit'))
+  for result in RESULTS:
+    before = earlierResults.get(result['name'], {}).get('p50Ms')
+    if before and 'p50Ms' in result:
+      change = (result['p50Ms'] - before) / before * 100
+      print "%-50s p50: %8.2fms -> %8.2fms (%+.1f%%)" % (result['name'], before, result['p50Ms'], change)
+
+def main(argv):
+  optionParser = optparse.OptionParser(usage="%prog [--json FILE] [--compare FILE] [benchmark ...]")
+  optionParser.add_option("--json", dest="json", metavar="FILE", help="write the results to FILE as JSON")
+  optionParser.add_option("--compare", dest="compare", metavar="FILE", help="compare the results with those in FILE")
+  options, names = optionParser.parse_args(argv)
+  benchmarks = BENCHMARKS
+  if names:
+    benchmarks = [benchmark for benchmark in BENCHMARKS if benchmarkName(benchmark) in names]
+    unknown = [name for name in names if name not in map(benchmarkName, BENCHMARKS)]
+    if unknown:
+      optionParser.error("unknown benchmarks: %s. Choose from: %s" % (', '.join(unknown),
+                                                                       ', '.join(map(benchmarkName, BENCHMARKS))))
+  # Sampled metrics and anything else that's random happens the same way on every run
+  random.seed(0)
+  setUpAppEngineStubs()
+  for benchmark in benchmarks:
+    benchmark()
+  if options.json:
+    writeResults(options.json)
+  if options.compare:
+    compareResults(options.compare)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
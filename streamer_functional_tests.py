@@ -1,11 +1,18 @@
+import datetime
 import os
 import unittest
 
+from django.utils import simplejson
 from gaetestbed import FunctionalTestCase
 
+import cache
+import metrics
+import opml
+import pingcache
 import pshb
 import settings
 import streamer
+import streamer_tests
 
 # Set the environment so that tests which require admin privileges, and thus look up the user's email address, will pass
 # See: http://code.google.com/p/nose-gae/issues/detail?id=13 for more
@@ -72,6 +79,11 @@ class SubscriptionsHandlerTest(BaseSubscriptionHandlerTest):
 class PostsHandlerTest(FunctionalTestCase, unittest.TestCase):
   APPLICATION = streamer.application
 
+  def setUp(self):
+    super(PostsHandlerTest, self).setUp()
+    # Pings remembered by earlier tests would otherwise be ignored
+    pingcache.clear()
+
   def testCanShowPosts(self):
     response = self.get('/posts')
     self.assertOK(response)
@@ -94,6 +106,17 @@ class PostsHandlerTest(FunctionalTestCase, unittest.TestCase):
     self.assertOK(response)
     response.mustcontain(challenge)
 
+  def testRecordsWhenTheLeaseVerifiedByTheHubExpires(self):
+    url = "http://example.org/atom"
+    streamer.Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url).put()
+
+    before = datetime.datetime.utcnow()
+    response = self.get('/posts?hub.mode=subscribe&hub.topic=%s&hub.challenge=x&hub.lease_seconds=3600' % url)
+    self.assertOK(response)
+    leaseExpires = streamer.Subscription.get_by_key_name(url).leaseExpires
+    self.assertTrue(before + datetime.timedelta(seconds=3600) <= leaseExpires)
+    self.assertTrue(leaseExpires <= datetime.datetime.utcnow() + datetime.timedelta(seconds=3600))
+
   def testAcceptsHubChallengeForUnsubscriptionToDeletedFeed(self):
     # If the hub wants us to unsubscribe and we don't have the subscription then we should accept it
     url = "http://example.org/atom"
@@ -116,6 +139,124 @@ class PostsHandlerTest(FunctionalTestCase, unittest.TestCase):
     self.assertEquals('404 Not Found', response.status)
     response.mustcontain("Challenge failed for feed: %s with mode: %s" % (url, 'unsubscribe'))
 
+  def testStagesPingAndEnqueuesTaskWhenIngestingAsynchronously(self):
+    settings.ASYNC_INGEST = True
+    try:
+      self.assertTasksInQueue(0)
+      response = self.post('/posts', streamer_tests.SAMPLE_FEED, headers={'Content-Type': 'application/atom+xml'})
+      self.assertEquals('202 Accepted', response.status)
+      self.assertEquals(1, streamer.IncomingPing.all().count())
+      self.assertTasksInQueue(1)
+    finally:
+      settings.ASYNC_INGEST = False
+
+  def testAcknowledgesRepeatedPingWithoutIngestingItAgain(self):
+    response = self.post('/posts', streamer_tests.SAMPLE_FEED, headers={'Content-Type': 'application/atom+xml'})
+    response.mustcontain("Good entries")
+    pshb.Post.all().get().delete()
+    response = self.post('/posts', streamer_tests.SAMPLE_FEED, headers={'Content-Type': 'application/atom+xml'})
+    self.assertOK(response)
+    response.mustcontain("Duplicate")
+    self.assertEquals(1, pshb.Post.all().count())
+
+  def testAnswersConditionalRequestForUnchangedFrontPage(self):
+    cache.invalidate()
+    response = self.get('/posts')
+    etag = response.headers['ETag']
+    response = self.get('/posts', headers={'If-None-Match': etag})
+    self.assertEquals('304 Not Modified', response.status)
+    self.assertEquals('', response.body)
+
+  def testStoringNewPostsChangesFrontPage(self):
+    cache.invalidate()
+    response = self.get('/posts')
+    etag = response.headers['ETag']
+    self.post('/posts', streamer_tests.SAMPLE_FEED, headers={'Content-Type': 'application/atom+xml'})
+    response = self.get('/posts', headers={'If-None-Match': etag})
+    self.assertOK(response)
+    self.assertNotEquals(etag, response.headers['ETag'])
+    response.mustcontain("First entry")
+
+  def testRejectsInvalidCursor(self):
+    response = self.get('/posts?cursor=not-a-cursor', expect_errors=True)
+    self.assertEquals('400 Bad Request', response.status)
+
+class ArchiveHandlerTest(FunctionalTestCase, unittest.TestCase):
+  APPLICATION = streamer.application
+
+  def setUp(self):
+    super(ArchiveHandlerTest, self).setUp()
+    # Pings remembered by earlier tests would otherwise be ignored
+    pingcache.clear()
+
+  def testShowsPostsPublishedThatDayWithLinksToAdjacentDays(self):
+    self.post('/posts', streamer_tests.SAMPLE_FEED, headers={'Content-Type': 'application/atom+xml'})
+    response = self.get('/archive/2010/02/28')
+    self.assertOK(response)
+    response.mustcontain("Second entry", "/archive/2010/02/27")
+    self.assertFalse("First entry" in response.body)
+
+  def testRejectsDaysThatDontExist(self):
+    response = self.get('/archive/2010/02/30', expect_errors=True)
+    self.assertEquals('404 Not Found', response.status)
+
+class AtomHandlerTest(FunctionalTestCase, unittest.TestCase):
+  APPLICATION = streamer.application
+
+  def setUp(self):
+    super(AtomHandlerTest, self).setUp()
+    # Pings remembered by earlier tests would otherwise be ignored
+    pingcache.clear()
+
+  def testShowsNewPostsAsAtom(self):
+    self.post('/posts', streamer_tests.SAMPLE_FEED, headers={'Content-Type': 'application/atom+xml'})
+    response = self.get('/atom')
+    self.assertOK(response)
+    self.assertTrue(response.headers['Content-Type'].startswith('application/atom+xml'))
+    response.mustcontain('<feed xmlns="http://www.w3.org/2005/Atom">', "tag:example.org,2010:entry-2")
+
+  def testStoringPostsSchedulesOnePublishToTheHub(self):
+    self.assertTasksInQueue(0)
+    self.post('/posts', streamer_tests.SAMPLE_FEED, headers={'Content-Type': 'application/atom+xml'})
+    self.post('/posts', streamer_tests.SAMPLE_FEED.replace('Second content', 'Edited'), headers={'Content-Type': 'application/atom+xml'})
+    self.assertTasksInQueue(1)
+
+class OpmlHandlerTest(BaseSubscriptionHandlerTest):
+  APPLICATION = streamer.application
+
+  def testImportEnqueuesTasksForNewFeeds(self):
+    document = '<opml version="1.1"><body><outline text="A" xmlUrl="http://example.org/atom"/></body></opml>'
+    self.assertTasksInQueue(0)
+    response = self.post('/admin/importOpml', document, headers={'Content-Type': 'text/x-opml'})
+    self.assertTasksInQueue(1)
+    self.assertOKAfterRedirect(response, "<title>Subscriptions</title>")
+
+  def testRejectsMalformedImport(self):
+    response = self.post('/admin/importOpml', '<opml>', headers={'Content-Type': 'text/x-opml'}, expect_errors=True)
+    self.assertEquals('400 Bad Request', response.status)
+
+  def testExportsEverySubscription(self):
+    url = "http://example.org/atom"
+    streamer.Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url).put()
+    response = self.get('/opml')
+    self.assertOK(response)
+    self.assertEquals([url], opml.parseFeedUrls(response.body))
+
+class AdminMetricsHandlerTest(BaseSubscriptionHandlerTest):
+  APPLICATION = streamer.application
+
+  def testShowsTimingsPage(self):
+    response = self.get('/admin/metrics')
+    self.assertOK(response)
+    response.mustcontain("<title>Metrics</title>", "parse.sax")
+
+  def testServesTimingsAsJson(self):
+    response = self.get('/admin/metrics.json?feed=http://example.org/atom')
+    self.assertOK(response)
+    data = simplejson.loads(response.body)
+    self.assertEquals("http://example.org/atom", data['feedUrl'])
+    self.assertEquals(metrics.TIMED_PHASES, [timing['phase'] for timing in data['timings']])
+
 class AboutHandlerTest(FunctionalTestCase, unittest.TestCase):
   APPLICATION = streamer.application
 
@@ -131,14 +272,14 @@ class AdminRefreshSubscriptionsHandlerTest(BaseSubscriptionHandlerTest):
     response = self.get('/admin/refreshSubscriptions')
     self.assertOKAfterRedirect(response, '<title>Subscriptions</title>')
 
-  def testEnqueuesTaskPerSubscription(self):
+  def testEnqueuesSingleTaskToScheduleRefresh(self):
     self.assertTasksInQueue(0)
     for i in range(5):
       url = "http://example.org/atom" + str(i)
       f = streamer.Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url)
       f.put()
     self.get('/admin/refreshSubscriptions')
-    self.assertTasksInQueue(streamer.Subscription.all().count())
+    self.assertTasksInQueue(1)
 
 class AdminAddSubscriptionHandlerTest(FunctionalTestCase, unittest.TestCase):
   APPLICATION = streamer.application
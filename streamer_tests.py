@@ -1,11 +1,52 @@
+from google.appengine.ext import db
 from pshb import ContentParser, Post, PostFactory
 from streamer import Subscription
 
+import BaseHTTPServer
+import aggregates
+import atomfeed
+import cache
+import cgi
 import datetime
+import entrycodec
 import feedparser
+import hashlib
+import hmac
+import metrics
+import opml
+import pingcache
 import pshb
+import settings
 import streamer
+import threading
+import time
 import unittest
+import zlib
+
+SAMPLE_FEED = """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Example Feed</title>
+  <link rel="self" href="http://example.org/atom"/>
+  <link rel="alternate" href="http://example.org/"/>
+  <link rel="hub" href="http://hub.example.org/"/>
+  <id>tag:example.org,2010:feed</id>
+  <updated>2010-02-28T12:00:00Z</updated>
+  <author><name>Example Author</name></author>
+  <entry>
+    <title>First entry</title>
+    <link rel="alternate" href="http://example.org/entries/1"/>
+    <id>tag:example.org,2010:entry-1</id>
+    <updated>2010-02-27T12:00:00Z</updated>
+    <content type="html">First content</content>
+  </entry>
+  <entry>
+    <title>Second entry</title>
+    <link rel="alternate" href="http://example.org/entries/2"/>
+    <id>tag:example.org,2010:entry-2</id>
+    <updated>2010-02-28T12:00:00Z</updated>
+    <content type="html">Second content</content>
+  </entry>
+</feed>"""
 
 class StubHubSubscriber(pshb.HubSubscriber):
   def unsubscribe(self, url, hub, callback_url):
@@ -13,6 +54,58 @@ class StubHubSubscriber(pshb.HubSubscriber):
     self.hub = hub
     self.callback_url = callback_url
 
+  subscribe = unsubscribe
+
+class RecordingHubSubscriber(pshb.HubSubscriber):
+  """Records the feeds it's asked to subscribe to and whether they were sent to the hubs"""
+
+  def __init__(self):
+    self.subscribed = []
+    self.flushed = False
+
+  def subscribe(self, url, hub, callback_url):
+    self.subscribed.append(url)
+
+  def flush(self):
+    self.flushed = True
+
+class StubResponse(object):
+  def __init__(self, content, status_code=200):
+    self.content = content
+    self.status_code = status_code
+    self.headers = {}
+
+class StubHubServer(object):
+  """A hub listening on localhost that answers each request with the next of the given statuses and then with 202"""
+
+  def __init__(self, statuses=[]):
+    self.statuses = list(statuses)
+    self.requests = []
+    hub = self
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length')))
+        hub.requests.append(cgi.parse_qs(body))
+        status = 202
+        if hub.statuses:
+          status = hub.statuses.pop(0)
+        self.send_response(status)
+        self.end_headers()
+
+      def log_message(self, format, *args):
+        pass
+    self.server = BaseHTTPServer.HTTPServer(('localhost', 0), Handler)
+    self.url = 'http://localhost:%d/' % self.server.server_address[1]
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+
+class StubHubPublisher(pshb.HubPublisher):
+  def publish(self, hub, urls):
+    self.hub = hub
+    self.urls = urls
+    return True
+
 class SubscriptionTest(unittest.TestCase):
   def setUp(self):
     subscriptions = Subscription.all()
@@ -48,6 +141,33 @@ class SubscriptionTest(unittest.TestCase):
     Subscription.deleteSubscriptionWithMatchingUrl(url)
     self.assertFalse(Subscription.exists(url))
 
+  def testRemembersValidatorsAndCountsBytesSavedByUnchangedFeeds(self):
+    s = Subscription(url="http://example.org/atom", hub="http://hub.example.org/", sourceUrl="http://example.org/")
+    parser = ContentParser(SAMPLE_FEED)
+    parser.etag = '"1"'
+    s.rememberFetch(parser)
+    self.assertEquals('"1"', s.etag)
+    self.assertEquals(len(SAMPLE_FEED), s.contentLength)
+
+    bytesSaved = metrics.get('fetch.bytesSaved')
+    parser.notModified = True
+    s.rememberFetch(parser)
+    self.assertEquals(bytesSaved + len(SAMPLE_FEED), metrics.get('fetch.bytesSaved'))
+
+  def testExistenceStaysCorrectAsSubscriptionsAreAddedAndDeleted(self):
+    url = "http://example.org/atom"
+    self.assertFalse(Subscription.exists(url))
+    Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url).put()
+    self.assertTrue(Subscription.exists(url))
+    Subscription.deleteSubscriptionWithMatchingUrl(url)
+    self.assertFalse(Subscription.exists(url))
+
+  def testUsesDefaultMicroformatsSettingUnlessOverridden(self):
+    s = Subscription(url="http://example.org/atom", hub="http://hub.example.org/", sourceUrl="http://example.org/")
+    self.assertEquals(settings.PARSE_MICROFORMATS, s.shouldParseMicroformats())
+    s.parseMicroformats = not settings.PARSE_MICROFORMATS
+    self.assertEquals(not settings.PARSE_MICROFORMATS, s.shouldParseMicroformats())
+
 class BackgroundHandlerTest(unittest.TestCase):
   def testCanDeleteFeed(self):
     url = "http://example.org/atom"
@@ -67,4 +187,763 @@ class BackgroundHandlerTest(unittest.TestCase):
     streamer.handleDeleteSubscription(url, hubSubscriber=hubSubscriber)
     self.assertEquals(url, hubSubscriber.url)
     self.assertEquals(hub, hubSubscriber.hub)
-    self.assertEquals('http://streamer-ade.appspot.com/posts', hubSubscriber.callback_url)
\ No newline at end of file
+    self.assertEquals('http://streamer-ade.appspot.com/posts', hubSubscriber.callback_url)
+
+  def testRefreshBatchesAreStaggeredPerHub(self):
+    subscriptions = []
+    for i in range(25):
+      url = "http://example.org/atom" + str(i)
+      subscriptions.append(Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/"))
+    subscriptions.append(Subscription(url="http://example.com/atom", hub="http://hub.example.com/", sourceUrl="http://example.com/"))
+
+    batches = streamer.planRefreshBatches(subscriptions, {})
+    countdowns = [countdown for countdown, urls in batches]
+    self.assertEquals(26, sum([len(urls) for countdown, urls in batches]))
+    # 3 batches for the busy hub all fit in its first interval as does the single batch for the other hub
+    self.assertEquals([0, 0, 0, 0], countdowns)
+
+    batchesPerHub = {"http://hub.example.org/": settings.REFRESH_HUB_CONCURRENCY}
+    batches = streamer.planRefreshBatches(subscriptions[:1], batchesPerHub)
+    self.assertEquals([(settings.REFRESH_HUB_INTERVAL_SECONDS, ["http://example.org/atom0"])], batches)
+
+  def testImportBatchesAreStaggeredPerHost(self):
+    urls = ["http://example.org/feeds/%d" % i for i in range(12)] + ["http://example.com/feed"]
+    batches = streamer.planImportBatches(urls)
+    self.assertEquals(13, sum([len(batch) for countdown, batch in batches]))
+    countdowns = [countdown for countdown, batch in batches if batch[0].startswith("http://example.org/")]
+    interval = settings.IMPORT_HOST_INTERVAL_SECONDS
+    expected = [(i // settings.IMPORT_HOST_CONCURRENCY) * interval for i in range(len(countdowns))]
+    self.assertEquals(expected, countdowns)
+    self.assertEquals([(0, ["http://example.com/feed"])], [b for b in batches if b[1][0].startswith("http://example.com/")])
+
+  def testRenewsOnlyAShareOfTheLeasesDueUnlessTheyAreAboutToExpire(self):
+    now = datetime.datetime(2010, 3, 1, 12, 0, 0)
+    interval = datetime.timedelta(seconds=settings.LEASE_RENEWAL_INTERVAL_SECONDS)
+    subscriptions = []
+    for i in range(300):
+      subscriptions.append(Subscription(url="http://example.org/atom%d" % i, hub="http://hub.example.org/",
+                                        sourceUrl="http://example.org/", leaseExpires=now + 10 * interval))
+    runsInWindow = settings.LEASE_RENEWAL_WINDOW_SECONDS // settings.LEASE_RENEWAL_INTERVAL_SECONDS
+    expectedShare = (300 + runsInWindow - 1) // runsInWindow
+    self.assertEquals(subscriptions[:expectedShare], streamer.planLeaseRenewals(subscriptions, now))
+
+    for subscription in subscriptions[:50]:
+      subscription.leaseExpires = now + interval
+    self.assertEquals(subscriptions[:50], streamer.planLeaseRenewals(subscriptions, now))
+
+  def testDoesNotRenewLeasesWhoseRenewalWasJustRequested(self):
+    now = datetime.datetime(2010, 3, 1, 12, 0, 0)
+    s = Subscription(url="http://example.org/atom", hub="http://hub.example.org/", sourceUrl="http://example.org/",
+                     leaseExpires=now, leaseRenewalRequested=now - datetime.timedelta(minutes=1))
+    self.assertEquals([], streamer.planLeaseRenewals([s], now))
+    s.leaseRenewalRequested = now - datetime.timedelta(seconds=settings.LEASE_RENEWAL_RETRY_SECONDS + 1)
+    self.assertEquals([s], streamer.planLeaseRenewals([s], now))
+
+  def testGivesSubscriptionsWithoutALeaseOneThatIsRenewedWithinTheWindow(self):
+    db.delete(Subscription.all(keys_only=True).fetch(1000))
+    leaseExpires = datetime.datetime.utcnow() + datetime.timedelta(days=30)
+    Subscription(url="http://example.org/leased", hub="http://hub.example.org/", sourceUrl="http://example.org/",
+                 key_name="http://example.org/leased", leaseExpires=leaseExpires).put()
+    Subscription(url="http://example.org/atom", hub="http://hub.example.org/", sourceUrl="http://example.org/",
+                 key_name="http://example.org/atom").put()
+    self.assertEquals(None, Subscription.backfillLeases())
+    self.assertEquals(leaseExpires, Subscription.get_by_key_name("http://example.org/leased").leaseExpires)
+    now = datetime.datetime.utcnow()
+    window = datetime.timedelta(seconds=settings.LEASE_RENEWAL_WINDOW_SECONDS + settings.LEASE_RENEWAL_INTERVAL_SECONDS)
+    due = Subscription.all().filter('leaseExpires <', now + window).fetch(10)
+    self.assertEquals(["http://example.org/atom"], [subscription.url for subscription in due])
+
+  def testImportOnlySubscribesToNewFeeds(self):
+    url = "http://example.org/atom"
+    Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url).put()
+    self.assertEquals(1, streamer.importSubscriptions([url, "http://example.org/new", "ftp://example.org/feed"], 'ade'))
+
+  def testDeletingPostsRecordsProgressUntilTheyAreAllGone(self):
+    db.delete(Post.all(keys_only=True).fetch(1000))
+    db.put(ContentParser(SAMPLE_FEED).extractPosts())
+    batchSize, timeBudget = settings.DELETE_BATCH_SIZE, settings.DELETE_TIME_BUDGET_SECONDS
+    settings.DELETE_BATCH_SIZE, settings.DELETE_TIME_BUDGET_SECONDS = 1, 0
+    try:
+      streamer.handleDeletePosts('http://example.org/atom')
+      self.assertEquals(1, streamer.DeletionJob.get_by_key_name('http://example.org/atom').postsDeleted)
+      streamer.handleDeletePosts('http://example.org/atom')
+      streamer.handleDeletePosts('http://example.org/atom')
+    finally:
+      settings.DELETE_BATCH_SIZE, settings.DELETE_TIME_BUDGET_SECONDS = batchSize, timeBudget
+    self.assertEquals(0, Post.all().count())
+    self.assertEquals(None, streamer.DeletionJob.get_by_key_name('http://example.org/atom'))
+
+  def testRetryingAFailedDeletionStillUnsubscribesAndDeletesThePosts(self):
+    url = "http://example.org/atom"
+    db.delete(streamer.DeletionJob.all(keys_only=True).fetch(1000))
+    Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url).put()
+    class FailingHubSubscriber(pshb.HubSubscriber):
+      def unsubscribe(self, url, hub, callback_url):
+        raise pshb.urlfetch.DownloadError("Deadline exceeded")
+    self.assertRaises(pshb.urlfetch.DownloadError, streamer.handleDeleteSubscription, url, FailingHubSubscriber())
+    self.assertEquals("http://hub.example.org/", streamer.DeletionJob.get_by_key_name(url).hub)
+
+    hubSubscriber = StubHubSubscriber()
+    streamer.handleDeleteSubscription(url, hubSubscriber=hubSubscriber)
+    self.assertEquals("http://hub.example.org/", hubSubscriber.hub)
+
+class NewSubscriptionTest(unittest.TestCase):
+  def setUp(self):
+    db.delete(Subscription.all(keys_only=True).fetch(1000))
+    self.fetch = pshb.urlfetch.fetch
+    pshb.urlfetch.fetch = lambda url, headers=None: StubResponse(SAMPLE_FEED)
+
+  def tearDown(self):
+    pshb.urlfetch.fetch = self.fetch
+
+  def testReAddingAChangedFeedKeepsItsOwnSettings(self):
+    url = "http://example.org/atom"
+    Subscription(url=url, hub="http://old-hub.example.org/", sourceUrl="http://example.org/", key_name=url,
+                 parseMicroformats=not settings.PARSE_MICROFORMATS).put()
+    dateAdded = Subscription.get_by_key_name(url).dateAdded
+    streamer.handleNewSubscription(url, 'ade', hubSubscriber=StubHubSubscriber())
+    subscription = Subscription.get_by_key_name(url)
+    self.assertEquals("http://hub.example.org/", subscription.hub)
+    self.assertEquals('ade', subscription.subscriber)
+    self.assertEquals(not settings.PARSE_MICROFORMATS, subscription.parseMicroformats)
+    self.assertEquals(dateAdded, subscription.dateAdded)
+
+  def testReAddingAChangedFeedKeepsItsLease(self):
+    url = "http://example.org/atom"
+    leaseExpires = datetime.datetime(2010, 3, 7, 12, 0, 0)
+    renewalRequested = datetime.datetime(2010, 3, 6, 12, 0, 0)
+    Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url,
+                 leaseExpires=leaseExpires, leaseRenewalRequested=renewalRequested,
+                 parseMicroformats=not settings.PARSE_MICROFORMATS).put()
+    streamer.handleNewSubscription(url, 'ade', hubSubscriber=StubHubSubscriber())
+    subscription = Subscription.get_by_key_name(url)
+    self.assertEquals(leaseExpires, subscription.leaseExpires)
+    self.assertEquals(renewalRequested, subscription.leaseRenewalRequested)
+    self.assertEquals(not settings.PARSE_MICROFORMATS, subscription.parseMicroformats)
+
+  def testNewFeedHasALeaseBeforeTheHubVerifiesIt(self):
+    url = "http://example.org/atom"
+    streamer.handleNewSubscription(url, 'ade', hubSubscriber=StubHubSubscriber())
+    self.assertTrue(Subscription.get_by_key_name(url).leaseExpires > datetime.datetime.utcnow())
+
+  def testOneFeedFailingDoesntStopTheRestOfTheBatch(self):
+    def fetch(url, headers=None):
+      if url == "http://example.org/broken":
+        raise pshb.urlfetch.DownloadError("Deadline exceeded")
+      return StubResponse(SAMPLE_FEED)
+    pshb.urlfetch.fetch = fetch
+    hubSubscriber = RecordingHubSubscriber()
+    streamer.handleNewSubscriptions(["http://example.org/broken", "http://example.org/atom"], 'ade', hubSubscriber)
+    self.assertEquals(["http://example.org/atom"], hubSubscriber.subscribed)
+    self.assertTrue(hubSubscriber.flushed)
+    self.assertEquals(None, Subscription.get_by_key_name("http://example.org/broken"))
+
+  def testOneFeedFailingDoesntStopTheRestOfARefresh(self):
+    def fetch(url, headers=None):
+      if url == "http://example.org/broken":
+        raise pshb.urlfetch.DownloadError("Deadline exceeded")
+      return StubResponse(SAMPLE_FEED)
+    pshb.urlfetch.fetch = fetch
+    for url in ["http://example.org/broken", "http://example.org/atom"]:
+      Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url).put()
+    hubSubscriber = RecordingHubSubscriber()
+    streamer.handleRefreshSubscriptions(["http://example.org/broken", "http://example.org/atom"], hubSubscriber)
+    self.assertEquals(["http://example.org/atom"], hubSubscriber.subscribed)
+    self.assertTrue(hubSubscriber.flushed)
+
+class BatchHubSubscriberTest(unittest.TestCase):
+  def testSendsQueuedRequestsWhenFlushed(self):
+    hub = StubHubServer()
+    subscriber = pshb.BatchHubSubscriber(concurrency=2)
+    for i in range(5):
+      subscriber.subscribe("http://example.org/feeds/%d" % i, hub.url, "http://example.org/posts")
+    self.assertEquals(0, len(hub.requests))
+    stats = subscriber.flush()
+    self.assertEquals(5, len(hub.requests))
+    self.assertEquals(['subscribe'], hub.requests[0]['hub.mode'])
+    self.assertEquals(5, stats[hub.url].requests)
+    self.assertEquals(0.0, stats[hub.url].errorRate())
+
+  def testRetriesTransientFailures(self):
+    hub = StubHubServer([503, 503])
+    subscriber = pshb.BatchHubSubscriber(maxAttempts=3, backoffSeconds=0)
+    subscriber.unsubscribe("http://example.org/atom", hub.url, "http://example.org/posts")
+    stats = subscriber.flush()[hub.url]
+    self.assertEquals(3, len(hub.requests))
+    self.assertEquals(2, stats.retries)
+    self.assertEquals(0, stats.errors)
+
+  def testGivesUpOnPermanentFailures(self):
+    hub = StubHubServer([404])
+    subscriber = pshb.BatchHubSubscriber(backoffSeconds=0)
+    subscriber.subscribe("http://example.org/atom", hub.url, "http://example.org/posts")
+    stats = subscriber.flush()[hub.url]
+    self.assertEquals(1, len(hub.requests))
+    self.assertEquals(1, stats.errors)
+    self.assertEquals(1.0, stats.errorRate())
+
+class OpmlTest(unittest.TestCase):
+  def testFindsFeedUrlsInNestedOutlinesWithoutRepeats(self):
+    document = """<opml version="1.1"><body>
+      <outline text="Tech">
+        <outline text="A" xmlUrl="http://a.example.org/feed"/>
+        <outline text="B" xmlurl="http://b.example.org/feed"/>
+      </outline>
+      <outline text="A again" xmlUrl="http://a.example.org/feed"/>
+      <outline text="Folder without a feed"/>
+    </body></opml>"""
+    self.assertEquals(["http://a.example.org/feed", "http://b.example.org/feed"], opml.parseFeedUrls(document))
+
+  def testRejectsMalformedDocuments(self):
+    self.assertRaises(opml.OpmlError, opml.parseFeedUrls, "<opml><body>")
+
+class SignatureTest(unittest.TestCase):
+  def testAcceptsMatchingSignature(self):
+    signature = 'sha1=' + hmac.new('secret', SAMPLE_FEED, hashlib.sha1).hexdigest()
+    self.assertTrue(pshb.signatureValid(SAMPLE_FEED, signature, 'secret'))
+
+  def testRejectsSignatureMadeWithDifferentSecret(self):
+    signature = 'sha1=' + hmac.new('other secret', SAMPLE_FEED, hashlib.sha1).hexdigest()
+    self.assertFalse(pshb.signatureValid(SAMPLE_FEED, signature, 'secret'))
+
+  def testRejectsMissingSignature(self):
+    self.assertFalse(pshb.signatureValid(SAMPLE_FEED, None, 'secret'))
+
+  def testRejectsSignatureWithoutAlgorithmOrOfTheWrongLength(self):
+    digest = hmac.new('secret', SAMPLE_FEED, hashlib.sha1).hexdigest()
+    self.assertFalse(pshb.signatureValid(SAMPLE_FEED, digest, 'secret'))
+    self.assertFalse(pshb.signatureValid(SAMPLE_FEED, 'sha1=' + digest[:-1], 'secret'))
+
+class IncomingPingTest(unittest.TestCase):
+  def testIngestingStagedPingStoresPostsAndDiscardsPing(self):
+    ping = streamer.IncomingPing(body=db.Blob(zlib.compress(SAMPLE_FEED)))
+    ping.put()
+
+    streamer.handleIncomingPing(str(ping.key()))
+    self.assertTrue(Post.get_by_key_name('tag:example.org,2010:entry-1'))
+    self.assertTrue(Post.get_by_key_name('tag:example.org,2010:entry-2'))
+    self.assertFalse(streamer.IncomingPing.get(ping.key()))
+
+  def testIngestingLargePingStoresPostsInChunks(self):
+    oldThreshold, oldChunkSize = settings.STREAMING_INGEST_BYTES, settings.INGEST_CHUNK_SIZE
+    settings.STREAMING_INGEST_BYTES, settings.INGEST_CHUNK_SIZE = 0, 1
+    try:
+      self.assertEquals((200, "Good entries"), streamer.ingestContent(SAMPLE_FEED))
+    finally:
+      settings.STREAMING_INGEST_BYTES, settings.INGEST_CHUNK_SIZE = oldThreshold, oldChunkSize
+    self.assertTrue(Post.get_by_key_name('tag:example.org,2010:entry-1'))
+    self.assertTrue(Post.get_by_key_name('tag:example.org,2010:entry-2'))
+
+  def testParsesPingsForFeedsWithTheirOwnMicroformatsSettingLikeRefreshesDo(self):
+    url = "http://example.org/atom"
+    Subscription(url=url, hub="http://hub.example.org/", sourceUrl="http://example.org/", key_name=url,
+                 parseMicroformats=not settings.PARSE_MICROFORMATS).put()
+    parsedWith = []
+    contentParser = pshb.ContentParser
+    class RecordingContentParser(contentParser):
+      def __init__(self, *args, **kwargs):
+        contentParser.__init__(self, *args, **kwargs)
+        parsedWith.append(kwargs.get('microformats'))
+    pshb.ContentParser = RecordingContentParser
+    oldThreshold = settings.STREAMING_INGEST_BYTES
+    try:
+      streamer.ingestContent(SAMPLE_FEED)
+      self.assertEquals(not settings.PARSE_MICROFORMATS, parsedWith[-1])
+      settings.STREAMING_INGEST_BYTES = 0
+      self.assertEquals((200, "Good entries"), streamer.ingestContent(SAMPLE_FEED))
+      self.assertEquals(not settings.PARSE_MICROFORMATS, parsedWith[-1])
+    finally:
+      pshb.ContentParser = contentParser
+      settings.STREAMING_INGEST_BYTES = oldThreshold
+      Subscription.get_by_key_name(url).delete()
+
+  def testIngestingPingThatWasAlreadyIngestedDoesNothing(self):
+    ping = streamer.IncomingPing(body=db.Blob(zlib.compress(SAMPLE_FEED)))
+    ping.put()
+    key = str(ping.key())
+    ping.delete()
+
+    streamer.handleIncomingPing(key)
+    self.assertFalse(Post.get_by_key_name('tag:example.org,2010:entry-1'))
+
+  def testDiscardsPingThatStillCantBeIngestedOnTheLastRetry(self):
+    ping = streamer.IncomingPing(body=db.Blob('not zlib data'))
+    ping.put()
+
+    self.assertRaises(Exception, streamer.handleIncomingPing, str(ping.key()), settings.MAX_TASK_RETRIES - 1)
+    self.assertTrue(streamer.IncomingPing.get(ping.key()))
+    streamer.handleIncomingPing(str(ping.key()), settings.MAX_TASK_RETRIES)
+    self.assertFalse(streamer.IncomingPing.get(ping.key()))
+
+class EntryCodecTest(unittest.TestCase):
+  def testRoundTripsFeedParserEntries(self):
+    entry = feedparser.parse(SAMPLE_FEED).entries[0]
+    decoded = entrycodec.decode(entrycodec.encode(entry))
+    self.assertEquals(entry, decoded)
+    self.assertEquals('First entry', decoded.title)
+    self.assertTrue(isinstance(decoded.updated_parsed, time.struct_time))
+
+  def testRoundTripsAllSupportedTypes(self):
+    value = {'none': None, 'bool': True, 'int': -42, 'float': 1.5, 'str': 'abc', 'unicode': u'\u00e9t\u00e9',
+             'list': [1, [2, 3]], 'tuple': (4, 5), u'caf\u00e9': {'nested': 'x' * 1000}}
+    self.assertEquals(value, entrycodec.decode(entrycodec.encode(value)))
+
+  def testLazyEntryOnlyDecodesRequestedFields(self):
+    entry = feedparser.parse(SAMPLE_FEED).entries[0]
+    lazyEntry = entrycodec.LazyEntry(entrycodec.encode(entry))
+    self.assertEquals('First entry', lazyEntry['title'])
+    self.assertEquals(['title'], lazyEntry.decoded.keys())
+    self.assertEquals(None, lazyEntry.get('no such field'))
+
+  def testLazyEntryListsItsFieldsLikeADictionary(self):
+    entry = feedparser.parse(SAMPLE_FEED).entries[0]
+    lazyEntry = entrycodec.LazyEntry(entrycodec.encode(entry))
+    self.assertEquals(sorted(entry.keys()), sorted(lazyEntry.keys()))
+    self.assertTrue(lazyEntry.has_key('title'))
+    self.assertFalse(lazyEntry.has_key('no such field'))
+    self.assertEquals({}, lazyEntry.decoded)
+
+  def testRejectsUnknownVersions(self):
+    encoded = entrycodec.encode({'title': 'x'})
+    self.assertRaises(entrycodec.CodecError, entrycodec.decode, chr(99) + encoded[1:])
+
+class CacheTest(unittest.TestCase):
+  def setUp(self):
+    cache.invalidate()
+
+  def testMatchesOnlyItsOwnETag(self):
+    page = cache.CachedPage('<html></html>')
+    self.assertTrue(page.matches(page.etag))
+    self.assertTrue(page.matches('"other", %s' % page.etag))
+    self.assertTrue(page.matches('*'))
+    self.assertFalse(page.matches('"other"'))
+    self.assertFalse(page.matches(None))
+
+  def testKeepsPagesTooBigForMemcacheInProcess(self):
+    key = cache.pageKey('atom')
+    cache.set(key, cache.CachedPage('x' * (2 * 1024 * 1024)))
+    self.assertEquals(2 * 1024 * 1024, len(cache.get(key).body))
+
+  def testKeepsPageWhenStoredPostsAreTooOldToBeShown(self):
+    posts = ContentParser(SAMPLE_FEED).extractPosts()
+    key = cache.pageKey('front')
+    cache.set(key, cache.CachedPage('<html></html>', datetime.datetime(2010, 3, 1)))
+    cache.invalidateIfShown(['front'], posts)
+    self.assertEquals(key, cache.pageKey('front'))
+    self.assertNotEquals(None, cache.get(key))
+
+  def testIgnoresPagesThatAreNotCached(self):
+    posts = ContentParser(SAMPLE_FEED).extractPosts()
+    key = cache.pageKey('front')
+    cache.set(key, cache.CachedPage('<html></html>', datetime.datetime(2010, 3, 1)))
+    cache.invalidateIfShown(['front', 'front:admin', 'atom'], posts)
+    self.assertEquals(key, cache.pageKey('front'))
+    self.assertNotEquals(None, cache.get(key))
+
+  def testInvalidatesPageWhenStoredPostsAreNewEnoughToBeShown(self):
+    posts = ContentParser(SAMPLE_FEED).extractPosts()
+    key = cache.pageKey('front')
+    cache.set(key, cache.CachedPage('<html></html>', datetime.datetime(2010, 2, 28)))
+    cache.invalidateIfShown(['front'], posts)
+    self.assertNotEquals(key, cache.pageKey('front'))
+    self.assertEquals(None, cache.get(cache.pageKey('front')))
+
+class MetricsTest(unittest.TestCase):
+  def setUp(self):
+    self.sampleRate = settings.METRICS_SAMPLE_RATE
+    settings.METRICS_SAMPLE_RATE = 1
+
+  def tearDown(self):
+    settings.METRICS_SAMPLE_RATE = self.sampleRate
+
+  def histogram(self, phase, feedUrl=None):
+    return [h for h in metrics.getHistograms(feedUrl) if h.phase == phase][0]
+
+  def testCountsTimingsOverallAndForTheFeedInTheRightBucket(self):
+    url = "http://example.org/atom"
+    before = self.histogram('put')
+    beforeForFeed = self.histogram('put', url)
+    metrics.recordTiming('put', 0.015, url)
+    after = self.histogram('put')
+    afterForFeed = self.histogram('put', url)
+    self.assertEquals(before.count + 1, after.count)
+    self.assertEquals(beforeForFeed.count + 1, afterForFeed.count)
+    self.assertEquals(beforeForFeed.totalMs + 15, afterForFeed.totalMs)
+    self.assertEquals(dict(beforeForFeed.buckets)['<=20ms'] + 1, dict(afterForFeed.buckets)['<=20ms'])
+
+  def testProfilesThatArentSampledRecordNothing(self):
+    profile = metrics.Profile(sampleRate=0)
+    self.assertEquals(3, profile.call('put', lambda x: x + 1, 2))
+    self.assertEquals({}, profile.timings)
+
+  def testProfiledIngestTimesEachParsePhaseForTheFeed(self):
+    url = "http://example.org/feeds/profiled"
+    before = self.histogram('parse.sax', url).count
+    beforeContentParser = self.histogram('contentParser', url).count
+    def ingest():
+      metrics.setProfileFeed(url)
+      parser = metrics.timed('contentParser', ContentParser, SAMPLE_FEED)
+      return metrics.timed('extractPosts', parser.extractPosts)
+    self.assertEquals(2, len(metrics.profiled(ingest)()))
+    self.assertEquals(before + 1, self.histogram('parse.sax', url).count)
+    self.assertEquals(beforeContentParser + 1, self.histogram('contentParser', url).count)
+
+  def testWorksOutHitRatesFromHitsAndMisses(self):
+    counters = {'a.hits': 3, 'a.misses': 1, 'b.hits': 0, 'b.misses': 0, 'c.hits': 0, 'c.misses': 2}
+    self.assertEquals({'a': 0.75, 'b': None, 'c': 0.0}, metrics.hitRates(['a', 'b', 'c'], counters))
+
+class PingCacheTest(unittest.TestCase):
+  def setUp(self):
+    pingcache.clear()
+    self.cacheSize = settings.PING_DIGEST_CACHE_SIZE
+
+  def tearDown(self):
+    settings.PING_DIGEST_CACHE_SIZE = self.cacheSize
+
+  def testRecognisesPingsThatHaveBeenIngested(self):
+    pingDigest = pingcache.digest(SAMPLE_FEED + 'ingested')
+    hits = metrics.get('pingDigests.hits')
+    misses = metrics.get('pingDigests.misses')
+    self.assertFalse(pingcache.seen(pingDigest))
+    pingcache.remember(pingDigest)
+    self.assertTrue(pingcache.seen(pingDigest))
+    self.assertEquals(hits + 1, metrics.get('pingDigests.hits'))
+    self.assertEquals(misses + 1, metrics.get('pingDigests.misses'))
+
+  def testOtherInstancesRecogniseIngestedPingsThroughMemcache(self):
+    pingDigest = pingcache.digest(SAMPLE_FEED + 'elsewhere')
+    pingcache.remember(pingDigest)
+    pingcache.clear()
+    self.assertTrue(pingcache.seen(pingDigest))
+
+  def testKeepsOnlyTheMostRecentlyUsedDigestsInProcess(self):
+    settings.PING_DIGEST_CACHE_SIZE = 2
+    digests = [pingcache.digest(SAMPLE_FEED + str(i)) for i in range(3)]
+    pingcache.remember(digests[0])
+    pingcache.remember(digests[1])
+    pingcache.seen(digests[0])
+    pingcache.remember(digests[2])
+    self.assertEquals(sorted([digests[0], digests[2]]), sorted(pingcache._recent.keys()))
+    for i in range(10):
+      pingcache.seen(digests[2])
+    self.assertTrue(len(pingcache._uses) <= 2 * settings.PING_DIGEST_CACHE_SIZE)
+
+class AggregatesTest(unittest.TestCase):
+  def setUp(self):
+    for model in [Post, pshb.PostDigest, aggregates.DayAggregate, aggregates.FeedAggregate, aggregates.AuthorAggregate]:
+      db.delete(model.all(keys_only=True).fetch(1000))
+
+  def testCountsNewPostsOnlyOnce(self):
+    streamer.storePosts(ContentParser(SAMPLE_FEED).extractPosts())
+    streamer.storePosts(ContentParser(SAMPLE_FEED.replace('Second content', 'Edited second content')).extractPosts())
+    days = aggregates.getDays([datetime.date(2010, 2, 27), datetime.date(2010, 2, 28)])
+    self.assertEquals([1, 1], [day.posts for day in days])
+    self.assertEquals('Sunday February 28, 2010', days[1].label)
+    feed = aggregates.getFeeds(['http://example.org/atom'])[0]
+    self.assertEquals(2, feed.posts)
+    self.assertEquals('Second entry', feed.latestPostTitle)
+
+  def testCountsPostsByAuthor(self):
+    feed = SAMPLE_FEED.replace('<title>First entry</title>', '<title>First entry</title><author><name>Ade</name></author>')
+    streamer.storePosts(ContentParser(feed).extractPosts())
+    self.assertEquals(1, aggregates.AuthorAggregate.all().filter('author =', 'Ade').get().posts)
+
+  def testStopsCountingDeletedPosts(self):
+    streamer.storePosts(ContentParser(SAMPLE_FEED).extractPosts())
+    streamer.handleDeletePosts('http://example.org/atom')
+    self.assertEquals([0, 0], [day.posts for day in aggregates.getDays([datetime.date(2010, 2, 27), datetime.date(2010, 2, 28)])])
+
+  def testUncountsEditedPostsFromTheDayTheyWereCountedOn(self):
+    streamer.storePosts(ContentParser(SAMPLE_FEED).extractPosts())
+    edited = SAMPLE_FEED.replace('2010-02-27T12:00:00Z', '2010-03-01T12:00:00Z').replace('First content', 'Edited')
+    streamer.storePosts(ContentParser(edited).extractPosts())
+    days = [datetime.date(2010, 2, 27), datetime.date(2010, 2, 28), datetime.date(2010, 3, 1)]
+    self.assertEquals([1, 1, None], [day and day.posts for day in aggregates.getDays(days)])
+    streamer.handleDeletePosts('http://example.org/atom')
+    self.assertEquals([0, 0, None], [day and day.posts for day in aggregates.getDays(days)])
+
+  def testCountsPostsStoredBeforeTheyWereCountedOnlyOnce(self):
+    pshb.putPosts(ContentParser(SAMPLE_FEED).extractPosts())
+    Post(key_name='legacy', url='http://example.org/entries/0', feedUrl='http://example.org/atom', title='Legacy',
+         content='Legacy content', author='Ade', datePublished=datetime.datetime(2010, 2, 27, 9)).put()
+    self.assertEquals(None, aggregates.countStoredPosts())
+    self.assertEquals(None, aggregates.countStoredPosts())
+    days = aggregates.getDays([datetime.date(2010, 2, 27), datetime.date(2010, 2, 28)])
+    self.assertEquals([2, 1], [day.posts for day in days])
+    self.assertEquals(3, aggregates.getFeeds(['http://example.org/atom'])[0].posts)
+    self.assertEquals(1, aggregates.AuthorAggregate.all().filter('author =', 'Ade').get().posts)
+    self.assertTrue(pshb.PostDigest.get_by_key_name('legacy').counted)
+
+  def testGroupsPostsByDayUsingStoredLabels(self):
+    streamer.storePosts(ContentParser(SAMPLE_FEED).extractPosts())
+    posts, cursor = Post.fetchPage()
+    days = streamer.groupPostsByDay(posts)
+    self.assertEquals(['Sunday February 28, 2010', 'Saturday February 27, 2010'], [day.label for day in days])
+    self.assertEquals(['/archive/2010/02/28', '/archive/2010/02/27'], [day.url for day in days])
+    self.assertEquals([1, 1], [day.count for day in days])
+
+class AtomFeedTest(unittest.TestCase):
+  def setUp(self):
+    for model in [Post, pshb.PostBody, pshb.PostDigest]:
+      db.delete(model.all(keys_only=True).fetch(1000))
+
+  def testSerializesEachPostOnceWhenItIsStored(self):
+    streamer.storePosts(ContentParser(SAMPLE_FEED).extractPosts())
+    post = Post.get_by_key_name('tag:example.org,2010:entry-1')
+    self.assertTrue(post.getBody().atomEntry.startswith('<entry><id>tag:example.org,2010:entry-1</id>'))
+    self.assertTrue('<source><id>http://example.org/atom</id>' in post.getBody().atomEntry)
+
+  def testRenderedFeedCanBeParsedBackIntoTheSamePosts(self):
+    streamer.storePosts(ContentParser(SAMPLE_FEED.replace('First content', '&lt;b&gt;First&lt;/b&gt; content')).extractPosts())
+    posts, cursor = Post.fetchPage()
+    Post.fetchBodies(posts)
+    feed = feedparser.parse(atomfeed.renderFeed(posts, 'http://example.org/streamer/atom', 'http://example.org/streamer/',
+                                                'http://hub.example.org/'))
+    self.assertFalse(feed.bozo)
+    self.assertEquals(['Second entry', 'First entry'], [entry.title for entry in feed.entries])
+    self.assertEquals('<b>First</b> content', feed.entries[1].content[0].value)
+    self.assertEquals('http://example.org/atom', feed.entries[1].source.id)
+    self.assertEquals(['http://hub.example.org/'], [link.href for link in feed.feed.links if link.rel == 'hub'])
+
+  def testPublishesAtomFeedToHub(self):
+    publisher = StubHubPublisher()
+    streamer.handlePublish(publisher)
+    self.assertEquals(settings.PUBLISH_HUB, publisher.hub)
+    self.assertEquals([streamer.atomFeedUrl()], publisher.urls)
+
+class ContentParserTest(unittest.TestCase):
+  def testStreamingParserYieldsTheSamePostsAsExtractPosts(self):
+    posts = ContentParser(SAMPLE_FEED).extractPosts()
+    streamedPosts = list(ContentParser(SAMPLE_FEED, streaming=True).iterPosts())
+    self.assertEquals([p.key().name() for p in posts], [p.key().name() for p in streamedPosts])
+    self.assertEquals([p.feedUrl for p in posts], [p.feedUrl for p in streamedPosts])
+    self.assertEquals([p.getContent() for p in posts], [p.getContent() for p in streamedPosts])
+
+  def testStreamingParserReportsBadDataOnceFinished(self):
+    parser = ContentParser(SAMPLE_FEED.replace('</feed>', ''), streaming=True)
+    self.assertEquals(2, len(list(parser.iterPosts())))
+    self.assertFalse(parser.dataValid())
+
+  def testResolvesRelativeLinksAndSanitizesContent(self):
+    content = '&lt;a href="/about"&gt;About&lt;/a&gt;&lt;script&gt;alert(1)&lt;/script&gt;'
+    feed = SAMPLE_FEED.replace('<feed ', '<feed xml:base="http://example.org/" ').replace('First content', content)
+    posts = ContentParser(feed, microformats=False).extractPosts()
+    self.assertEquals('<a href="http://example.org/about">About</a>', posts[0].getContent())
+
+  def testWorksOutTheFeedMetadataOnce(self):
+    parser = ContentParser(SAMPLE_FEED, defaultHub='http://default.example.org/')
+    metadata = parser.feedMetadata()
+    self.assertEquals('http://example.org/atom', metadata.feedUrl)
+    self.assertEquals('http://example.org/atom', metadata.selfLink)
+    self.assertEquals('http://hub.example.org/', metadata.hub)
+    self.assertEquals('http://example.org/', metadata.sourceUrl)
+    self.assertEquals('Example Author', metadata.author)
+    self.assertEquals('http://hub.example.org/', metadata.linksByRel['hub'])
+    parser.extractPosts()
+    self.assertTrue(metadata is parser.feedMetadata())
+
+  def testFeedUrlIsTheFirstOfTheSelfAndGDataFeedLinks(self):
+    feed = SAMPLE_FEED.replace('<link rel="self"', '<link rel="http://schemas.google.com/g/2005#feed" '
+                               'href="http://example.org/gdata"/>\n  <link rel="self"')
+    self.assertEquals('http://example.org/gdata', ContentParser(feed).extractFeedUrl())
+
+  def testFeedAuthorIsTheAuthorOfEveryEntryWhenTheFeedHasNone(self):
+    feed = SAMPLE_FEED.replace('<author><name>Example Author</name></author>', '')
+    feed = feed.replace('<title>First entry</title>', '<title>First entry</title><author><name>A</name></author>')
+    self.assertEquals('', ContentParser(feed).extractFeedAuthor())
+    feed = feed.replace('<title>Second entry</title>', '<title>Second entry</title><author><name>A</name></author>')
+    self.assertEquals('A', ContentParser(feed).extractFeedAuthor())
+
+  def testFeedMetadataIsWorkedOutAgainWhenAStreamedFeedGainsLinks(self):
+    parser = ContentParser(SAMPLE_FEED, streaming=True)
+    posts = list(parser.iterPosts())
+    self.assertEquals(['http://example.org/atom'] * 2, [p.feedUrl for p in posts])
+    # Links that come after the first entry are only seen part way through a streamed parse
+    parser.data.feed.links.insert(0, feedparser.FeedParserDict(rel='self', href='http://example.org/moved'))
+    self.assertEquals('http://example.org/moved', parser.extractFeedUrl())
+
+class PutInBatchesTest(unittest.TestCase):
+  def setUp(self):
+    db.delete(pshb.PostBody.all(keys_only=True).fetch(1000))
+    pshb._putBatchSize[0] = 4
+    self.put = db.put
+
+  def tearDown(self):
+    db.put = self.put
+    pshb._putBatchSize[0] = None
+
+  def bodies(self, count, contentLength=10):
+    return [pshb.PostBody(key_name='body-%d' % i, content='x' * contentLength) for i in range(count)]
+
+  def testSplitsPutsByEntityCount(self):
+    batches = pshb.putInBatches(self.bodies(10), maxEntities=4)
+    self.assertEquals([4, 4, 2], [entities for entities, size, seconds in batches])
+    self.assertEquals(10, pshb.PostBody.all().count())
+
+  def testSplitsPutsBySize(self):
+    bodies = self.bodies(5, 1000)
+    maxBytes = 2 * pshb.estimateSize(bodies[0])
+    batches = pshb.putInBatches(bodies, maxBytes=maxBytes)
+    self.assertEquals([2, 2, 1], [entities for entities, size, seconds in batches])
+    self.assertTrue(max([size for entities, size, seconds in batches]) <= maxBytes)
+
+  def testRetriesSmallerBatchAfterTimeout(self):
+    calls = []
+    def timeOutOnce(entities):
+      calls.append(len(entities))
+      if len(calls) == 1:
+        raise db.Timeout()
+      return self.put(entities)
+    db.put = timeOutOnce
+    backoff = settings.PUT_BACKOFF_SECONDS
+    settings.PUT_BACKOFF_SECONDS = 0
+    try:
+      pshb.putInBatches(self.bodies(4), maxEntities=4)
+    finally:
+      settings.PUT_BACKOFF_SECONDS = backoff
+    self.assertEquals([4, 2, 2], calls[:3])
+    self.assertEquals(4, pshb.PostBody.all().count())
+
+class PostTest(unittest.TestCase):
+  def setUp(self):
+    for model in [Post, pshb.PostBody, pshb.PostDigest]:
+      db.delete(model.all(keys_only=True).fetch(1000))
+
+  def testStoredEntryCanBeReadBack(self):
+    posts = ContentParser(SAMPLE_FEED).extractPosts()
+    pshb.putPosts(posts)
+    post = Post.get_by_key_name('tag:example.org,2010:entry-1')
+    self.assertEquals('First entry', post.getFeedParserEntry().title)
+    self.assertEquals('First entry', post.getEntryField('title'))
+
+  def testMigratesLegacyEntryStrings(self):
+    key = 'tag:example.org,2010:legacy'
+    post = Post(key_name=key, url='http://example.org/legacy', feedUrl='http://example.org/atom',
+                entryString=repr({'title': u'Legacy entry'}))
+    post.put()
+
+    Post.migrateEntryStrings()
+    post = Post.get_by_key_name(key)
+    self.assertEquals(None, post.entryString)
+    self.assertEquals(u'Legacy entry', post.getFeedParserEntry().title)
+
+  def testStoresBodySeparatelyAndOnlyFetchesItWhenNeeded(self):
+    pshb.putPosts(ContentParser(SAMPLE_FEED).extractPosts())
+    post = Post.get_by_key_name('tag:example.org,2010:entry-2')
+    self.assertEquals(None, post.content)
+    self.assertEquals(None, post.entryBlob)
+    self.assertEquals('Second content', post.excerpt)
+    self.assertEquals('Second content', post.getContent())
+    self.assertEquals(2, pshb.PostBody.all().count())
+    # The entry already holds the content so it isn't stored a second time
+    self.assertEquals(None, pshb.PostBody.get_by_key_name('tag:example.org,2010:entry-2').content)
+
+  def testMigratesLegacyBodiesWithoutChangingTheirDigests(self):
+    posts = ContentParser(SAMPLE_FEED).extractPosts()
+    legacyPosts = []
+    for post in posts:
+      body = post.getBody()
+      legacyPosts.append(Post(key_name=post.key().name(), url=post.url, feedUrl=post.feedUrl, title=post.title,
+                              datePublished=post.datePublished, author=post.author, content=body.getContent(),
+                              entryBlob=body.entryBlob))
+    db.put(legacyPosts)
+    digests = [post.computeDigest() for post in legacyPosts]
+
+    self.assertEquals(None, Post.migrateBodies())
+    migratedPosts = Post.get_by_key_name([post.key().name() for post in posts])
+    self.assertEquals([False, False], [post.hasLegacyBody() for post in migratedPosts])
+    self.assertEquals(['First content', 'Second content'], [post.excerpt for post in migratedPosts])
+    self.assertEquals(digests, [post.computeDigest() for post in migratedPosts])
+    self.assertEquals('First entry', migratedPosts[0].getFeedParserEntry().title)
+    bodies = pshb.PostBody.get_by_key_name([post.key().name() for post in posts])
+    self.assertEquals([None, None], [body.content for body in bodies])
+
+  def testExcerptsAreShortPlainText(self):
+    self.assertEquals('Some bold text', pshb.makeExcerpt('<p>Some <b>bold</b>\ntext</p>'))
+    self.assertEquals('one two...', pshb.makeExcerpt('one two three', length=9))
+    self.assertEquals('AT...', pshb.makeExcerpt('AT&amp;T', length=5))
+
+  def testDeletesPostsInBatchesUntilTimeBudgetRunsOut(self):
+    db.put(ContentParser(SAMPLE_FEED).extractPosts())
+    deleted, cursor = Post.deleteAllPostsWithMatchingFeedUrl('http://example.org/atom', batchSize=1, timeBudget=0)
+    self.assertEquals(1, deleted)
+    self.assertTrue(cursor)
+
+    deleted, cursor = Post.deleteAllPostsWithMatchingFeedUrl('http://example.org/atom', cursor, batchSize=10)
+    self.assertEquals(1, deleted)
+    self.assertEquals(None, cursor)
+    self.assertEquals(0, Post.all().filter('feedUrl =', 'http://example.org/atom').count())
+
+  def testDeletesBodiesAlongWithPosts(self):
+    pshb.putPosts(ContentParser(SAMPLE_FEED).extractPosts())
+    Post.deleteAllPostsWithMatchingFeedUrl('http://example.org/atom')
+    self.assertEquals(0, pshb.PostBody.all().count())
+
+  def testOnlyStoresPostsThatAreNewOrChanged(self):
+    self.assertEquals(2, len(pshb.putPosts(ContentParser(SAMPLE_FEED).extractPosts())[0]))
+    self.assertEquals(0, len(pshb.putPosts(ContentParser(SAMPLE_FEED).extractPosts())[0]))
+
+    changedFeed = SAMPLE_FEED.replace('Second content', 'Edited second content')
+    changedPosts, newPosts = pshb.putPosts(ContentParser(changedFeed).extractPosts())
+    self.assertEquals(['tag:example.org,2010:entry-2'], [post.key().name() for post in changedPosts])
+    self.assertEquals([], newPosts)
+    self.assertEquals('Edited second content', Post.get_by_key_name('tag:example.org,2010:entry-2').getContent())
+
+  def testSniffsEntryIdsWithoutParsing(self):
+    entries = pshb.sniffEntries(SAMPLE_FEED)
+    self.assertEquals(['tag:example.org,2010:entry-1', 'tag:example.org,2010:entry-2'],
+                      [keyName for start, end, keyName, rawDigest in entries])
+    start, end = entries[0][:2]
+    self.assertTrue(SAMPLE_FEED[start:end].startswith('<entry>'))
+    self.assertTrue(SAMPLE_FEED[start:end].endswith('</entry>'))
+    # Anything that changes how the entries are parsed changes their digests
+    rebased = SAMPLE_FEED.replace('<feed ', '<feed xml:base="http://example.com/" ')
+    for otherEntries in [pshb.sniffEntries(rebased), pshb.sniffEntries(SAMPLE_FEED, salt='True')]:
+      self.assertNotEquals(entries[0][3], otherEntries[0][3])
+
+  def testSkipsParsingEntriesThatHaventChanged(self):
+    pshb.putPosts(ContentParser(SAMPLE_FEED, skipUnchanged=True).extractPosts())
+    parser = ContentParser(SAMPLE_FEED, skipUnchanged=True)
+    self.assertEquals(2, parser.skippedEntries)
+    self.assertEquals([], parser.extractPosts())
+    self.assertEquals('http://example.org/atom', parser.extractFeedUrl())
+
+    changedFeed = SAMPLE_FEED.replace('Second content', 'Edited second content')
+    parser = ContentParser(changedFeed, skipUnchanged=True)
+    self.assertEquals(1, parser.skippedEntries)
+    changedPosts = pshb.putPosts(parser.extractPosts())[0]
+    self.assertEquals(['tag:example.org,2010:entry-2'], [post.key().name() for post in changedPosts])
+    self.assertEquals(1, ContentParser(SAMPLE_FEED, skipUnchanged=True).skippedEntries)
+
+  def testRemembersTheMarkupOfEntriesWhosePostsHaventChanged(self):
+    pshb.putPosts(ContentParser(SAMPLE_FEED).extractPosts())
+    # Posts stored without sniffing are parsed the first time they're seen again but not after that
+    self.assertEquals(0, ContentParser(SAMPLE_FEED, skipUnchanged=True).skippedEntries)
+    self.assertEquals([], pshb.putPosts(ContentParser(SAMPLE_FEED, skipUnchanged=True).extractPosts())[0])
+    self.assertEquals(2, ContentParser(SAMPLE_FEED, skipUnchanged=True).skippedEntries)
+
+  def testPagesThroughPostsNewestFirstByCursor(self):
+    db.put(ContentParser(SAMPLE_FEED).extractPosts())
+    posts, cursor = Post.fetchPage(pageSize=1)
+    self.assertEquals(['tag:example.org,2010:entry-2'], [post.key().name() for post in posts])
+    posts, cursor = Post.fetchPage(cursor, pageSize=1)
+    self.assertEquals(['tag:example.org,2010:entry-1'], [post.key().name() for post in posts])
+    posts, cursor = Post.fetchPage(cursor, pageSize=1)
+    self.assertEquals([], posts)
+    self.assertEquals(None, cursor)
+
+  def testFetchesPostsPublishedOnASingleDay(self):
+    db.put(ContentParser(SAMPLE_FEED).extractPosts())
+    posts, cursor = Post.fetchPage(day=datetime.date(2010, 2, 27))
+    self.assertEquals(['tag:example.org,2010:entry-1'], [post.key().name() for post in posts])
+    self.assertEquals(None, cursor)
+
+  def testFindsTheNearestDaysWithPosts(self):
+    db.put(ContentParser(SAMPLE_FEED).extractPosts())
+    self.assertEquals((None, datetime.date(2010, 2, 28)), Post.findAdjacentDays(datetime.date(2010, 2, 27)))
+    self.assertEquals((datetime.date(2010, 2, 27), None), Post.findAdjacentDays(datetime.date(2010, 2, 28)))
+    self.assertEquals((datetime.date(2010, 2, 28), None), Post.findAdjacentDays(datetime.date(2010, 3, 15)))
+
+    pshb.putPosts(ContentParser(SAMPLE_FEED).extractPosts())
+    Post.deleteAllPostsWithMatchingFeedUrl('http://example.org/atom')
+    self.assertEquals(0, pshb.PostDigest.all().count())